@@ -17,7 +17,10 @@ https://github.com/rabbitmq/rabbitmq-auth-backend-http
 
 # noinspection PyUnresolvedReferences
 import n6lib  # <- 1st import, so that n6lib-specific monkey patching is done as early as possible
+from n6brokerauthapi.decision_cache import DecisionCache
 from n6brokerauthapi.views import (
+    N6BrokerAuthDecisionCacheInvalidationView,
+    N6BrokerAuthDecisionCacheStatsView,
     N6BrokerAuthResourceView,
     N6BrokerAuthTopicView,
     N6BrokerAuthUserView,
@@ -35,10 +38,14 @@ class N6BrokerAuthApiConfigHelper(ConfigMixin, BasicConfigHelper):
     config_spec = '''
         [broker_auth_api]
         auth_manager_maker_class :: importable_dotted_name
+        decision_cache_ttl = 30 :: float          ; in seconds (0 => no caching)
+        decision_cache_negative_ttl = 5 :: float  ; in seconds (0 => no caching of "deny")
+        decision_cache_max_size = 10000 :: int
     '''
 
     def prepare_config(self, config):
         config.registry.auth_manager_maker = self._get_auth_manager_maker()
+        config.registry.decision_cache = self._get_decision_cache()
         return super(N6BrokerAuthApiConfigHelper, self).prepare_config(config)
 
     def _get_auth_manager_maker(self):
@@ -47,6 +54,9 @@ class N6BrokerAuthApiConfigHelper(ConfigMixin, BasicConfigHelper):
         auth_manager_maker = auth_manager_maker_class(settings)
         return auth_manager_maker
 
+    def _get_decision_cache(self):
+        return DecisionCache.from_config_section(self.get_config_section(self.settings))
+
 
 # (see: https://github.com/rabbitmq/rabbitmq-auth-backend-http#what-must-my-web-server-do)
 RESOURCES = [
@@ -70,6 +80,18 @@ RESOURCES = [
         url_pattern='/topic',
         view_base=N6BrokerAuthTopicView,
     ),
+
+    # (administrative resources -- available only from localhost)
+    HttpResource(
+        resource_id='decision_cache_invalidation',
+        url_pattern='/decision-cache/invalidate',
+        view_base=N6BrokerAuthDecisionCacheInvalidationView,
+    ),
+    HttpResource(
+        resource_id='decision_cache_stats',
+        url_pattern='/decision-cache/stats',
+        view_base=N6BrokerAuthDecisionCacheStatsView,
+    ),
 ]
 
 
@@ -2,8 +2,12 @@
 
 import sys
 import threading
+import time
 
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import (
+    Session,
+    joinedload,
+)
 from sqlalchemy.orm.exc import NoResultFound
 from typing import Union
 
@@ -17,21 +21,97 @@ from n6lib.log_helpers import get_logger
 LOGGER = get_logger(__name__)
 
 
+def _get_admins_group(db_session):
+    try:
+        return db_session.query(models.SystemGroup).filter(
+            models.SystemGroup.name == ADMINS_SYSTEM_GROUP_NAME).one()
+    except NoResultFound:
+        LOGGER.error('System group %r not found in auth db!', ADMINS_SYSTEM_GROUP_NAME)
+        return None
+
+
+class PreloadedAuthData(object):
+
+    """
+    An in-memory snapshot of the Auth DB data needed by broker auth
+    managers -- so that (when the snapshot is used) they can answer
+    any question without accessing the Auth DB.
+
+    The snapshot keeps (detached from any DB session) `models.User`
+    instances (with their `org` already loaded) and `models.Component`
+    instances, as well as the set of logins of the users that belong
+    to the "admins" system group.
+
+    An instance is not supposed to be modified after creation (so it
+    can be safely shared between threads).
+    """
+
+    def __init__(self, login_to_user_obj, login_to_component_obj, admin_user_logins,
+                 load_time=None):
+        self.login_to_user_obj = login_to_user_obj            # type: dict
+        self.login_to_component_obj = login_to_component_obj  # type: dict
+        self.admin_user_logins = admin_user_logins            # type: frozenset
+        self.load_time = (time.time() if load_time is None else load_time)
+
+    @classmethod
+    def load(cls, db_session):
+        user_objs = db_session.query(models.User).options(joinedload(models.User.org)).all()
+        component_objs = db_session.query(models.Component).all()
+        admins_group = _get_admins_group(db_session)
+        admin_user_logins = (frozenset(user.login for user in admins_group.users)
+                             if admins_group is not None
+                             else frozenset())
+        login_to_user_obj = {}
+        for user_obj in user_objs:
+            org_obj = user_obj.org
+            assert org_obj is not None
+            login_to_user_obj[user_obj.login] = user_obj
+        login_to_component_obj = {comp_obj.login: comp_obj for comp_obj in component_objs}
+        # (detaching the objects -- so that they remain usable
+        # after the session is closed)
+        db_session.expunge_all()
+        LOGGER.info('Auth data preloaded: %d users (including %d admins), %d components.',
+                    len(login_to_user_obj), len(admin_user_logins), len(login_to_component_obj))
+        return cls(login_to_user_obj, login_to_component_obj, admin_user_logins)
+
+    def get_age(self):
+        return time.time() - self.load_time
+
+
 class BaseBrokerAuthManagerMaker(object):
 
+    # the minimum interval (in seconds) between attempts to reload
+    # the preloaded auth data after a failed attempt (meanwhile the
+    # previous snapshot is still in use)
+    preloaded_auth_data_reload_retry_interval = 10.0
+
     def __init__(self, settings):
         self._db_connector = SQLAuthDBConnector(settings=settings)
         self._manager_creation_lock = threading.Lock()  # (just in case...)
+        self._auth_data_lock = threading.Lock()
+        self._auth_data = None  # type: Union[PreloadedAuthData, None]
+        self._auth_data_reload_retry_time = 0.0
 
     def __call__(self, params):
-        force_exit_on_any_remaining_entered_contexts(self._db_connector)
+        auth_data = self._get_auth_data()
+        if auth_data is None:
+            force_exit_on_any_remaining_entered_contexts(self._db_connector)
         with self._manager_creation_lock:
             manager_factory = self.get_manager_factory(params)
             manager_factory_kwargs = self.get_manager_factory_kwargs(params)
-            manager = manager_factory(**manager_factory_kwargs)
+            manager = manager_factory(auth_data=auth_data, **manager_factory_kwargs)
         assert isinstance(manager, BaseBrokerAuthManager)
         return manager
 
+    def invalidate_preloaded_auth_data(self):
+        """
+        Make the preloaded auth data (if any) be reloaded on the next
+        request (to be called, e.g., when the Auth DB has been changed).
+        """
+        with self._auth_data_lock:
+            self._auth_data = None
+            self._auth_data_reload_retry_time = 0.0
+
     #
     # Abstract method (*must* be implemented in concrete subclasses)
 
@@ -46,21 +126,82 @@ class BaseBrokerAuthManagerMaker(object):
         return dict(db_connector=self._db_connector,
                     params=validated_view_params)
 
+    #
+    # Hook that *can* be overridden/extended in subclasses (if needed)
+
+    def get_preloaded_auth_data_max_age(self):  # type: () -> Union[float, None]
+        """
+        Get the maximum age (in seconds) of the preloaded auth data
+        snapshot (after that time the snapshot is reloaded from the
+        Auth DB) or None -- meaning that the auth data should not be
+        preloaded at all, i.e., that the Auth DB is to be queried on
+        each request (the default).
+        """
+        return None
+
+    #
+    # Private stuff
+
+    def _get_auth_data(self):
+        max_age = self.get_preloaded_auth_data_max_age()
+        if max_age is None:
+            return None
+        auth_data = self._auth_data
+        if auth_data is None or (auth_data.get_age() >= max_age and
+                                 time.time() >= self._auth_data_reload_retry_time):
+            # If there is an older snapshot and another thread is
+            # just reloading the data, we do not wait for it but just
+            # use the older snapshot.
+            if self._auth_data_lock.acquire(auth_data is None):
+                try:
+                    if self._auth_data is auth_data:
+                        self._auth_data = self._reload_auth_data(auth_data)
+                    auth_data = self._auth_data
+                finally:
+                    self._auth_data_lock.release()
+        assert auth_data is not None
+        return auth_data
+
+    def _reload_auth_data(self, stale_auth_data):
+        try:
+            return self._load_auth_data()
+        except Exception:
+            if stale_auth_data is None:
+                raise
+            # The Auth DB may be unavailable only temporarily, so --
+            # rather than failing all requests -- we keep using the
+            # older snapshot (and do not retry on each request).
+            retry_interval = self.preloaded_auth_data_reload_retry_interval
+            self._auth_data_reload_retry_time = time.time() + retry_interval
+            LOGGER.error('Could not reload the preloaded auth data! The older snapshot '
+                         '(%.1f seconds old) will still be used; the next reload attempt '
+                         'in %.1f seconds.', stale_auth_data.get_age(), retry_interval,
+                         exc_info=True)
+            return stale_auth_data
+
+    def _load_auth_data(self):
+        force_exit_on_any_remaining_entered_contexts(self._db_connector)
+        with self._db_connector as db_session:
+            return PreloadedAuthData.load(db_session)
+
 
 class BaseBrokerAuthManager(object):
 
     def __init__(self,
                  db_connector,
-                 params):
+                 params,
+                 auth_data=None):
         if 'username' not in params:
             raise ValueError("param 'username' not given")  # view code should have ensured that
         self.db_connector = db_connector
         self.params = params    # type: dict    # request params (already deduplicated + validated)
+        self.auth_data = auth_data  # type: Union[PreloadedAuthData, None]  # (None => use Auth DB)
         self.db_session = None  # type: Session
         self.client_obj = None  # type: Union[models.User, models.Component, None]
 
     def __enter__(self):
-        self.db_session = self.db_connector.__enter__()
+        if self.auth_data is None:
+            self.db_session = self.db_connector.__enter__()
         try:
             self.client_obj = self._verify_and_get_client_obj()
             return self
@@ -69,6 +210,8 @@ class BaseBrokerAuthManager(object):
             raise
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.auth_data is not None:
+            return
         try:
             self.db_connector.__exit__(exc_type, exc_val, exc_tb)
         finally:
@@ -124,19 +267,13 @@ class BaseBrokerAuthManager(object):
         if self.client_type != 'user':
             return False
         assert self.client_verified and self.client_obj is not None
-        admins_group = self._get_admins_group()
+        if self.auth_data is not None:
+            return self.client_obj.login in self.auth_data.admin_user_logins
+        admins_group = _get_admins_group(self.db_session)
         if admins_group is not None:
             return admins_group in self.client_obj.system_groups
         return False
 
-    def _get_admins_group(self):
-        try:
-            return self.db_session.query(models.SystemGroup).filter(
-                models.SystemGroup.name == ADMINS_SYSTEM_GROUP_NAME).one()
-        except NoResultFound:
-            LOGGER.error('System group %r not found in auth db!', ADMINS_SYSTEM_GROUP_NAME)
-            return None
-
     #
     # Abstract methods (*must* be implemented in concrete subclasses)
 
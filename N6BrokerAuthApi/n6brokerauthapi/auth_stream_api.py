@@ -25,6 +25,7 @@ class StreamApiBrokerAuthManagerMaker(ConfigMixin, BaseBrokerAuthManagerMaker):
         push_exchange_name = _push :: str
         privileged_component_logins = rabbit-inner :: list_of_str
         autogenerated_queue_prefix = stomp :: str
+        preloaded_auth_data_max_age = 0 :: float  ; in seconds (0 => no preloading)
     """
 
     def __init__(self, settings):
@@ -45,6 +46,9 @@ class StreamApiBrokerAuthManagerMaker(ConfigMixin, BaseBrokerAuthManagerMaker):
     def get_manager_factory(self, params):
         return StreamApiBrokerAuthManager
 
+    def get_preloaded_auth_data_max_age(self):
+        return self._config['preloaded_auth_data_max_age'] or None
+
     def get_manager_factory_kwargs(self, params):
         base = super(StreamApiBrokerAuthManagerMaker, self).get_manager_factory_kwargs(params)
         return dict(base,
@@ -82,6 +86,8 @@ class StreamApiBrokerAuthManager(BaseBrokerAuthManager):
         return super(StreamApiBrokerAuthManager, self).should_try_to_verify_client()
 
     def verify_and_get_user_obj(self):
+        if self.auth_data is not None:
+            return self.auth_data.login_to_user_obj.get(self.broker_username)
         user_obj = self._from_db(models.User, 'login', self.broker_username)
         if user_obj is not None:
             org_obj = user_obj.org
@@ -89,6 +95,8 @@ class StreamApiBrokerAuthManager(BaseBrokerAuthManager):
         return user_obj
 
     def verify_and_get_component_obj(self):
+        if self.auth_data is not None:
+            return self.auth_data.login_to_component_obj.get(self.broker_username)
         return self._from_db(models.Component, 'login', self.broker_username)
 
     def _from_db(self, model, col_name, val):
@@ -0,0 +1,153 @@
+# Copyright (c) 2013-2019 NASK. All rights reserved.
+
+import collections
+import threading
+import time
+
+from n6lib.log_helpers import get_logger
+
+
+LOGGER = get_logger(__name__)
+
+
+DENY_DECISION = 'deny'
+
+
+class DecisionCache(object):
+
+    """
+    An in-process, thread-safe, size-limited TTL cache of the
+    "allow..."/"deny" decisions made by the broker auth views.
+
+    RabbitMQ's `rabbitmq-auth-backend-http` plugin asks our API on
+    every connection and channel operation, so during a reconnect
+    storm the same questions are asked again and again -- and each
+    of them would, otherwise, involve an Auth DB session and several
+    queries.
+
+    Constructor args/kwargs:
+        `ttl`:
+            The time (in seconds) for which an "allow..." decision is
+            kept.  If it is 0 (or negative) nothing is cached at all.
+        `negative_ttl`:
+            The time (in seconds) for which a "deny" decision is kept
+            (typically much shorter than `ttl` -- so that, e.g., a
+            newly added user does not need to wait long for access).
+            If it is 0 (or negative) "deny" decisions are not cached.
+        `max_size`:
+            The maximum number of cached decisions; when it is
+            exceeded, the least recently used ones are dropped.
+        `time_func` (default: `time.time`):
+            A function used to determine current time.
+
+    >>> t = 0
+    >>> cache = DecisionCache(ttl=10, negative_ttl=2, max_size=2,
+    ...                       time_func=lambda: t)
+    >>> cache.get(('user', 'a')) is None
+    True
+    >>> cache.set(('user', 'a'), 'allow')
+    >>> cache.set(('user', 'b'), 'deny')
+    >>> cache.get(('user', 'a'))
+    'allow'
+    >>> cache.get(('user', 'b'))
+    'deny'
+    >>> t = 2
+    >>> cache.get(('user', 'b')) is None   # (negative TTL elapsed)
+    True
+    >>> cache.set(('user', 'c'), 'allow')
+    >>> cache.set(('user', 'd'), 'allow')  # (max size exceeded)
+    >>> cache.get(('user', 'a')) is None   # (least recently used)
+    True
+    >>> cache.get(('user', 'c'))
+    'allow'
+    >>> cache.invalidate()
+    >>> cache.get(('user', 'c')) is None
+    True
+    >>> stats = cache.get_stats()
+    >>> (stats['hits'], stats['negative_hits'], stats['misses'])
+    (3, 1, 4)
+    >>> (stats['expirations'], stats['evictions'], stats['invalidations'])
+    (1, 1, 1)
+    >>> stats['size']
+    0
+    """
+
+    def __init__(self, ttl, negative_ttl, max_size, time_func=time.time):
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._max_size = max_size
+        self._time_func = time_func
+        self._lock = threading.Lock()
+        self._key_to_decision_and_expiry = collections.OrderedDict()
+        self._stat_counters = collections.Counter()
+
+    @classmethod
+    def from_config_section(cls, config_section):
+        return cls(ttl=config_section['decision_cache_ttl'],
+                   negative_ttl=config_section['decision_cache_negative_ttl'],
+                   max_size=config_section['decision_cache_max_size'])
+
+    @property
+    def enabled(self):
+        return self._ttl > 0 and self._max_size > 0
+
+    @staticmethod
+    def make_key(kind, params):
+        """
+        Make a cache key from the view kind (e.g., 'user' or 'topic')
+        and a dict of (already validated) request params.
+        """
+        return (kind,) + tuple(sorted(params.iteritems()))
+
+    def get(self, key):
+        """Get the cached decision (a str) or None."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            try:
+                decision, expiry_time = self._key_to_decision_and_expiry.pop(key)
+            except KeyError:
+                self._stat_counters['misses'] += 1
+                return None
+            if expiry_time <= self._time_func():
+                self._stat_counters['expirations'] += 1
+                self._stat_counters['misses'] += 1
+                return None
+            # re-inserting makes the item the most recently used one
+            self._key_to_decision_and_expiry[key] = decision, expiry_time
+            self._stat_counters['hits'] += 1
+            if decision == DENY_DECISION:
+                self._stat_counters['negative_hits'] += 1
+            return decision
+
+    def set(self, key, decision):
+        ttl = (self._negative_ttl if decision == DENY_DECISION
+               else self._ttl)
+        if not (self.enabled and ttl > 0):
+            return
+        with self._lock:
+            self._key_to_decision_and_expiry.pop(key, None)
+            self._key_to_decision_and_expiry[key] = decision, self._time_func() + ttl
+            while len(self._key_to_decision_and_expiry) > self._max_size:
+                self._key_to_decision_and_expiry.popitem(last=False)
+                self._stat_counters['evictions'] += 1
+
+    def invalidate(self):
+        with self._lock:
+            self._key_to_decision_and_expiry.clear()
+            self._stat_counters['invalidations'] += 1
+        LOGGER.info('The decision cache has been invalidated.')
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict.fromkeys(
+                ['hits', 'negative_hits', 'misses',
+                 'expirations', 'evictions', 'invalidations'], 0)
+            stats.update(self._stat_counters)
+            stats['size'] = len(self._key_to_decision_and_expiry)
+            return stats
+
+
+if __name__ == '__main__':
+    from n6lib.unit_test_helpers import run_module_doctests
+    run_module_doctests()
@@ -0,0 +1,178 @@
+# Copyright (c) 2013-2019 NASK. All rights reserved.
+
+import json
+import unittest
+
+from unittest_expander import (
+    expand,
+    foreach,
+    param,
+)
+
+from n6brokerauthapi.decision_cache import DecisionCache
+from n6brokerauthapi.tests.test_views_with_auth_stream_api import (
+    ADMIN_USER,
+    EXCHANGE,
+    ORG1,
+    READ,
+    TEST_USER,
+    UNKNOWN_USER,
+    _AssertResponseMixin,
+    _MockerMixin,
+)
+from n6brokerauthapi.views import (
+    N6BrokerAuthDecisionCacheInvalidationView,
+    N6BrokerAuthDecisionCacheStatsView,
+    N6BrokerAuthResourceView,
+    N6BrokerAuthUserView,
+)
+from n6sdk.exceptions import AuthorizationError
+
+
+class _DecisionCacheMixin(_MockerMixin, _AssertResponseMixin):
+
+    def setUp(self):
+        super(_DecisionCacheMixin, self).setUp()
+        self.time = 1000
+        self.decision_cache = DecisionCache(
+            ttl=30,
+            negative_ttl=5,
+            max_size=100,
+            time_func=lambda: self.time)
+        self.config.registry.decision_cache = self.decision_cache
+
+    def perform_request(self, view_class, remote_addr=None, **params):
+        request = self.create_request(view_class, **params)
+        if remote_addr is not None:
+            request.remote_addr = remote_addr
+        return request.perform()
+
+    def perform_user_request(self, username):
+        return self.perform_request(N6BrokerAuthUserView, username=username)
+
+    def perform_resource_request(self, username):
+        return self.perform_request(N6BrokerAuthResourceView,
+                                    username=username,
+                                    vhost='whatever',
+                                    resource=EXCHANGE,
+                                    permission=READ,
+                                    name=ORG1)
+
+    def db_session_entered_count(self):
+        return self.connector_mock.__enter__.call_count
+
+
+class TestViewsWithDecisionCache(_DecisionCacheMixin, unittest.TestCase):
+
+    def test_allow_decision_is_cached(self):
+        resp = self.perform_resource_request(TEST_USER)
+        self.assertAllow(resp)
+        self.assertEqual(self.db_session_entered_count(), 1)
+        for _ in range(3):
+            resp = self.perform_resource_request(TEST_USER)
+            self.assertAllow(resp)
+        self.assertEqual(self.db_session_entered_count(), 1)
+        stats = self.decision_cache.get_stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['size']), (3, 1, 1))
+
+    def test_allow_administrator_decision_is_cached(self):
+        self.perform_user_request(ADMIN_USER)
+        resp = self.perform_user_request(ADMIN_USER)
+        self.assertEqual(resp.body, 'allow administrator')
+        self.assertEqual(self.db_session_entered_count(), 1)
+
+    def test_allow_decision_expires(self):
+        self.perform_resource_request(TEST_USER)
+        self.time += 29
+        self.perform_resource_request(TEST_USER)
+        self.assertEqual(self.db_session_entered_count(), 1)
+        self.time += 1
+        resp = self.perform_resource_request(TEST_USER)
+        self.assertAllow(resp)
+        self.assertEqual(self.db_session_entered_count(), 2)
+
+    def test_deny_decision_is_cached_with_negative_ttl(self):
+        resp = self.perform_user_request(UNKNOWN_USER)
+        self.assertDeny(resp)
+        self.time += 4
+        resp = self.perform_user_request(UNKNOWN_USER)
+        self.assertDeny(resp)
+        self.assertEqual(self.db_session_entered_count(), 1)
+        self.time += 1
+        resp = self.perform_user_request(UNKNOWN_USER)
+        self.assertDeny(resp)
+        self.assertEqual(self.db_session_entered_count(), 2)
+        self.assertEqual(self.decision_cache.get_stats()['negative_hits'], 1)
+
+    def test_different_views_and_params_are_cached_separately(self):
+        self.perform_user_request(TEST_USER)
+        self.perform_resource_request(TEST_USER)
+        self.perform_user_request(ADMIN_USER)
+        self.assertEqual(self.db_session_entered_count(), 3)
+        self.assertEqual(self.decision_cache.get_stats()['size'], 3)
+
+    def test_request_with_password_is_not_cached(self):
+        for _ in range(2):
+            resp = self.perform_request(N6BrokerAuthUserView,
+                                        username=TEST_USER,
+                                        password='123')
+            self.assertDeny(resp)
+        self.assertEqual(self.decision_cache.get_stats()['size'], 0)
+
+    def test_no_caching_if_disabled(self):
+        self.config.registry.decision_cache = DecisionCache(ttl=0, negative_ttl=5, max_size=100)
+        for _ in range(2):
+            resp = self.perform_resource_request(TEST_USER)
+            self.assertAllow(resp)
+        self.assertEqual(self.db_session_entered_count(), 2)
+
+
+@expand
+class TestLocalhostOnlyDecisionCacheViews(_DecisionCacheMixin, unittest.TestCase):
+
+    @foreach(['127.0.0.1', '::1'])
+    def test_invalidation(self, remote_addr):
+        self.perform_resource_request(TEST_USER)
+        resp = self.perform_request(N6BrokerAuthDecisionCacheInvalidationView,
+                                    remote_addr=remote_addr)
+        self.assertEqual(resp.body, 'invalidated')
+        self.perform_resource_request(TEST_USER)
+        self.assertEqual(self.db_session_entered_count(), 2)
+        self.assertEqual(self.decision_cache.get_stats()['invalidations'], 1)
+
+    @foreach(['127.0.0.1', '::1'])
+    def test_stats(self, remote_addr):
+        self.perform_resource_request(TEST_USER)
+        self.perform_resource_request(TEST_USER)
+        resp = self.perform_request(N6BrokerAuthDecisionCacheStatsView,
+                                    remote_addr=remote_addr)
+        stats = json.loads(resp.body)
+        self.assertEqual(stats, {
+            'hits': 1,
+            'negative_hits': 0,
+            'misses': 1,
+            'expirations': 0,
+            'evictions': 0,
+            'invalidations': 0,
+            'size': 1,
+        })
+
+    @foreach(
+        param(view_class=N6BrokerAuthDecisionCacheInvalidationView),
+        param(view_class=N6BrokerAuthDecisionCacheStatsView),
+    )
+    @foreach(
+        param(remote_addr='10.20.30.40'),
+        param(remote_addr='192.168.0.1'),
+        param(remote_addr='2001:db8::1'),
+    )
+    def test_non_local_access_refused(self, view_class, remote_addr):
+        self.perform_resource_request(TEST_USER)
+        with self.assertRaises(AuthorizationError):
+            self.perform_request(view_class, remote_addr=remote_addr)
+        self.assertEqual(self.decision_cache.get_stats()['invalidations'], 0)
+        self.assertEqual(self.decision_cache.get_stats()['size'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
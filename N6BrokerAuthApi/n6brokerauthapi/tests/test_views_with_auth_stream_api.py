@@ -87,6 +87,13 @@ READ = 'read'
 
 class _MockerMixin(RequestHelperMixin, DBConnectionPatchMixin):
 
+    # (can be extended in subclasses)
+    auth_manager_maker_settings = {
+        'stream_api_broker_auth.push_exchange_name': PUSH_EXCHANGE,
+        'stream_api_broker_auth.privileged_component_logins': PRIVILEGED_COMPONENT,
+        'stream_api_broker_auth.autogenerated_queue_prefix': AUTOGENERATED_QUEUE_PREFIX,
+    }
+
     # noinspection PyUnresolvedReferences
     def setUp(self):
         self.config = self.prepare_pyramid_testing()
@@ -95,11 +102,7 @@ class _MockerMixin(RequestHelperMixin, DBConnectionPatchMixin):
         self._setup_db_mock()
 
     def _setup_auth_manager_maker(self):
-        settings = {
-            'stream_api_broker_auth.push_exchange_name': PUSH_EXCHANGE,
-            'stream_api_broker_auth.privileged_component_logins': PRIVILEGED_COMPONENT,
-            'stream_api_broker_auth.autogenerated_queue_prefix': AUTOGENERATED_QUEUE_PREFIX,
-        }
+        settings = self.auth_manager_maker_settings
         with patch('n6brokerauthapi.auth_base.SQLAuthDBConnector',
                    return_value=self.connector_mock):
             self.config.registry.auth_manager_maker = StreamApiBrokerAuthManagerMaker(settings)
@@ -752,5 +755,113 @@ class TestTopicView(_N6BrokerViewTestingMixin, unittest.TestCase):
         self.assertDeny(resp)
 
 
+#
+# Actual tests with preloaded auth data (instead of per-request DB access)
+#
+
+class _PreloadedAuthDataMixin(object):
+
+    auth_manager_maker_settings = dict(
+        _MockerMixin.auth_manager_maker_settings,
+        **{'stream_api_broker_auth.preloaded_auth_data_max_age': '60'})
+
+
+class TestUserViewWithPreloadedAuthData(_PreloadedAuthDataMixin, TestUserView):
+    pass
+
+
+class TestVHostViewWithPreloadedAuthData(_PreloadedAuthDataMixin, TestVHostView):
+    pass
+
+
+class TestResourceViewWithPreloadedAuthData(_PreloadedAuthDataMixin, TestResourceView):
+    pass
+
+
+class TestTopicViewWithPreloadedAuthData(_PreloadedAuthDataMixin, TestTopicView):
+    pass
+
+
+class TestPreloadedAuthDataReloading(_PreloadedAuthDataMixin,
+                                     _MockerMixin,
+                                     _AssertResponseMixin,
+                                     unittest.TestCase):
+
+    @property
+    def auth_manager_maker(self):
+        return self.config.registry.auth_manager_maker
+
+    def perform_requests(self, count=5):
+        for _ in xrange(count):
+            request = self.create_request(N6BrokerAuthUserView, username=ADMIN_USER)
+            resp = request.perform()
+            self.assertAdministratorTagPresent(resp)
+            self.assertAllow(resp)
+
+    def db_session_entered_count(self):
+        return self.connector_mock.__enter__.call_count
+
+    def test_loaded_once(self):
+        self.perform_requests()
+        self.assertConnectorUsedOnlyAfterEnsuredClean()
+        self.assertEqual(self.db_session_entered_count(), 1)
+        self.assertEqual(self.session_mock.expunge_all.call_count, 1)
+
+    def test_reloaded_when_too_old(self):
+        self.perform_requests()
+        # noinspection PyProtectedMember
+        self.auth_manager_maker._auth_data.load_time -= 59
+        self.perform_requests()
+        self.assertEqual(self.db_session_entered_count(), 1)
+        # noinspection PyProtectedMember
+        self.auth_manager_maker._auth_data.load_time -= 1
+        self.perform_requests()
+        self.assertEqual(self.db_session_entered_count(), 2)
+
+    def test_reloaded_after_invalidation(self):
+        self.perform_requests()
+        self.auth_manager_maker.invalidate_preloaded_auth_data()
+        self.perform_requests()
+        self.assertEqual(self.db_session_entered_count(), 2)
+
+    def test_older_snapshot_used_if_reload_failed(self):
+        self.perform_requests()
+        # noinspection PyProtectedMember
+        self.auth_manager_maker._auth_data.load_time -= 60
+        self.connector_mock.__enter__.side_effect = RuntimeError('Auth DB unavailable')
+        self.perform_requests()
+        # (failed once, then no more attempts until the retry time)
+        self.assertEqual(self.db_session_entered_count(), 2)
+        self.connector_mock.__enter__.side_effect = None
+        self.perform_requests()
+        self.assertEqual(self.db_session_entered_count(), 2)
+        # noinspection PyProtectedMember
+        self.auth_manager_maker._auth_data_reload_retry_time -= 10
+        self.perform_requests()
+        self.assertEqual(self.db_session_entered_count(), 3)
+        # noinspection PyProtectedMember
+        self.assertLess(self.auth_manager_maker._auth_data.get_age(), 1)
+
+    def test_reload_error_propagated_if_no_older_snapshot(self):
+        self.connector_mock.__enter__.side_effect = RuntimeError('Auth DB unavailable')
+        request = self.create_request(N6BrokerAuthUserView, username=ADMIN_USER)
+        with self.assertRaises(RuntimeError):
+            request.perform()
+        self.connector_mock.__enter__.side_effect = None
+        self.perform_requests()
+        self.assertEqual(self.db_session_entered_count(), 2)
+
+    def test_changes_visible_after_reload(self):
+        self.perform_requests()
+        self.collection['system_group'][0].users.remove(
+            self.collection['user'][1])  # (ADMIN_USER is no longer an admin)
+        self.perform_requests(1)
+        self.auth_manager_maker.invalidate_preloaded_auth_data()
+        request = self.create_request(N6BrokerAuthUserView, username=ADMIN_USER)
+        resp = request.perform()
+        self.assertNoAdministratorTag(resp)
+        self.assertAllow(resp)
+
+
 if __name__ == '__main__':
     unittest.main()
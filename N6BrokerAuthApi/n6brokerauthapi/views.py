@@ -8,7 +8,10 @@ from n6brokerauthapi.auth_base import BaseBrokerAuthManager
 from n6lib.class_helpers import attr_required
 from n6lib.common_helpers import ascii_str
 from n6lib.log_helpers import get_logger
-from n6sdk.exceptions import ParamCleaningError
+from n6sdk.exceptions import (
+    AuthorizationError,
+    ParamCleaningError,
+)
 from n6sdk.pyramid_commons import (
     AbstractViewBase,
     SingleParamValuesViewMixin,
@@ -48,7 +51,7 @@ class _N6BrokerAuthViewBase(SingleParamValuesViewMixin, AbstractViewBase):
 
     def make_response(self):
         self.validate_params()
-        response = self.make_auth_response()
+        response = self._make_auth_response_using_decision_cache()
         assert isinstance(response, Response)
         return response
 
@@ -59,6 +62,10 @@ class _N6BrokerAuthViewBase(SingleParamValuesViewMixin, AbstractViewBase):
     # names (str) to `whether this param is required` flags (bool):
     param_name_to_required_flag = None
 
+    # Attribute that in a subclass must be a str identifying the
+    # kind of the view (it is a part of decision cache keys):
+    decision_cache_kind = None
+
     # Method that *can* be extended in subclasses (if needed):
     @attr_required('param_name_to_required_flag')
     def validate_params(self):
@@ -77,6 +84,11 @@ class _N6BrokerAuthViewBase(SingleParamValuesViewMixin, AbstractViewBase):
     def auth_manager_maker(self):
         return self.request.registry.auth_manager_maker
 
+    @property
+    def decision_cache(self):
+        # (None if the app has not been equipped with a decision cache)
+        return getattr(self.request.registry, 'decision_cache', None)
+
     @classmethod
     @attr_required('param_name_to_required_flag')
     def get_required_param_names(cls):
@@ -99,6 +111,26 @@ class _N6BrokerAuthViewBase(SingleParamValuesViewMixin, AbstractViewBase):
     #
     # Private stuff
 
+    @attr_required('decision_cache_kind')
+    def _make_auth_response_using_decision_cache(self):
+        decision_cache = self.decision_cache
+        if (decision_cache is None
+              or not decision_cache.enabled
+              # (not caching anything related to a password -- so that
+              # no passwords are kept in memory)
+              or 'password' in self.params):
+            return self.make_auth_response()
+        known_params = {name: value
+                        for name, value in self.params.iteritems()
+                        if name in self.param_name_to_required_flag}
+        key = decision_cache.make_key(self.decision_cache_kind, known_params)
+        decision = decision_cache.get(key)
+        if decision is not None:
+            return self.plain_text_response(decision)
+        response = self.make_auth_response()
+        decision_cache.set(key, response.body)
+        return response
+
     def _log(self, level, log_message):
         LOGGER.log(level, '[%r: %s] %s',
                    self,
@@ -160,6 +192,8 @@ class _N6BrokerAuthResourceViewBase(_N6BrokerAuthViewBase):
 # the *user_path* view (in rabbitmq-auth-backend-http's parlance)
 class N6BrokerAuthUserView(_N6BrokerAuthViewBase):
 
+    decision_cache_kind = 'user'
+
     param_name_to_required_flag = {
         'username': True,
         'password': False,
@@ -178,6 +212,8 @@ class N6BrokerAuthUserView(_N6BrokerAuthViewBase):
 # the *vhost_path* view (in rabbitmq-auth-backend-http's parlance)
 class N6BrokerAuthVHostView(_N6BrokerAuthViewBase):
 
+    decision_cache_kind = 'vhost'
+
     param_name_to_required_flag = {
         'username': True,
         'vhost': True,
@@ -197,6 +233,8 @@ class N6BrokerAuthVHostView(_N6BrokerAuthViewBase):
 # the *resource_path* view (in rabbitmq-auth-backend-http's parlance)
 class N6BrokerAuthResourceView(_N6BrokerAuthResourceViewBase):
 
+    decision_cache_kind = 'resource'
+
     valid_resources = ('exchange', 'queue')
     valid_permissions = ('configure', 'write', 'read')
 
@@ -215,6 +253,8 @@ class N6BrokerAuthResourceView(_N6BrokerAuthResourceViewBase):
 # the *topic_path* view (in rabbitmq-auth-backend-http's parlance)
 class N6BrokerAuthTopicView(_N6BrokerAuthResourceViewBase):
 
+    decision_cache_kind = 'topic'
+
     param_name_to_required_flag = dict(
         _N6BrokerAuthResourceViewBase.param_name_to_required_flag,
         **{'routing_key': True})
@@ -230,3 +270,55 @@ class N6BrokerAuthTopicView(_N6BrokerAuthResourceViewBase):
             if auth_manager.apply_topic_rules():
                 return self.allow_response()
         return self.deny_response()
+
+
+#
+# Administrative views (available only from localhost)
+
+class _N6BrokerAuthLocalhostOnlyViewBase(AbstractViewBase):
+
+    LOCALHOST_ADDRESSES = ('127.0.0.1', '::1')
+
+    def make_response(self):
+        # Note: we use `remote_addr`, *not* `client_addr` -- as the
+        # latter is taken from the `X-Forwarded-For` header (if
+        # present), i.e., it could be easily spoofed.
+        remote_addr = self.request.remote_addr
+        if remote_addr not in self.LOCALHOST_ADDRESSES:
+            LOGGER.error('Refusing access to %r (%s) from a non-local address: %s.',
+                         self,
+                         ascii_str(self.request.url),
+                         ascii_str(remote_addr))
+            raise AuthorizationError(public_message='Access allowed only from localhost.')
+        response = self.make_localhost_only_response()
+        assert isinstance(response, Response)
+        return response
+
+    # Abstract method (*must* be implemented in concrete subclasses):
+    def make_localhost_only_response(self):  # type: () -> Response
+        raise NotImplementedError
+
+    @property
+    def decision_cache(self):
+        decision_cache = getattr(self.request.registry, 'decision_cache', None)
+        if decision_cache is None:
+            raise AssertionError('the app has not been equipped with a decision cache')
+        return decision_cache
+
+
+class N6BrokerAuthDecisionCacheInvalidationView(_N6BrokerAuthLocalhostOnlyViewBase):
+
+    @classmethod
+    def get_default_http_methods(cls):
+        return 'POST'
+
+    def make_localhost_only_response(self):
+        self.decision_cache.invalidate()
+        self.request.registry.auth_manager_maker.invalidate_preloaded_auth_data()
+        return self.plain_text_response('invalidated')
+
+
+class N6BrokerAuthDecisionCacheStatsView(_N6BrokerAuthLocalhostOnlyViewBase):
+
+    def make_localhost_only_response(self):
+        return self.json_response(self.decision_cache.get_stats())
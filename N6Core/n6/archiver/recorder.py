@@ -72,6 +72,8 @@ class Recorder(QueuedBase):
                     "exchange_type": "topic"
                     }
 
+    supports_trusted_record_dict_input = True
+
     SQL_WAIT_TIMEOUT = "SET SESSION wait_timeout = {wait}"
 
     def __init__(self, **kwargs):
@@ -90,16 +92,16 @@ class Recorder(QueuedBase):
         self.routing_key = None
 
         self.dict_map_fun = {
-            "event.filtered": (RecordDict.from_json, self.new_event),
-            "bl-new.filtered": (BLRecordDict.from_json, self.blacklist_new),
-            "bl-change.filtered": (BLRecordDict.from_json, self.blacklist_change),
-            "bl-delist.filtered": (BLRecordDict.from_json, self.blacklist_delist),
-            "bl-expire.filtered": (BLRecordDict.from_json, self.blacklist_expire),
-            "bl-update.filtered": (BLRecordDict.from_json, self.blacklist_update),
-            "suppressed.filtered": (RecordDict.from_json, self.suppressed_update),
+            "event.filtered": (RecordDict, self.new_event),
+            "bl-new.filtered": (BLRecordDict, self.blacklist_new),
+            "bl-change.filtered": (BLRecordDict, self.blacklist_change),
+            "bl-delist.filtered": (BLRecordDict, self.blacklist_delist),
+            "bl-expire.filtered": (BLRecordDict, self.blacklist_expire),
+            "bl-update.filtered": (BLRecordDict, self.blacklist_update),
+            "suppressed.filtered": (RecordDict, self.suppressed_update),
         }
         # keys in each of the tuples being values of `dict_map_fun`
-        self.FROM_JSON = 0
+        self.RECORD_DICT_CLASS = 0
         self.HANDLE_EVENT = 1
 
         super(Recorder, self).__init__(**kwargs)
@@ -168,10 +170,10 @@ class Recorder(QueuedBase):
         # take the first two parts of the routing key
         truncated_rk = self.get_truncated_rk(self.routing_key, 2)
 
-        # run BLRecordDict.from_json() or RecordDict.from_json()
+        # deserialize BLRecordDict or RecordDict
         # depending on the routing key
-        from_json = self.dict_map_fun[truncated_rk][self.FROM_JSON]
-        self.record_dict = from_json(body)
+        record_dict_class = self.dict_map_fun[truncated_rk][self.RECORD_DICT_CLASS]
+        self.record_dict = self.record_dict_from_json(record_dict_class, body, properties)
         # add modified time, set microseconds to 0, because the database
         #  does not have microseconds, and it is not known if the base is not rounded
         self.record_dict['modified'] = datetime.datetime.utcnow().replace(microsecond=0)
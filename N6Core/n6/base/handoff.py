@@ -0,0 +1,331 @@
+# Copyright (c) 2013-2019 NASK. All rights reserved.
+
+"""
+The *state handoff* mode of restarting stateful components (see:
+StateHandoffMixin).
+"""
+
+import cPickle
+import errno
+import os
+import socket
+import struct
+import time
+
+from pika.adapters.select_connection import READ
+
+from n6lib.log_helpers import get_logger
+
+
+LOGGER = get_logger(__name__)
+
+
+class StateHandoffError(Exception):
+    """Raised by the new instance if the state handoff failed."""
+
+
+class StateHandoffMixin(object):
+
+    """
+    A mixin for QueuedBase subclasses that keep a (possibly, very
+    large) in-memory state -- to make it possible to restart such a
+    component without stalling the pipeline for the time needed to
+    store and load the whole state.
+
+    A running instance listens on a Unix socket (see: the
+    `state_handoff_socket_path` attribute).  A new instance started
+    with the `--n6state-handoff` command line option:
+
+    1. connects to that socket and sends the PREPARE command (see:
+       begin_state_handoff() -- to be called in the new instance's
+       __init__() *before* loading the state); the old instance calls
+       prepare_state_handoff() (e.g., to stop overwriting its persisted
+       state and begin tracking changes) and replies OK -- but it still
+       keeps consuming;
+
+    2. loads the state (e.g., from the files persisted by the old
+       instance), connects to the AMQP broker, etc. -- and then, just
+       before it would start consuming, calls catch_up_state_handoff()
+       (e.g., to apply changes made by the old instance in the
+       meantime) and sends the HANDOFF command;
+
+    3. the old instance cancels its consumer and, when the broker
+       confirms that (so all messages delivered to it have been
+       processed), sends the result of get_state_handoff_delta() (all
+       changes not yet seen by the new instance) and shuts down;
+
+    4. the new instance calls apply_state_handoff_delta() and starts
+       consuming (and listening on the Unix socket).
+
+    If the new instance disconnects before sending HANDOFF, the old
+    one calls abort_state_handoff() and just continues its work.
+
+    The hook methods mentioned above need to be implemented in
+    subclasses.
+    """
+
+    # to be set in subclasses (typically, in __init__())
+    state_handoff_socket_path = None
+
+    # max time (in seconds) the new instance waits for each reply
+    STATE_HANDOFF_TIMEOUT = 600
+
+    # max time (in seconds) the old instance waits for the rest of a
+    # command line once its beginning has arrived (note: the commands
+    # are received within the IO loop, so it must be short; if it is
+    # exceeded, the state handoff is aborted)
+    STATE_HANDOFF_COMMAND_TIMEOUT = 5
+
+    # set to True (in the old instance) when the state has been handed off
+    state_handed_off = False
+
+    _PREPARE_COMMAND = 'PREPARE'
+    _HANDOFF_COMMAND = 'HANDOFF'
+    _OK_REPLY = 'OK'
+    _DELTA_SIZE_HEADER = struct.Struct('>Q')
+
+    _state_handoff_client_socket = None
+    _state_handoff_listening_socket = None
+    _state_handoff_connection = None
+    _state_handoff_prepared = False
+    _state_handoff_requested = False
+
+
+    def get_arg_parser(self):
+        arg_parser = super(StateHandoffMixin, self).get_arg_parser()
+        arg_parser.add_argument('--n6state-handoff',
+                                action='store_true',
+                                help=('take over the state from the running instance '
+                                      '(communicating with it via a Unix socket) '
+                                      'instead of just loading the persisted state'))
+        return arg_parser
+
+
+    #
+    # Hooks to be implemented in subclasses
+
+    def prepare_state_handoff(self):
+        """[Old instance] Called when a new instance sent PREPARE."""
+        raise NotImplementedError
+
+    def abort_state_handoff(self):
+        """[Old instance] Called when the new instance went away before HANDOFF."""
+        raise NotImplementedError
+
+    def get_state_handoff_delta(self):
+        """
+        [Old instance] Called when consuming has been cancelled. Should
+        return a picklable object to be passed to the new instance's
+        apply_state_handoff_delta(). The instance must not modify its
+        state after this call.
+        """
+        raise NotImplementedError
+
+    def catch_up_state_handoff(self):
+        """[New instance] Called just before sending HANDOFF (optional)."""
+
+    def apply_state_handoff_delta(self, delta):
+        """[New instance] Called with the delta received from the old instance."""
+        raise NotImplementedError
+
+
+    #
+    # New instance's side
+
+    @property
+    def state_handoff_pending(self):
+        """
+        True between begin_state_handoff() (if it actually began the
+        handoff) and receiving the delta from the old instance.
+        """
+        return self._state_handoff_client_socket is not None
+
+    def begin_state_handoff(self):
+        """
+        If the `--n6state-handoff` command line option has been given,
+        connect to the running instance and tell it to prepare for the
+        state handoff.
+
+        To be called in __init__() -- *before* loading the state.
+        """
+        if not getattr(self.cmdline_args, 'n6state_handoff', False):
+            return
+        LOGGER.info('Requesting state handoff via %r', self.state_handoff_socket_path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.STATE_HANDOFF_TIMEOUT)
+        try:
+            sock.connect(self.state_handoff_socket_path)
+            sock.sendall(self._PREPARE_COMMAND + '\n')
+            reply = _recv_exactly(sock, len(self._OK_REPLY) + 1)
+        except (socket.error, EOFError) as exc:
+            sock.close()
+            raise StateHandoffError('could not begin the state handoff '
+                                    '(is the old instance running?): {}'.format(exc))
+        if reply != self._OK_REPLY + '\n':
+            sock.close()
+            raise StateHandoffError('unexpected reply: {!r}'.format(reply))
+        self._state_handoff_client_socket = sock
+
+    def start_consuming(self):
+        self._complete_state_handoff()
+        self._start_state_handoff_server()
+        super(StateHandoffMixin, self).start_consuming()
+
+    def _complete_state_handoff(self):
+        sock = self._state_handoff_client_socket
+        if sock is None:
+            return
+        self._state_handoff_client_socket = None
+        try:
+            self.catch_up_state_handoff()
+            sock.sendall(self._HANDOFF_COMMAND + '\n')
+            header = _recv_exactly(sock, self._DELTA_SIZE_HEADER.size)
+            [delta_size] = self._DELTA_SIZE_HEADER.unpack(header)
+            delta = cPickle.loads(_recv_exactly(sock, delta_size))
+        except (socket.error, EOFError) as exc:
+            raise StateHandoffError('could not complete the state handoff: {}'.format(exc))
+        finally:
+            sock.close()
+        self.apply_state_handoff_delta(delta)
+        LOGGER.info('State handoff completed (delta size: %d bytes)', delta_size)
+
+
+    #
+    # Old instance's side
+
+    def _start_state_handoff_server(self):
+        path = self.state_handoff_socket_path
+        if path is None or self._state_handoff_listening_socket is not None:
+            return
+        if _is_unix_socket_listened_on(path):
+            LOGGER.warning('Another instance is listening on %r -- state handoff '
+                           'will not be possible for this instance', path)
+            return
+        try:
+            os.unlink(path)
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+        listening_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listening_socket.bind(path)
+        listening_socket.listen(1)
+        listening_socket.setblocking(False)
+        self._state_handoff_listening_socket = listening_socket
+        self._connection.ioloop.add_handler(listening_socket.fileno(),
+                                            self._on_state_handoff_connection,
+                                            READ)
+
+    def _on_state_handoff_connection(self, fileno, events, **kwargs):
+        try:
+            conn, _ = self._state_handoff_listening_socket.accept()
+        except socket.error as exc:
+            if exc.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        if self._state_handoff_connection is not None or self._closing:
+            LOGGER.warning('Rejecting a state handoff request (another one '
+                           'is in progress or the instance is closing)')
+            conn.close()
+            return
+        conn.settimeout(self.STATE_HANDOFF_COMMAND_TIMEOUT)
+        self._state_handoff_connection = conn
+        self._connection.ioloop.add_handler(conn.fileno(),
+                                            self._on_state_handoff_command,
+                                            READ)
+
+    def _on_state_handoff_command(self, fileno, events, **kwargs):
+        conn = self._state_handoff_connection
+        try:
+            command = _recv_line(conn, timeout=self.STATE_HANDOFF_COMMAND_TIMEOUT)
+        except (socket.error, EOFError):   # (note: socket.timeout is a subclass of socket.error)
+            command = None
+        if command == self._PREPARE_COMMAND and not self._state_handoff_prepared:
+            LOGGER.info('Preparing for state handoff')
+            self._state_handoff_prepared = True
+            self.prepare_state_handoff()
+            conn.sendall(self._OK_REPLY + '\n')
+        elif command == self._HANDOFF_COMMAND and self._state_handoff_prepared:
+            LOGGER.info('Handing off the state: cancelling the consumer...')
+            self._connection.ioloop.remove_handler(fileno)
+            self._state_handoff_requested = True
+            self.stop_consuming()
+        else:
+            self._connection.ioloop.remove_handler(fileno)
+            self._state_handoff_connection = None
+            conn.close()
+            if self._state_handoff_prepared:
+                LOGGER.warning('State handoff aborted (got: %r)', command)
+                self._state_handoff_prepared = False
+                self.abort_state_handoff()
+
+    def on_cancelok(self, unused_frame):
+        if self._state_handoff_requested:
+            self._send_state_handoff_delta()
+        super(StateHandoffMixin, self).on_cancelok(unused_frame)
+
+    def _send_state_handoff_delta(self):
+        conn = self._state_handoff_connection
+        self._state_handoff_connection = None
+        self._state_handoff_prepared = False
+        self._state_handoff_requested = False
+        self._closing = True
+        delta = cPickle.dumps(self.get_state_handoff_delta(), cPickle.HIGHEST_PROTOCOL)
+        try:
+            # (the instance is being closed anyway, so it can wait longer)
+            conn.settimeout(self.STATE_HANDOFF_TIMEOUT)
+            conn.sendall(self._DELTA_SIZE_HEADER.pack(len(delta)) + delta)
+        except socket.error as exc:
+            LOGGER.error('Could not send the state handoff delta (%s)', exc)
+            self.abort_state_handoff()
+        else:
+            self.state_handed_off = True
+            LOGGER.info('The state has been handed off')
+        finally:
+            conn.close()
+        self._close_state_handoff_listening_socket()
+
+    def _close_state_handoff_listening_socket(self):
+        listening_socket = self._state_handoff_listening_socket
+        if listening_socket is not None:
+            self._state_handoff_listening_socket = None
+            self._connection.ioloop.remove_handler(listening_socket.fileno())
+            listening_socket.close()
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise EOFError('connection closed by the peer')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+def _recv_line(sock, max_length=64, timeout=None):
+    deadline = (time.time() + timeout if timeout is not None else None)
+    chars = []
+    while len(chars) < max_length:
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise socket.timeout('timed out while receiving a line')
+            sock.settimeout(remaining)
+        char = _recv_exactly(sock, 1)
+        if char == '\n':
+            return ''.join(chars)
+        chars.append(char)
+    raise EOFError('line too long')
+
+
+def _is_unix_socket_listened_on(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        return False
+    else:
+        return True
+    finally:
+        sock.close()
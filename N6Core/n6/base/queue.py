@@ -11,8 +11,10 @@ import collections
 import contextlib
 import copy
 import functools
+import logging
 import pprint
 import re
+import select
 import sys
 import time
 import traceback
@@ -47,6 +49,20 @@ class n6AMQPCommunicationError(Exception):
     pass
 
 
+def _get_pika_connection_write_internals(connection):
+    """
+    Get the `(<outbound buffer>, <socket>, <handle-write function>)`
+    tuple for the given pika connection -- or None if the installed
+    version of pika is not the one these (non-public) pika connection
+    internals are known for (see: QueuedBase.limit_outbound_buffer()).
+    """
+    if not pika.__version__.startswith('0.10.'):
+        return None
+    return (connection.outbound_buffer,
+            connection.socket,
+            connection._handle_write)
+
+
 class QueuedBase(object):
 
     """
@@ -108,6 +124,12 @@ class QueuedBase(object):
     # accept --n6recovery argument option (see: the get_arg_parser() method)
     supports_n6recovery = True
 
+    # in a subclass, it can be set to True if the component deserializes
+    # its input using the record_dict_from_json() method -- then the
+    # component accepts the --n6trusted-input and --n6trusted-input-
+    # validation-rate argument options (see: the get_arg_parser() method)
+    supports_trusted_record_dict_input = False
+
     # it is set on a new instance by __new__() (which is called
     # automatically before __init__()) to an argparse.Namespace instance
     cmdline_args = None
@@ -125,6 +147,35 @@ class QueuedBase(object):
     # basic kwargs for pika.BasicProperties (message-publishing-related)
     basic_prop_kwargs = {'delivery_mode': 2}
 
+    # if true, the output channel is put into the AMQP transactional
+    # mode, and the messages published while handling an input message
+    # are committed (and then the input message is acked), or rolled
+    # back (and then the input message is nacked)
+    # (so that they are not delivered by the broker at all if an error
+    # occurs in the middle of handling an input message; see: the
+    # on_message() method); it can be set to True in subclasses
+    # [note: then `prefetch_count` is ignored -- the input messages
+    # are consumed one at a time; see: the on_bindok() method]
+    output_transactional = False
+
+    # When the size (in bytes) of the pika connection's outbound buffer
+    # reaches the value of this attribute (see: limit_outbound_buffer())
+    # the buffer is flushed synchronously.
+    outbound_buffer_size_limit = 4 * 2 ** 20   # (4 MiB)
+
+    # (the number of bytes of the message bodies published since the
+    # outbound buffer was found empty or its size was counted -- see:
+    # publish_output() and limit_outbound_buffer())
+    _outbound_buffer_byte_count = 0
+
+    # (set by limit_outbound_buffer() when it has given up flushing
+    # the outbound buffer; reset when the buffer is found empty)
+    _outbound_buffer_flushing_given_up = False
+
+    # (set when the broker has blocked the connection, e.g., because
+    # of its memory or disk alarm -- see: on_connection_blocked())
+    _connection_blocked = False
+
 
     #
     # Pre-init methods
@@ -251,7 +302,16 @@ class QueuedBase(object):
           *all* (input and output) AMQP exchange names and queue names
           (that is needed to perform data recovery from MongoDB...); to
           prevent this method from providing the "--n6recovery" option,
-          set the `supports_n6recovery` class attribute to False.
+          set the `supports_n6recovery` class attribute to False;
+
+        * if the `supports_trusted_record_dict_input` class attribute is
+          set to True -- the possibility to run the component with the
+          "--n6trusted-input" command line option (and, optionally,
+          with "--n6trusted-input-validation-rate ..."); that will cause
+          that the record_dict_from_json() method will skip adjusting
+          the values of messages marked by other n6 components as
+          containing ready record dicts (see: the `trusted` and
+          `validation_rate` arguments of RecordDict.from_json()).
         """
         arg_parser = N6ArgumentParser()
         arg_parser.add_argument('--n6input-suffix',
@@ -267,6 +327,19 @@ class QueuedBase(object):
                                     action='store_true',
                                     help=('add the "_recovery" suffix to '
                                           'all AMQP exchange/queue names'))
+        if self.supports_trusted_record_dict_input:
+            arg_parser.add_argument('--n6trusted-input',
+                                    action='store_true',
+                                    help=('do not re-adjust the values of input '
+                                          'record dicts marked as produced by '
+                                          'other n6 components'))
+            arg_parser.add_argument('--n6trusted-input-validation-rate',
+                                    metavar='RATE',
+                                    type=float,
+                                    default=0.0,
+                                    help=('the fraction (from 0.0 to 1.0) of such '
+                                          'record dicts that are re-adjusted after '
+                                          'all, to detect any discrepancies'))
         return arg_parser
 
     def preinit_hook(self):
@@ -492,9 +565,37 @@ class QueuedBase(object):
             `connection`: pika.SelectConnection instance
         """
         LOGGER.info('Connection opened')
+        self._connection_blocked = False
         self._connection.add_on_close_callback(self.on_connection_closed)
+        self._connection.add_on_connection_blocked_callback(self.on_connection_blocked)
+        self._connection.add_on_connection_unblocked_callback(self.on_connection_unblocked)
         self.open_channels()
 
+    def on_connection_blocked(self, method_frame):
+        """
+        Invoked by pika when RabbitMQ has sent the Connection.Blocked
+        method frame, i.e., has stopped reading from the connection
+        (typically, because of its memory or disk alarm).
+
+        Args:
+            `method_frame`: The Connection.Blocked method frame.
+        """
+        LOGGER.warning('Connection blocked by RabbitMQ (reason: %r)',
+                       getattr(method_frame.method, 'reason', None))
+        self._connection_blocked = True
+
+    def on_connection_unblocked(self, method_frame):
+        """
+        Invoked by pika when RabbitMQ has sent the Connection.Unblocked
+        method frame.
+
+        Args:
+            `method_frame`: The Connection.Unblocked method frame.
+        """
+        LOGGER.info('Connection unblocked by RabbitMQ')
+        self._connection_blocked = False
+        self._outbound_buffer_flushing_given_up = False
+
     def on_connection_closed(self, connection, reply_code, reply_text):
         """
         From pika docs:
@@ -592,6 +693,9 @@ class QueuedBase(object):
         self._channel_out = channel
         self._channel_out.add_on_close_callback(self.on_channel_closed)
         self._declared_output_exchanges.clear()
+        if self.output_transactional:
+            LOGGER.debug('Selecting the transactional mode for the output channel')
+            self._channel_out.tx_select()
         self.setup_output_exchanges()
 
     def on_channel_closed(self, channel, reply_code, reply_text):
@@ -763,7 +867,18 @@ class QueuedBase(object):
         if self._num_queues_bound == len(self.input_queue["binding_keys"]) + 1:
             LOGGER.debug('All queues bound (including the dead-letter queue)')
             LOGGER.debug('Setting prefetch count')
-            self._channel_in.basic_qos(prefetch_count=self.prefetch_count)
+            if self.output_transactional:
+                # The next input message must not be delivered before
+                # the broker has confirmed the commit/rollback of the
+                # output of the previous one (as pika sends published
+                # messages immediately, whereas Tx.Commit/Rollback wait
+                # until any previous RPC on the channel is finished, so
+                # the next message's output could be committed/rolled
+                # back together with the previous message's output).
+                prefetch_count = 1
+            else:
+                prefetch_count = self.prefetch_count
+            self._channel_in.basic_qos(prefetch_count=prefetch_count)
             self.start_consuming()
             self.complete_input_setup()
 
@@ -910,7 +1025,14 @@ class QueuedBase(object):
                          '#%r:\nrouting key: %r\nproperties: %r',
                          delivery_tag, routing_key, properties)
             LOGGER.debug('Body of message #%r:\n%r', delivery_tag, body)
-            self.nacknowledge_message(delivery_tag, '{0!r} in {1!r}'.format(type(exc), self))
+            reason = '{0!r} in {1!r}'.format(type(exc), self)
+            if self.output_transactional and self._is_output_channel_open():
+                # (the rollback is asynchronous, so the input message is
+                # nacked only when the broker has confirmed it)
+                self.rollback_output(callback=functools.partial(
+                    self._on_output_rolled_back, channel, delivery_tag, reason))
+            else:
+                self.nacknowledge_message(delivery_tag, reason)
         except:
             # we do want to nack and requeue event on SystemExit, KeyboardInterrupt etc.
             exc_info = sys.exc_info()
@@ -918,15 +1040,112 @@ class QueuedBase(object):
                         'The message will be requeued...',
                         exc_info[1],
                         delivery_tag)
+            self.rollback_output()
             self.nacknowledge_message(delivery_tag, '{0!r} in {1!r}'.format(exc_info[1], self),
                                       requeue=True)
             # now we can re-raise the original exception
             raise exc_info[0], exc_info[1], exc_info[2]
         else:
-            self.acknowledge_message(delivery_tag)
+            if not self.output_transactional:
+                self.acknowledge_message(delivery_tag)
+            elif self._is_output_channel_open():
+                # (the commit is asynchronous, so the input message is
+                # acked only when the broker has confirmed it)
+                self.commit_output(callback=functools.partial(
+                    self._on_output_committed, channel, delivery_tag))
+            else:
+                # (the uncommitted messages have been discarded together
+                # with the output channel, so the input message needs
+                # to be handled again)
+                LOGGER.warning('Output channel closed before committing the '
+                               'messages published while handling message #%r. '
+                               'The message will be requeued...', delivery_tag)
+                self.nacknowledge_message(delivery_tag, 'output channel closed',
+                                          requeue=True)
         finally:
             del exc_info
 
+    def _on_output_committed(self, channel, delivery_tag, method_frame):
+        # (the delivery tag is valid only for the channel the message
+        # has been received from)
+        if channel is self._channel_in and channel.is_open:
+            self.acknowledge_message(delivery_tag)
+        else:
+            LOGGER.warning('Input channel closed before acking message #%r '
+                           '(it will be redelivered by the broker)', delivery_tag)
+
+    def _on_output_rolled_back(self, channel, delivery_tag, reason, method_frame):
+        if channel is self._channel_in and channel.is_open:
+            self.nacknowledge_message(delivery_tag, reason)
+        else:
+            LOGGER.warning('Input channel closed before nacking message #%r '
+                           '(it will be redelivered by the broker)', delivery_tag)
+
+    def commit_output(self, callback=None):
+        """
+        If `output_transactional` is true: commit the messages published
+        since the previous commit/rollback (typically, while handling an
+        input message; see: on_message()).
+
+        Kwargs:
+            `callback` (optional):
+                To be called (with the Tx.CommitOk method frame as the
+                argument) when the broker has confirmed the commit.
+        """
+        if self.output_transactional and self._is_output_channel_open():
+            self._channel_out.tx_commit(callback)
+
+    def rollback_output(self, callback=None):
+        """
+        If `output_transactional` is true: roll back (i.e., discard) the
+        messages published since the previous commit/rollback.
+
+        Kwargs:
+            `callback` (optional):
+                To be called (with the Tx.RollbackOk method frame as the
+                argument) when the broker has confirmed the rollback.
+        """
+        if self.output_transactional and self._is_output_channel_open():
+            LOGGER.warning('Rolling back the messages published while '
+                           'handling the current input message')
+            self._channel_out.tx_rollback(callback)
+
+    def _is_output_channel_open(self):
+        return self._channel_out is not None and self._channel_out.is_open
+
+    def record_dict_from_json(self, record_dict_class, body, properties, **kwargs):
+        """
+        Deserialize a record dict from the body of an input message.
+
+        Args:
+            `record_dict_class`:
+                n6lib.record_dict.RecordDict or its subclass.
+            `body`:
+                The AMQP message body (a JSON string).
+            `properties`:
+                A pika.BasicProperties instance (or None).
+
+        Kwargs:
+            Passed to `record_dict_class.from_json()`.
+
+        If the "--n6trusted-input" command line option has been given
+        (see: get_arg_parser()) and the message has been marked (with
+        the `record_dict_class.TRUSTED_JSON_HEADER` header, see: the
+        `basic_prop_kwargs` attribute of the producing components) as
+        containing a ready record dict, the record dict's values are not
+        re-adjusted (see: RecordDict.from_json()).
+        """
+        trusted = (getattr(self.cmdline_args, 'n6trusted_input', False) and
+                   properties is not None and
+                   properties.headers is not None and
+                   properties.headers.get(record_dict_class.TRUSTED_JSON_HEADER) ==
+                   record_dict_class.TRUSTED_JSON_VERSION)
+        if trusted:
+            kwargs.update(
+                trusted=True,
+                validation_rate=self.cmdline_args.n6trusted_input_validation_rate)
+        return record_dict_class.from_json(body, **kwargs)
+
     def input_callback(self, routing_key, body, properties):
         """
         Placeholder for input_callback defined by child classes.
@@ -1052,7 +1271,8 @@ class QueuedBase(object):
         are ready.  Publishers should override this method.
         """
 
-    def publish_output(self, routing_key, body, prop_kwargs=None, exchange=None):
+    def publish_output(self, routing_key, body, prop_kwargs=None, exchange=None,
+                       properties=None):
         """
         Publish to the (default or specified) output exchange.
 
@@ -1067,6 +1287,11 @@ class QueuedBase(object):
                 The exchange name.  If omitted, the 'exchange' value of
                 the first item of the `output_queue` instance attribute
                 will be used.
+            `properties` (optional):
+                A ready pika.BasicProperties instance, typically made
+                (once, to be reused for many messages) with the
+                make_output_properties() method.  It cannot be specified
+                together with `prop_kwargs`.
         """
         if self._closing:
             # CRITICAL because for a long time (since 2013-04-26!) there was a silent return here!
@@ -1082,19 +1307,16 @@ class QueuedBase(object):
         if exchange not in self._declared_output_exchanges:
             raise RuntimeError('exchange {0!r} has not been declared'.format(exchange))
 
-        kwargs_for_properties = self.basic_prop_kwargs.copy()
-        if prop_kwargs is not None:
-            kwargs_for_properties.update(prop_kwargs)
-        if 'headers' in kwargs_for_properties and (
-              not kwargs_for_properties['headers']):
-            # delete empty `headers` dict
-            del kwargs_for_properties['headers']
-        properties = pika.BasicProperties(**kwargs_for_properties)
+        if properties is None:
+            properties = self.make_output_properties(prop_kwargs)
+        elif prop_kwargs is not None:
+            raise TypeError('`prop_kwargs` and `properties` cannot be specified together')
 
         self.basic_publish(exchange=exchange,
                            routing_key=routing_key,
                            body=body,
                            properties=properties)
+        self._outbound_buffer_byte_count += len(body)
 
         # basic_publish() might trigger the on_connection_closed() callback
         if self._closing or not self.output_ready:
@@ -1106,6 +1328,96 @@ class QueuedBase(object):
                 '(routing key: {2!r}, body length: {3})'.format(
                     self._closing, self.output_ready, routing_key, len(body)))
 
+    def make_output_properties(self, prop_kwargs=None):
+        """
+        Make a pika.BasicProperties instance for output messages.
+
+        Args:
+            `prop_kwargs` (optional):
+                Custom keyword arguments for pika.BasicProperties
+                (they override those from the `basic_prop_kwargs`
+                attribute).
+
+        Note: the resultant object can be passed (and reused many
+        times) as the `properties` argument of publish_output().
+        """
+        kwargs_for_properties = self.basic_prop_kwargs.copy()
+        if prop_kwargs is not None:
+            kwargs_for_properties.update(prop_kwargs)
+        if 'headers' in kwargs_for_properties and (
+              not kwargs_for_properties['headers']):
+            # delete empty `headers` dict
+            del kwargs_for_properties['headers']
+        return pika.BasicProperties(**kwargs_for_properties)
+
+    def limit_outbound_buffer(self):
+        """
+        Flush the pika connection's outbound buffer synchronously if its
+        size (in bytes) has reached `outbound_buffer_size_limit`.
+
+        To be called after publish_output() by code that publishes
+        many messages without giving the control back to the pika
+        connection's IO loop (e.g., in an input_callback()) -- so that
+        the buffer does not grow without limit when the messages are
+        produced faster than they can be sent.
+
+        The IO loop is not starved longer than the time returned by
+        _get_yield_time_interval_threshold(): then the flushing is given
+        up, and it is *not* attempted again until the buffer is found
+        empty (i.e., flushed by the IO loop) or the broker unblocks the
+        connection. The flushing is not attempted at all while the
+        connection is blocked by the broker (see: the Connection.Blocked
+        AMQP extension and on_connection_blocked()).
+
+        **Beware:** in these cases (i.e., when the broker does not read
+        the data, typically because of its memory or disk alarm) the
+        buffer is *not* limited -- it grows until the data published so
+        far is sent by the IO loop; we prefer that to stalling on each
+        further `outbound_buffer_size_limit` bytes.
+
+        Note: this method relies on pika's non-public connection
+        internals; with a version of pika other than 0.10.x it does
+        nothing (see: _get_pika_connection_write_internals()).
+        """
+        connection = self._connection
+        write_internals = _get_pika_connection_write_internals(connection)
+        if write_internals is None:
+            return
+        outbound_buffer, sock, handle_write = write_internals
+        if not outbound_buffer:
+            self._outbound_buffer_byte_count = 0
+            self._outbound_buffer_flushing_given_up = False
+            return
+        if self._outbound_buffer_flushing_given_up or self._connection_blocked:
+            return
+        if self._outbound_buffer_byte_count < self.outbound_buffer_size_limit:
+            return
+        # (the count is just an estimate -- as, e.g., the frame headers
+        # are not included -- so now the actual size is determined)
+        self._outbound_buffer_byte_count = sum(len(frame) for frame in outbound_buffer)
+        if self._outbound_buffer_byte_count < self.outbound_buffer_size_limit:
+            return
+        LOGGER.debug("Flushing pika's outbound buffer synchronously")
+        deadline = time.time() + self._get_yield_time_interval_threshold()
+        while outbound_buffer:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                LOGGER.warning(
+                    "Could not flush pika's outbound buffer synchronously "
+                    "(%d frames remain) -- giving up (until the buffer is "
+                    "flushed by the IO loop), not to block the connection's "
+                    "IO loop any longer", len(outbound_buffer))
+                self._outbound_buffer_flushing_given_up = True
+                break
+            _, writable, _ = select.select([], [sock], [], timeout)
+            if writable:
+                handle_write()
+            if self._closing or not self.output_ready or connection.is_closed:
+                raise n6AMQPCommunicationError(
+                    'AMQP communication is no longer possible while '
+                    'flushing the outbound buffer')
+        self._outbound_buffer_byte_count = 0
+
     def basic_publish(self, exchange, routing_key, body, properties):
         """
         Thin wrapper around pika's basic_publish -- for easier testing/mocking.
@@ -1113,12 +1425,14 @@ class QueuedBase(object):
         Typically it is *not* used directly but only by calling the
         publish_output() method.
         """
-        LOGGER.debug('Publishing message to %r, rk: %r\n'
-                     'Properties: %s\nBody: %r',
-                     exchange,
-                     routing_key,
-                     ascii_str(pprint.pformat(properties)),
-                     body)
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            # (checking it explicitly, as pformat() is quite expensive)
+            LOGGER.debug('Publishing message to %r, rk: %r\n'
+                         'Properties: %s\nBody: %r',
+                         exchange,
+                         routing_key,
+                         ascii_str(pprint.pformat(properties)),
+                         body)
         self._channel_out.basic_publish(exchange=exchange,
                                         routing_key=routing_key,
                                         body=body,
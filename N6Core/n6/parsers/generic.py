@@ -57,6 +57,12 @@ class BaseParser(ConfigMixin, QueuedBase):
         "exchange_type": "topic",
     }
 
+    # the output messages are marked as containing ready record dicts
+    # (see: QueuedBase.record_dict_from_json())
+    basic_prop_kwargs = dict(
+        QueuedBase.basic_prop_kwargs,
+        headers={RecordDict.TRUSTED_JSON_HEADER: RecordDict.TRUSTED_JSON_VERSION})
+
     # a string
     #    '<source label>.<source channel>'
     # or '<source label>.<source channel>.<raw format version tag>'
@@ -100,10 +106,32 @@ class BaseParser(ConfigMixin, QueuedBase):
     # (see: get_output_bodies())
     allow_empty_results = False
 
+    # whether the output messages should be published as soon as the
+    # consecutive records are parsed and postprocessed (see:
+    # iter_output_bodies()) instead of collecting all of them first
+    # (see: get_output_bodies()); if true, the output channel is used
+    # in the AMQP transactional mode, so that if an error occurs in
+    # the middle of parsing, the messages that have already been
+    # published are discarded (see: QueuedBase.on_message()); note
+    # that in this mode the `total` argument of postprocess_parsed()
+    # is None, so this mode cannot be used for black list parsers
+    stream_output = False
+
+    # (data, record dict kwargs, template record dict) -- the record
+    # dict template for the currently parsed input data (see:
+    # new_record_dict(); it is cleared by input_callback())
+    _record_dict_template_cache = None
+
 
     @attr_required('default_binding_key')
     def __init__(self, **kwargs):
         assert self.event_type in ('event', 'bl', 'hifreq')
+        if self.stream_output:
+            if self.event_type == 'bl':
+                raise TypeError('The `stream_output` class attribute cannot be set for '
+                                'black list parsers (each black list event needs to '
+                                'include the total number of the events)')
+            self.output_transactional = True
         super(BaseParser, self).__init__(**kwargs)
         self.set_configuration()
         # the attribute is overridden in order to supply each parser
@@ -221,8 +249,10 @@ class BaseParser(ConfigMixin, QueuedBase):
 
         * prepare_data(),
         * get_output_rk(),
-        * get_output_bodies(),
-        * and for each item of the sequence returned by get_output_bodies():
+        * get_output_bodies() (or, if `stream_output` is true,
+          iter_output_bodies()),
+        * and for each item of the sequence returned by get_output_bodies()
+          (or of the iterator returned by iter_output_bodies()):
           * publish_output() (this one is defined in a superclass --
             typically it is QueuedBase.publish_output()).
 
@@ -232,11 +262,21 @@ class BaseParser(ConfigMixin, QueuedBase):
         body = self._fix_body(body)
         data = self.prepare_data(routing_key, body, properties)
         rid = data.get('properties.message_id')
-        with self.setting_error_event_info(rid):
-            output_rk = self.get_output_rk(data)
-            with FilePagedSequence(page_size=1000) as working_seq:
-                for output_body in self.get_output_bodies(data, working_seq):
-                    self.publish_output(routing_key=output_rk, body=output_body)
+        try:
+            with self.setting_error_event_info(rid):
+                output_rk = self.get_output_rk(data)
+                if self.stream_output:
+                    for output_body in self.iter_output_bodies(data):
+                        self.publish_output(routing_key=output_rk, body=output_body)
+                        self.limit_outbound_buffer()
+                    return
+                with FilePagedSequence(page_size=1000) as working_seq:
+                    for output_body in self.get_output_bodies(data, working_seq):
+                        self.publish_output(routing_key=output_rk, body=output_body)
+        finally:
+            # (not to keep `data` -- including the raw body -- alive
+            # until the next input message; see: new_record_dict())
+            self._record_dict_template_cache = None
 
     @staticmethod
     def _fix_body(body):
@@ -368,6 +408,49 @@ class BaseParser(ConfigMixin, QueuedBase):
         # publishing in the midst by a data error
         return working_seq
 
+    def iter_output_bodies(self, data):
+        """
+        Process given data, generating serialized events one by one.
+
+        Args:
+            `data` (dict):
+                As returned by prepare_data() (especially, its 'raw' item
+                contains the raw data body).
+
+        Yields:
+            Strings, each being JSON-serialized event data dict.
+
+        This method is used instead of get_output_bodies() if the
+        `stream_output` attribute is true.  It does the same, except
+        that each record dict yielded by parse() is postprocessed and
+        serialized immediately (so `None` is passed to postprocess_parsed()
+        as the `total` argument), and that an error concerning any record
+        (or the lack of records) is raised when some of the preceding
+        serialized events may have already been published.
+
+        Typically, this method is used indirectly -- being called in
+        input_callback().
+        """
+        item_no = 0
+        for parsed in self.parse(data):
+            assert isinstance(parsed, RecordDict)
+            if not parsed.used_as_context_manager:
+                raise AssertionError('record dict yielded in a parser must be '
+                                     'treated with a "with ..." statement!')
+            parsed["id"] = self.get_output_message_id(parsed)
+            self.delete_too_long_address(parsed)
+            item_no += 1
+            with self.setting_error_event_info(parsed):
+                parsed = self.postprocess_parsed(data, parsed, None,
+                                                 item_no=item_no)
+                output_body = parsed.get_ready_json()
+            yield output_body
+        if not item_no and not self.allow_empty_results:
+            raise ValueError('no output data to publish; either all data '
+                             'items caused AdjusterError (you can look '
+                             'for apropriate warnings in logs) or input '
+                             'data contained no actual data items')
+
     def delete_too_long_address(self, parsed):
         _address = parsed.get('address')
         if _address and len(_address) > MAX_IPS_IN_ADDRESS:
@@ -469,21 +552,41 @@ class BaseParser(ConfigMixin, QueuedBase):
             passed in automatically.
 
         Returns:
-            A new RecordDict instance, populated by calling set_basic_items()
-            on it.
+            A new RecordDict instance, populated with the items set by
+            set_basic_items().
 
         This method is intended to be called in the parse() method to create
         new record dicts.
+
+        Note: set_basic_items() is called only once per `data` (i.e.,
+        per input message) -- on a "template" record dict -- and then
+        each new record dict is derived from that template (see:
+        RecordDict.derive()), so that the values of the basic items
+        do not need to be passed through the adjusters again and
+        again.  Therefore, set_basic_items() implementations should
+        depend only on `data` (and it should not be modified in
+        parse()).
         """
         if self.record_dict_kwargs is not None:
             record_dict_kwargs = dict(self.record_dict_kwargs,
                                       **record_dict_kwargs)
-        record_dict = self.record_dict_class(
+        record_dict_kwargs = dict(
+            record_dict_kwargs,
             log_nonstandard_names=True,
-            context_manager_error_callback=self.handle_parse_error,
-            **record_dict_kwargs)
-        self.set_basic_items(record_dict, data)
-        return record_dict
+            context_manager_error_callback=self.handle_parse_error)
+        template = self._get_record_dict_template(data, record_dict_kwargs)
+        return template.derive(**record_dict_kwargs)
+
+    def _get_record_dict_template(self, data, record_dict_kwargs):
+        cached = self._record_dict_template_cache
+        if (cached is not None and
+              cached[0] is data and
+              cached[1] == record_dict_kwargs):
+            return cached[2]
+        template = self.record_dict_class(**record_dict_kwargs)
+        self.set_basic_items(template, data)
+        self._record_dict_template_cache = data, record_dict_kwargs, template
+        return template
 
     @staticmethod
     @picklable
@@ -580,17 +683,69 @@ class BaseParser(ConfigMixin, QueuedBase):
         # method does call: after any code changes it should generate
         # the same ids for already stored data!  (That's why this code
         # may already seem to be weird a bit...)
+        # [Note: the fast paths of the _serialize_*_for_output_id()
+        # methods handle only values of the exact types they check for
+        # -- for any other values they fall back to the original
+        # _prepare_for_deterministic_serialization() logic; the results
+        # are verified against the original implementation of this
+        # method (kept in the tests) on a large corpus of records.]
         assert isinstance(parsed, RecordDict)
+        serialize_value = self._serialize_value_for_output_id
         serialized = []
         for k, v in sorted(self.iter_output_id_base_items(parsed)):
-            if isinstance(v, (list, tuple)):
-                v = ('{}'.format(self._prepare_for_deterministic_serialization(el))
-                     for el in v)
-                v = ','.join(sorted(v))
-            v = self._prepare_for_deterministic_serialization(v)
-            serialized.append("{},{}".format(k, v))
+            v_type = type(v)
+            if v_type is unicode:
+                v = v.encode('utf-8')
+            elif v_type is not str:
+                v = serialize_value(v)
+            if type(k) is str and type(v) is str:
+                serialized.append(k + ',' + v)
+            else:
+                serialized.append("{},{}".format(k, v))
         return hashlib.md5("\n".join(serialized)).hexdigest()
 
+    def _serialize_value_for_output_id(self, value):
+        value_type = type(value)
+        if value_type is str:
+            return value
+        if value_type is unicode:
+            return value.encode('utf-8')
+        if isinstance(value, (list, tuple)):
+            serialize_element = self._serialize_element_for_output_id
+            return ','.join(sorted([serialize_element(el) for el in value]))
+        if value_type is dict:
+            return self._serialize_dict_for_output_id(value)
+        return self._prepare_for_deterministic_serialization(value)
+
+    def _serialize_element_for_output_id(self, el):
+        el_type = type(el)
+        if el_type is str:
+            return el
+        if el_type is dict:
+            return self._serialize_dict_for_output_id(el)
+        if el_type is unicode:
+            return el.encode('utf-8')
+        return '{}'.format(self._prepare_for_deterministic_serialization(el))
+
+    def _serialize_dict_for_output_id(self, value):
+        item_reprs = {}
+        for k, v in value.iteritems():
+            k_type = type(k)
+            if k_type is unicode:
+                k = k.encode('utf-8')
+            elif k_type is not str:
+                return self._prepare_for_deterministic_serialization(value)
+            v_type = type(v)
+            if v_type is str or v_type is int:
+                v = repr(v)
+            elif v_type is unicode:
+                v = repr(v.encode('utf-8'))
+            else:
+                return self._prepare_for_deterministic_serialization(value)
+            item_reprs[repr(k)] = v
+        return '{%s}' % ', '.join([k + ': ' + v
+                                   for k, v in sorted(item_reprs.iteritems())])
+
     def _prepare_for_deterministic_serialization(self, value):
         VALUE_TYPES = str, int, long
         if isinstance(value, dict):
@@ -658,8 +813,10 @@ class BaseParser(ConfigMixin, QueuedBase):
                 As returned by prepare_data().
             `parsed` (RecordDict instance):
                 The parsed event data (a RecordDict instance).
-            `total` (int):
-                Total number of parsed events (within latest parse() call).
+            `total` (int or None):
+                Total number of parsed events (within latest parse() call),
+                or None if `stream_output` is true (then the number is not
+                known yet).
             `item_no` (int):
                 The number of this parsed event (within latest parse() call).
 
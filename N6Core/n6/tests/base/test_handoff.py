@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013-2019 NASK. All rights reserved.
+
+import os.path
+import select
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+from mock import MagicMock
+
+from n6.base.handoff import StateHandoffError
+from n6.base.queue import n6QueueProcessingException
+from n6.utils.aggregator import (
+    Aggregator,
+    AggregatorDataWrapper,
+)
+from n6.utils.comparator import (
+    Comparator,
+    ComparatorDataWrapper,
+    ComparatorState,
+)
+from n6lib.common_helpers import SimpleNamespace
+
+
+class _FakeIOLoop(object):
+
+    def __init__(self):
+        self.fd_to_handler = {}
+
+    def add_handler(self, fileno, handler, events):
+        self.fd_to_handler[fileno] = handler
+
+    def remove_handler(self, fileno):
+        del self.fd_to_handler[fileno]
+
+    def poll(self, timeout=0.05):
+        readable, _, _ = select.select(list(self.fd_to_handler), [], [], timeout)
+        for fileno in readable:
+            handler = self.fd_to_handler.get(fileno)
+            if handler is not None:
+                handler(fileno, 1)
+
+
+class _StateHandoffTestMixin(object):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.dbpath = os.path.join(self.tmp_dir, 'db.pickle')
+        self.old = self.make_instance(n6state_handoff=False)
+        self.old._start_state_handoff_server()
+
+    def make_instance(self, n6state_handoff):
+        instance = self.component_class.__new__(self.component_class)
+        instance.cmdline_args = SimpleNamespace(n6state_handoff=n6state_handoff)
+        instance.state_handoff_socket_path = self.dbpath + '.handoff.sock'
+        instance._connection = MagicMock()
+        instance._connection.ioloop = _FakeIOLoop()
+        instance._channel_in = MagicMock()
+        instance._closing = False
+        instance.publish_output = MagicMock()
+        # (cancelling the consumer is confirmed immediately)
+        instance.stop_consuming = lambda: instance.on_cancelok(None)
+        return instance
+
+    def run_new_instance_in_thread(self, target):
+        result = {}
+        def run():
+            try:
+                result['new'] = target()
+            except Exception as exc:
+                result['exc'] = exc
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread, result
+
+    def pump_old_instance_until(self, condition, timeout=10):
+        for _ in xrange(int(timeout / 0.05)):
+            if condition():
+                return
+            self.old._connection.ioloop.poll()
+        self.fail('timeout')
+
+
+class TestAggregatorStateHandoff(_StateHandoffTestMixin, unittest.TestCase):
+
+    component_class = Aggregator
+
+    def make_instance(self, n6state_handoff):
+        instance = super(TestAggregatorStateHandoff, self).make_instance(n6state_handoff)
+        instance.timeout_id = None
+        instance.begin_state_handoff()
+        instance.db = AggregatorDataWrapper(self.dbpath, 600,
+                                            state_log_max_records=5,
+                                            state_log_shared=instance.state_handoff_pending)
+        return instance
+
+    def process(self, instance, first, last):
+        for i in xrange(first, last):
+            data = {
+                'id': '{:032x}'.format(i),
+                'source': 'testsource.channel{}'.format(i % 3),
+                '_group': 'group{}'.format(i % 7),
+                'time': '2017-06-01 {:02}:00:00'.format(i // 4),
+            }
+            try:
+                instance.process_event(data)
+            except n6QueueProcessingException:
+                pass
+
+    @staticmethod
+    def get_state(instance):
+        def hifreq_items(hifreq_data_dict):
+            return [(key, v.payload, v.first, v.until, v.count)
+                    for key, v in hifreq_data_dict.iteritems()]
+        return {
+            source: (sd.time, hifreq_items(sd.groups), hifreq_items(sd.buffer))
+            for source, sd in instance.db.aggr_data.sources.iteritems()}
+
+    def test_state_handoff(self):
+        self.process(self.old, 0, 20)
+        new_loaded = threading.Event()
+        handoff_requested = threading.Event()
+        def run_new_instance():
+            new = self.make_instance(n6state_handoff=True)
+            new_loaded.set()
+            handoff_requested.wait()
+            new.start_consuming = lambda: None   # (not relevant here)
+            new._complete_state_handoff()
+            return new
+        thread, result = self.run_new_instance_in_thread(run_new_instance)
+        self.pump_old_instance_until(lambda: new_loaded.is_set())
+        self.assertTrue(self.old.db.snapshots_suspended)
+        # the old instance keeps working while the new one has
+        # already loaded the state (note: the snapshot is not
+        # stored, even though `state_log_max_records` is exceeded)
+        self.process(self.old, 20, 40)
+        self.assertGreater(self.old.db.state_log.record_count, 5)
+        handoff_requested.set()
+        self.pump_old_instance_until(lambda: not thread.is_alive())
+        thread.join()
+        self.assertNotIn('exc', result)
+        new = result['new']
+        self.assertTrue(self.old.state_handed_off)
+        self.assertTrue(self.old._closing)
+        self.assertEqual(self.get_state(new), self.get_state(self.old))
+        self.assertEqual(new.db.aggr_data.state_log_seq, self.old.db.aggr_data.state_log_seq)
+        self.assertFalse(new.db.state_log_shared)
+        # the new instance continues the state log
+        self.process(new, 40, 60)
+        expected_state = self.get_state(new)
+        restarted = self.make_instance(n6state_handoff=False)
+        self.assertEqual(self.get_state(restarted), expected_state)
+
+    def test_state_handoff_aborted(self):
+        self.process(self.old, 0, 20)
+        def run_new_instance():
+            new = self.make_instance(n6state_handoff=True)
+            new._state_handoff_client_socket.close()
+        thread, result = self.run_new_instance_in_thread(run_new_instance)
+        self.pump_old_instance_until(lambda: not thread.is_alive())
+        self.pump_old_instance_until(lambda: self.old._state_handoff_connection is None)
+        self.assertFalse(self.old.state_handed_off)
+        self.assertFalse(self.old.db.snapshots_suspended)
+        self.process(self.old, 20, 40)
+        self.assertLess(self.old.db.state_log.record_count, 5)
+
+    def _connect_to_old_instance(self):
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(client.close)
+        client.settimeout(10)
+        client.connect(self.dbpath + '.handoff.sock')
+        self.pump_old_instance_until(lambda: self.old._state_handoff_connection is not None)
+        return client
+
+    def test_incomplete_command_does_not_block_old_instance(self):
+        self.old.STATE_HANDOFF_COMMAND_TIMEOUT = 0.2
+        client = self._connect_to_old_instance()
+        client.sendall('PREP')
+        start = time.time()
+        self.pump_old_instance_until(lambda: self.old._state_handoff_connection is None)
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(client.recv(1), '')   # (closed by the old instance)
+        self.assertFalse(self.old.db.snapshots_suspended)
+
+    def test_incomplete_command_after_prepare_aborts_state_handoff(self):
+        self.old.STATE_HANDOFF_COMMAND_TIMEOUT = 0.2
+        client = self._connect_to_old_instance()
+        client.sendall('PREPARE\n')
+        self.pump_old_instance_until(lambda: self.old.db.snapshots_suspended)
+        self.assertEqual(client.recv(3), 'OK\n')
+        client.sendall('HAND')
+        self.pump_old_instance_until(lambda: self.old._state_handoff_connection is None)
+        self.assertFalse(self.old.db.snapshots_suspended)
+        self.assertFalse(self.old.state_handed_off)
+        self.assertFalse(self.old._closing)
+
+    def test_no_old_instance(self):
+        self.old._close_state_handoff_listening_socket()
+        with self.assertRaises(StateHandoffError):
+            self.make_instance(n6state_handoff=True)
+
+
+class TestComparatorStateHandoff(_StateHandoffTestMixin, unittest.TestCase):
+
+    component_class = Comparator
+
+    def make_instance(self, n6state_handoff):
+        instance = super(TestComparatorStateHandoff, self).make_instance(n6state_handoff)
+        instance.comparator_config = {'series_timeout': 100}
+        instance.state = ComparatorState(100)
+        instance.begin_state_handoff()
+        instance.db = ComparatorDataWrapper(self.dbpath)
+        instance.start_publishing()
+        return instance
+
+    def process_series(self, instance, source, series_id, ips, total=None):
+        for i, ip in enumerate(ips, 1):
+            instance._process_input({
+                '_bl-time': '2017-01-19 12:{:02}:00'.format(int(series_id)),
+                '_bl-series-total': total or len(ips),
+                '_bl-series-no': i,
+                '_bl-series-id': series_id,
+                'expires': '2017-01-20 15:15:15',
+                'address': [{'ip': ip}],
+                'source': source,
+                'id': '{:030}{:02}'.format(int(series_id), i),
+            })
+
+    @staticmethod
+    def get_state(instance, source_names):
+        def get_source_state(sd):
+            return (sd.time, sd.flags, {key: (bl.payload, bl.expires)
+                                        for key, bl in sd.blacklist.iteritems()})
+        return {name: get_source_state(instance.db.get_sourcedata(name))
+                for name in source_names}
+
+    def test_state_handoff(self):
+        self.process_series(self.old, 'source1.channel', '01', ['1.1.1.1', '2.2.2.2'])
+        self.process_series(self.old, 'source2.channel', '02', ['3.3.3.3'])
+        # (an incomplete series, so the source is not stored)
+        self.process_series(self.old, 'source4.channel', '05', ['8.8.8.8'], total=2)
+        new_loaded = threading.Event()
+        handoff_requested = threading.Event()
+        def run_new_instance():
+            new = self.make_instance(n6state_handoff=True)
+            new_loaded.set()
+            handoff_requested.wait()
+            new._complete_state_handoff()
+            return new
+        thread, result = self.run_new_instance_in_thread(run_new_instance)
+        self.pump_old_instance_until(lambda: new_loaded.is_set())
+        self.process_series(self.old, 'source1.channel', '03', ['1.1.1.1', '4.4.4.4'])
+        # (an incomplete series)
+        self.process_series(self.old, 'source3.channel', '04', ['5.5.5.5'], total=3)
+        handoff_requested.set()
+        self.pump_old_instance_until(lambda: not thread.is_alive())
+        thread.join()
+        self.assertNotIn('exc', result)
+        new = result['new']
+        self.assertTrue(self.old.state_handed_off)
+        source_names = list(self.old.db.comp_data.sources)
+        self.assertEqual(len(source_names), 4)
+        self.assertEqual(self.get_state(new, source_names),
+                         self.get_state(self.old, source_names))
+        self.assertEqual(self.old.db.dirty_source_names,
+                         {'source1.channel', 'source3.channel', 'source4.channel'})
+        # the sources received from the old instance have been stored
+        # by the new one immediately
+        self.assertEqual(new.db.dirty_source_names, set())
+        restarted = SimpleNamespace(db=ComparatorDataWrapper(self.dbpath))
+        self.assertEqual(self.get_state(restarted, source_names),
+                         self.get_state(self.old, source_names))
+        self.assertEqual(sorted(new.state.open_series), ['04', '05'])
+        self.assertEqual(new.state.open_series['04']['msg-count'], 1)
+        self.assertIsInstance(new.state.open_series['04']['last-seen'], float)
+        self.old._connection.remove_timeout.assert_called_once_with(
+            self.old._connection.add_timeout.return_value)
+        # the incomplete series is continued by the new instance
+        for i, ip in [(2, '6.6.6.6'), (3, '7.7.7.7')]:
+            new._process_input({
+                '_bl-time': '2017-01-19 12:04:00',
+                '_bl-series-total': 3,
+                '_bl-series-no': i,
+                '_bl-series-id': '04',
+                'expires': '2017-01-20 15:15:15',
+                'address': [{'ip': ip}],
+                'source': 'source3.channel',
+                'id': '{:030}{:02}'.format(4, i),
+            })
+        self.assertEqual(list(new.state.open_series), ['05'])
+        self.assertEqual(len(new.db.comp_data.sources['source3.channel'].blacklist), 3)
+        self.assertNotIn('source3.channel', new.db.dirty_source_names)
+
+
+if __name__ == '__main__':
+    unittest.main()
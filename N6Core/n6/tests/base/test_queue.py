@@ -0,0 +1,547 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013-2019 NASK. All rights reserved.
+
+import collections
+import itertools
+import unittest
+
+from mock import (
+    Mock,
+    call,
+    patch,
+    sentinel,
+)
+from unittest_expander import (
+    expand,
+    foreach,
+    param,
+)
+
+from n6.base.queue import (
+    QueuedBase,
+    n6AMQPCommunicationError,
+)
+from n6lib.common_helpers import SimpleNamespace
+from n6lib.record_dict import RecordDict
+from n6lib.unit_test_helpers import MethodProxy
+
+
+@expand
+class TestQueuedBase__output_transactional(unittest.TestCase):
+
+    def setUp(self):
+        self.channel_in = Mock(is_open=True)
+        self.mock = Mock(__class__=QueuedBase,
+                         _channel_in=self.channel_in,
+                         _channel_out=Mock(is_open=True),
+                         output_transactional=True)
+        self.mock.commit_output.side_effect = (
+            lambda **kwargs: self.meth.commit_output(**kwargs))
+        self.mock._on_output_committed.side_effect = (
+            lambda *args: self.meth._on_output_committed(*args))
+        self.mock._on_output_rolled_back.side_effect = (
+            lambda *args: self.meth._on_output_rolled_back(*args))
+        self.mock.rollback_output.side_effect = (
+            lambda **kwargs: self.meth.rollback_output(**kwargs))
+        self.mock._is_output_channel_open.side_effect = (
+            lambda: self.meth._is_output_channel_open())
+        self.mock._get_error_event_info_msg.return_value = ''
+        self.meth = MethodProxy(QueuedBase, self.mock)
+        self.basic_deliver = SimpleNamespace(delivery_tag=sentinel.delivery_tag,
+                                             routing_key=sentinel.routing_key)
+
+    def _on_message(self):
+        self.meth.on_message(self.channel_in,
+                             self.basic_deliver,
+                             sentinel.properties,
+                             sentinel.body)
+
+    def test_not_transactional_by_default(self):
+        self.assertIs(QueuedBase.output_transactional, False)
+
+    def test__on_output_channel_open(self):
+        channel = Mock()
+        self.meth.on_output_channel_open(channel)
+        self.assertEqual(channel.mock_calls[1:], [
+            call.tx_select(),
+        ])
+        self.mock.setup_output_exchanges.assert_called_once_with()
+
+    def test__on_output_channel_open__not_transactional(self):
+        self.mock.output_transactional = False
+        channel = Mock()
+        self.meth.on_output_channel_open(channel)
+        self.assertNotIn(call.tx_select(), channel.mock_calls)
+
+    def _confirm_commit(self):
+        [(_, (callback,), _)] = self.mock._channel_out.tx_commit.mock_calls
+        callback(sentinel.commit_ok_frame)
+
+    def test__on_message__success(self):
+        self._on_message()
+        self.assertEqual(len(self.mock._channel_out.mock_calls), 1)
+        # (acked only when the commit has been confirmed)
+        self.assertEqual(self.mock.acknowledge_message.mock_calls, [])
+        self._confirm_commit()
+        self.mock.acknowledge_message.assert_called_once_with(sentinel.delivery_tag)
+        self.assertEqual(self.mock.nacknowledge_message.mock_calls, [])
+
+    def test__on_message__success__not_transactional(self):
+        self.mock.output_transactional = False
+        self._on_message()
+        self.assertEqual(self.mock._channel_out.mock_calls, [])
+        self.mock.acknowledge_message.assert_called_once_with(sentinel.delivery_tag)
+
+    @foreach(
+        param(channel_out=Mock(is_open=False)),
+        param(channel_out=None),
+    )
+    def test__on_message__success__output_channel_closed(self, channel_out):
+        self.mock._channel_out = channel_out
+        with patch('n6.base.queue.LOGGER'):
+            self._on_message()
+        if channel_out is not None:
+            self.assertEqual(channel_out.method_calls, [])
+        self.assertEqual(self.mock.acknowledge_message.mock_calls, [])
+        self.assertEqual(len(self.mock.nacknowledge_message.mock_calls), 1)
+        self.assertIs(self.mock.nacknowledge_message.call_args[1].get('requeue'), True)
+
+    @foreach(
+        param(channel_in_after_commit=None),
+        param(channel_in_after_commit=Mock(is_open=True)),
+        param(channel_in_after_commit='the same, closed'),
+    )
+    def test__on_message__success__input_channel_closed_before_commit_confirmed(
+            self, channel_in_after_commit):
+        self._on_message()
+        if channel_in_after_commit == 'the same, closed':
+            self.channel_in.is_open = False
+        else:
+            self.mock._channel_in = channel_in_after_commit
+        with patch('n6.base.queue.LOGGER'):
+            self._confirm_commit()
+        self.assertEqual(self.mock.acknowledge_message.mock_calls, [])
+        self.assertEqual(self.mock.nacknowledge_message.mock_calls, [])
+
+    def _confirm_rollback(self):
+        [(_, (callback,), _)] = self.mock._channel_out.tx_rollback.mock_calls
+        callback(sentinel.rollback_ok_frame)
+
+    def test__on_message__error(self):
+        self.mock.input_callback.side_effect = ValueError('foo')
+        with patch('n6.base.queue.LOGGER'):
+            self._on_message()
+        self.assertEqual(len(self.mock._channel_out.mock_calls), 1)
+        # (nacked only when the rollback has been confirmed)
+        self.assertEqual(self.mock.nacknowledge_message.mock_calls, [])
+        self._confirm_rollback()
+        self.assertEqual(self.mock.acknowledge_message.mock_calls, [])
+        self.assertEqual(len(self.mock.nacknowledge_message.mock_calls), 1)
+        self.assertIs(self.mock.nacknowledge_message.call_args[1].get('requeue', False), False)
+
+    def test__on_message__error__not_transactional(self):
+        self.mock.output_transactional = False
+        self.mock.input_callback.side_effect = ValueError('foo')
+        with patch('n6.base.queue.LOGGER'):
+            self._on_message()
+        self.assertEqual(self.mock._channel_out.mock_calls, [])
+        self.assertEqual(len(self.mock.nacknowledge_message.mock_calls), 1)
+
+    @foreach(
+        param(channel_out=Mock(is_open=False)),
+        param(channel_out=None),
+    )
+    def test__on_message__error__output_channel_closed(self, channel_out):
+        self.mock._channel_out = channel_out
+        self.mock.input_callback.side_effect = ValueError('foo')
+        with patch('n6.base.queue.LOGGER'):
+            self._on_message()
+        if channel_out is not None:
+            self.assertEqual(channel_out.method_calls, [])
+        self.assertEqual(len(self.mock.nacknowledge_message.mock_calls), 1)
+
+    def test__on_message__error__input_channel_closed_before_rollback_confirmed(self):
+        self.mock.input_callback.side_effect = ValueError('foo')
+        with patch('n6.base.queue.LOGGER'):
+            self._on_message()
+            self.channel_in.is_open = False
+            self._confirm_rollback()
+        self.assertEqual(self.mock.nacknowledge_message.mock_calls, [])
+
+    def test__on_message__keyboard_interrupt(self):
+        self.mock.input_callback.side_effect = KeyboardInterrupt
+        with patch('n6.base.queue.LOGGER'), \
+             self.assertRaises(KeyboardInterrupt):
+            self._on_message()
+        self.assertEqual(self.mock._channel_out.mock_calls, [
+            call.tx_rollback(None),
+        ])
+        self.assertEqual(self.mock.acknowledge_message.mock_calls, [])
+        self.assertEqual(len(self.mock.nacknowledge_message.mock_calls), 1)
+        self.assertIs(self.mock.nacknowledge_message.call_args[1].get('requeue'), True)
+
+    @foreach(
+        param(output_transactional=True, expected_prefetch_count=1),
+        param(output_transactional=False, expected_prefetch_count=20),
+    )
+    def test__on_bindok__prefetch_count(self, output_transactional, expected_prefetch_count):
+        self.mock.output_transactional = output_transactional
+        self.mock.prefetch_count = 20
+        self.mock._num_queues_bound = 0
+        self.mock.input_queue = {'binding_keys': []}
+        self.meth.on_bindok(sentinel.bind_ok_frame)
+        self.channel_in.basic_qos.assert_called_once_with(
+            prefetch_count=expected_prefetch_count)
+
+    @foreach(
+        param(output_transactional=False, channel_out=Mock(is_open=True)),
+        param(output_transactional=True, channel_out=Mock(is_open=False)),
+        param(output_transactional=True, channel_out=None),
+    )
+    def test__commit_and_rollback_output__no_op(self, output_transactional, channel_out):
+        self.mock.output_transactional = output_transactional
+        self.mock._channel_out = channel_out
+        self.meth.commit_output()
+        self.meth.rollback_output()
+        if channel_out is not None:
+            self.assertEqual(channel_out.method_calls, [])
+
+
+
+class _FakeBroker(object):
+
+    """
+    A (very) simplified model of the broker and of pika channels -- as
+    regards consuming with a prefetch limit and publishing to a channel
+    in the AMQP transactional mode.
+
+    Like pika's channels, the output channel sends published messages
+    immediately, whereas a Tx.Commit/Rollback (being a synchronous AMQP
+    method) is sent only when no previous RPC is awaiting its reply.
+    """
+
+    def __init__(self, input_bodies):
+        self.to_deliver = collections.deque(enumerate(input_bodies, 1))
+        self.prefetch_count = None
+        self.unacked = set()
+        self.acked = []
+        self.nacked = []
+        self.uncommitted = []
+        self.committed = []
+        self.replies = collections.deque()
+        self.rpc_awaiting_reply = False
+        self.blocked_rpcs = collections.deque()
+
+    # input side
+
+    def basic_qos(self, prefetch_count):
+        self.prefetch_count = prefetch_count
+
+    def ack(self, delivery_tag):
+        self.unacked.remove(delivery_tag)
+        self.acked.append(delivery_tag)
+
+    def nack(self, delivery_tag, reason, requeue=False):
+        self.unacked.remove(delivery_tag)
+        self.nacked.append(delivery_tag)
+
+    # output side
+
+    def basic_publish(self, body):
+        self.uncommitted.append(body)
+
+    def tx_commit(self, callback=None):
+        self._rpc(self._commit, callback)
+
+    def tx_rollback(self, callback=None):
+        self._rpc(self._rollback, callback)
+
+    def _rpc(self, action, callback):
+        if self.rpc_awaiting_reply:
+            self.blocked_rpcs.append((action, callback))
+        else:
+            self.rpc_awaiting_reply = True
+            action()
+            self.replies.append(callback)
+
+    def _commit(self):
+        self.committed.extend(self.uncommitted)
+        del self.uncommitted[:]
+
+    def _rollback(self):
+        del self.uncommitted[:]
+
+    # the IO loop
+
+    def run(self, on_message):
+        while self.to_deliver or self.replies:
+            # (deliveries that are already allowed by the prefetch
+            # limit may arrive before a reply to a pending RPC)
+            while self.to_deliver and len(self.unacked) < self.prefetch_count:
+                delivery_tag, body = self.to_deliver.popleft()
+                self.unacked.add(delivery_tag)
+                on_message(delivery_tag, body)
+            if self.replies:
+                callback = self.replies.popleft()
+                self.rpc_awaiting_reply = False
+                if callback is not None:
+                    callback(sentinel.method_frame)
+                if self.blocked_rpcs:
+                    self._rpc(*self.blocked_rpcs.popleft())
+
+
+class TestQueuedBase__output_transactional__interleaved_deliveries(unittest.TestCase):
+
+    def setUp(self):
+        # (the 2nd input message causes an error after publishing some output)
+        self.broker = _FakeBroker(['a', 'b', 'c'])
+        self.channel_in = Mock(is_open=True)
+        self.channel_in.basic_qos.side_effect = self.broker.basic_qos
+        self.channel_out = Mock(is_open=True)
+        self.channel_out.tx_commit.side_effect = self.broker.tx_commit
+        self.channel_out.tx_rollback.side_effect = self.broker.tx_rollback
+        self.mock = Mock(__class__=QueuedBase,
+                         _channel_in=self.channel_in,
+                         _channel_out=self.channel_out,
+                         output_transactional=True,
+                         prefetch_count=20,
+                         _num_queues_bound=0,
+                         input_queue={'binding_keys': []})
+        self.meth = MethodProxy(QueuedBase, self.mock, [
+            'commit_output',
+            'rollback_output',
+            '_on_output_committed',
+            '_on_output_rolled_back',
+            '_is_output_channel_open',
+        ])
+        self.mock.input_callback.side_effect = self._input_callback
+        self.mock.acknowledge_message.side_effect = self.broker.ack
+        self.mock.nacknowledge_message.side_effect = self.broker.nack
+        self.mock._get_error_event_info_msg.return_value = ''
+
+    def _input_callback(self, routing_key, body, properties):
+        self.broker.basic_publish(body + '1')
+        if body == 'b':
+            raise ValueError('foo')
+        self.broker.basic_publish(body + '2')
+
+    def _on_message(self, delivery_tag, body):
+        basic_deliver = SimpleNamespace(delivery_tag=delivery_tag,
+                                        routing_key=sentinel.routing_key)
+        self.meth.on_message(self.channel_in, basic_deliver, sentinel.properties, body)
+
+    def test_output_of_successfully_handled_messages_committed(self):
+        self.meth.on_bindok(sentinel.bind_ok_frame)
+        with patch('n6.base.queue.LOGGER'):
+            self.broker.run(self._on_message)
+        self.assertEqual(self.broker.acked, [1, 3])
+        self.assertEqual(self.broker.nacked, [2])
+        self.assertEqual(self.broker.committed, ['a1', 'a2', 'c1', 'c2'])
+        self.assertEqual(self.broker.uncommitted, [])
+
+
+class TestQueuedBase__limit_outbound_buffer(unittest.TestCase):
+
+    def setUp(self):
+        self.outbound_buffer = collections.deque()
+        self.connection = Mock(outbound_buffer=self.outbound_buffer, is_closed=False)
+        self.connection._handle_write.side_effect = self.outbound_buffer.popleft
+        self.mock = Mock(__class__=QueuedBase,
+                         _connection=self.connection,
+                         _closing=False,
+                         output_ready=True,
+                         outbound_buffer_size_limit=5,
+                         _outbound_buffer_byte_count=5,
+                         _outbound_buffer_flushing_given_up=False,
+                         _connection_blocked=False)
+        self.mock._get_yield_time_interval_threshold.return_value = 10.0
+        self.meth = MethodProxy(QueuedBase, self.mock)
+        self.time_mock = self._patch('n6.base.queue.time.time', return_value=1000.0)
+        self.select_mock = self._patch('n6.base.queue.select.select',
+                                       return_value=([], [self.connection.socket], []))
+
+    def _patch(self, *args, **kwargs):
+        patcher = patch(*args, **kwargs)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def test_buffer_empty(self):
+        self.meth.limit_outbound_buffer()
+        self.assertEqual(self.mock._outbound_buffer_byte_count, 0)
+        self.assertEqual(self.select_mock.mock_calls, [])
+
+    def test_byte_count_below_limit(self):
+        self.outbound_buffer.extend(['aaa', 'bbb'])
+        self.mock._outbound_buffer_byte_count = 4
+        self.meth.limit_outbound_buffer()
+        self.assertEqual(list(self.outbound_buffer), ['aaa', 'bbb'])
+        self.assertEqual(self.mock._outbound_buffer_byte_count, 4)
+        self.assertEqual(self.select_mock.mock_calls, [])
+
+    def test_actual_size_below_limit(self):
+        self.outbound_buffer.extend(['aa', 'bb'])
+        self.meth.limit_outbound_buffer()
+        self.assertEqual(list(self.outbound_buffer), ['aa', 'bb'])
+        self.assertEqual(self.mock._outbound_buffer_byte_count, 4)
+        self.assertEqual(self.select_mock.mock_calls, [])
+
+    def test_limit_reached(self):
+        self.outbound_buffer.extend(['aa', 'bb', 'c'])
+        self.meth.limit_outbound_buffer()
+        self.assertEqual(list(self.outbound_buffer), [])
+        self.assertEqual(self.mock._outbound_buffer_byte_count, 0)
+        self.assertEqual(self.select_mock.mock_calls, 3 * [
+            call([], [self.connection.socket], [], 10.0),
+        ])
+
+    def test_giving_up_when_socket_not_writable(self):
+        self.outbound_buffer.extend(['aa', 'bb', 'c'])
+        self.select_mock.return_value = ([], [], [])
+        self.time_mock.side_effect = itertools.chain([1000.0, 1000.0, 1006.0],
+                                                     itertools.repeat(1010.0))
+        with patch('n6.base.queue.LOGGER'):
+            self.meth.limit_outbound_buffer()
+        self.assertEqual(list(self.outbound_buffer), ['aa', 'bb', 'c'])
+        self.assertEqual(self.mock._outbound_buffer_byte_count, 0)
+        self.assertIs(self.mock._outbound_buffer_flushing_given_up, True)
+        self.assertEqual(self.select_mock.mock_calls, [
+            call([], [self.connection.socket], [], 10.0),
+            call([], [self.connection.socket], [], 4.0),
+        ])
+        self.assertEqual(self.connection._handle_write.mock_calls, [])
+
+    def test_buffer_not_limited_after_giving_up_until_found_empty(self):
+        self.mock._outbound_buffer_flushing_given_up = True
+        self.outbound_buffer.extend(['aa', 'bb', 'c'])
+        for _ in xrange(3):
+            self.outbound_buffer.extend(['dd', 'ee', 'f'])
+            self.mock._outbound_buffer_byte_count += 5
+            self.meth.limit_outbound_buffer()
+        # (no more stalling -- so the buffer just grows...)
+        self.assertEqual(len(self.outbound_buffer), 12)
+        self.assertEqual(self.select_mock.mock_calls, [])
+        # (...until the IO loop has flushed it)
+        self.outbound_buffer.clear()
+        self.meth.limit_outbound_buffer()
+        self.assertIs(self.mock._outbound_buffer_flushing_given_up, False)
+        self.outbound_buffer.extend(['aa', 'bb', 'c'])
+        self.mock._outbound_buffer_byte_count = 5
+        self.meth.limit_outbound_buffer()
+        self.assertEqual(list(self.outbound_buffer), [])
+        self.assertEqual(len(self.select_mock.mock_calls), 3)
+
+    def test_buffer_not_limited_while_connection_blocked(self):
+        self.mock._connection_blocked = True
+        self.outbound_buffer.extend(['aa', 'bb', 'c'])
+        self.meth.limit_outbound_buffer()
+        self.assertEqual(list(self.outbound_buffer), ['aa', 'bb', 'c'])
+        self.assertEqual(self.select_mock.mock_calls, [])
+
+    def test_no_op_for_unknown_pika_version(self):
+        self.outbound_buffer.extend(['aa', 'bb', 'c'])
+        with patch('n6.base.queue.pika.__version__', '1.1.0'):
+            self.meth.limit_outbound_buffer()
+        self.assertEqual(list(self.outbound_buffer), ['aa', 'bb', 'c'])
+        self.assertEqual(self.select_mock.mock_calls, [])
+        self.assertEqual(self.connection._handle_write.mock_calls, [])
+
+    def test_connection_blocked_and_unblocked(self):
+        with patch('n6.base.queue.LOGGER'):
+            self.meth.on_connection_open(self.connection)
+            self.assertEqual(self.connection.mock_calls[:3], [
+                call.add_on_close_callback(self.mock.on_connection_closed),
+                call.add_on_connection_blocked_callback(self.mock.on_connection_blocked),
+                call.add_on_connection_unblocked_callback(self.mock.on_connection_unblocked),
+            ])
+            self.assertIs(self.mock._connection_blocked, False)
+            self.meth.on_connection_blocked(Mock())
+            self.assertIs(self.mock._connection_blocked, True)
+            self.mock._outbound_buffer_flushing_given_up = True
+            self.meth.on_connection_unblocked(Mock())
+        self.assertIs(self.mock._connection_blocked, False)
+        self.assertIs(self.mock._outbound_buffer_flushing_given_up, False)
+
+    def test_connection_lost(self):
+        self.outbound_buffer.extend(['aa', 'bb', 'c'])
+        def handle_write():
+            self.mock.output_ready = False
+        self.connection._handle_write.side_effect = handle_write
+        with self.assertRaises(n6AMQPCommunicationError):
+            self.meth.limit_outbound_buffer()
+
+    def test_connection_closed_while_socket_not_writable(self):
+        self.outbound_buffer.extend(['aa', 'bb', 'c'])
+        self.select_mock.return_value = ([], [], [])
+        self.connection.is_closed = True
+        with self.assertRaises(n6AMQPCommunicationError):
+            self.meth.limit_outbound_buffer()
+        self.assertEqual(len(self.select_mock.mock_calls), 1)
+
+
+@expand
+class TestQueuedBase__record_dict_from_json(unittest.TestCase):
+
+    BODY = '{"category": "bots", "source": "foo.bar"}'
+    MARKED = {RecordDict.TRUSTED_JSON_HEADER: RecordDict.TRUSTED_JSON_VERSION}
+
+    def setUp(self):
+        self.record_dict_class = Mock(
+            TRUSTED_JSON_HEADER=RecordDict.TRUSTED_JSON_HEADER,
+            TRUSTED_JSON_VERSION=RecordDict.TRUSTED_JSON_VERSION)
+        self.record_dict_class.from_json.return_value = sentinel.record_dict
+
+    def _call(self, cmdline_args, properties):
+        mock = Mock(__class__=QueuedBase, cmdline_args=cmdline_args)
+        meth = MethodProxy(QueuedBase, mock)
+        result = meth.record_dict_from_json(self.record_dict_class,
+                                            self.BODY,
+                                            properties,
+                                            foo=sentinel.foo)
+        self.assertIs(result, sentinel.record_dict)
+
+    def test_trusted(self):
+        self._call(SimpleNamespace(n6trusted_input=True,
+                                   n6trusted_input_validation_rate=sentinel.rate),
+                   SimpleNamespace(headers=dict(self.MARKED, bar='spam')))
+        self.assertEqual(self.record_dict_class.from_json.mock_calls, [
+            call(self.BODY, foo=sentinel.foo, trusted=True, validation_rate=sentinel.rate),
+        ])
+
+    @foreach(
+        param(cmdline_args=SimpleNamespace(n6trusted_input=False),
+              properties=SimpleNamespace(headers=MARKED)),
+        param(cmdline_args=SimpleNamespace(),
+              properties=SimpleNamespace(headers=MARKED)),
+        param(cmdline_args=None,
+              properties=SimpleNamespace(headers=MARKED)),
+        param(cmdline_args=SimpleNamespace(n6trusted_input=True),
+              properties=SimpleNamespace(headers={RecordDict.TRUSTED_JSON_HEADER: 12345})),
+        param(cmdline_args=SimpleNamespace(n6trusted_input=True),
+              properties=SimpleNamespace(headers={})),
+        param(cmdline_args=SimpleNamespace(n6trusted_input=True),
+              properties=SimpleNamespace(headers=None)),
+        param(cmdline_args=SimpleNamespace(n6trusted_input=True),
+              properties=None),
+    )
+    def test_not_trusted(self, cmdline_args, properties):
+        self._call(cmdline_args, properties)
+        self.assertEqual(self.record_dict_class.from_json.mock_calls, [
+            call(self.BODY, foo=sentinel.foo),
+        ])
+
+    def test_arg_parser(self):
+        mock = Mock(__class__=QueuedBase, supports_trusted_record_dict_input=True,
+                    supports_n6recovery=False)
+        arg_parser = MethodProxy(QueuedBase, mock).get_arg_parser()
+        args = arg_parser.parse_args(['--n6trusted-input',
+                                      '--n6trusted-input-validation-rate', '0.01'])
+        self.assertIs(args.n6trusted_input, True)
+        self.assertEqual(args.n6trusted_input_validation_rate, 0.01)
+        args = arg_parser.parse_args([])
+        self.assertIs(args.n6trusted_input, False)
+        self.assertEqual(args.n6trusted_input_validation_rate, 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,9 +2,13 @@
 
 # Copyright (c) 2013-2019 NASK. All rights reserved.
 
+import collections
+import datetime
 import hashlib
 import json
+import random
 import unittest
+import warnings
 
 from mock import (
     ANY,
@@ -51,7 +55,7 @@ from n6.parsers.generic import (
 class TestBaseParser(unittest.TestCase):
 
     def setUp(self):
-        self.mock = Mock(__class__=BaseParser, allow_empty_results=False)
+        self.mock = Mock(__class__=BaseParser, allow_empty_results=False, stream_output=False)
         self.meth = MethodProxy(BaseParser, self.mock)
 
     def _asserts_of_proper__new__instance_adjustment(self, instance):
@@ -213,6 +217,28 @@ class TestBaseParser(unittest.TestCase):
                 expected_config,
                 expected_config_full)
 
+    def test_initialization_with_stream_output(self):
+        class SomeParser(BaseParser):
+            default_binding_key = 'foo.bar'
+            stream_output = True
+
+        super_cls_mock = SimpleNamespace(__init__=Mock())
+        with patch_always('n6.parsers.generic.super',
+                          return_value=super_cls_mock), \
+             patch('n6.parsers.generic.Config._load_n6_config_files',
+                   return_value={}):
+            instance = SomeParser()
+        self.assertIs(instance.output_transactional, True)
+        self.assertIs(BaseParser.output_transactional, False)
+
+    def test_initialization_with_stream_output_for_black_list_parser(self):
+        class SomeParser(BlackListParser):
+            default_binding_key = 'foo.bar'
+            stream_output = True
+
+        with self.assertRaises(TypeError):
+            SomeParser()
+
     def test__make_binding_keys(self):
         self.mock.default_binding_key = 'fooo.barr'
         binding_keys = self.meth.make_binding_keys()
@@ -249,6 +275,7 @@ class TestBaseParser(unittest.TestCase):
         FilePagedSequence_mock.return_value.__enter__.return_value = sentinel.working_seq
         data = MagicMock(**{'get.return_value': sentinel.rid})
         self.mock.configure_mock(**{
+            '_record_dict_template_cache': sentinel.template_cache,
             '_fix_body.return_value': sentinel.body,
             'prepare_data.return_value': data,
             'setting_error_event_info': MagicMock(),
@@ -280,6 +307,60 @@ class TestBaseParser(unittest.TestCase):
             call().__enter__(),
             call().__exit__(None, None, None),
         ])
+        self.assertIsNone(self.mock._record_dict_template_cache)
+
+    @patch('n6.parsers.generic.FilePagedSequence')
+    def test__input_callback__error(self, FilePagedSequence_mock):
+        data = MagicMock(**{'get.return_value': sentinel.rid})
+        self.mock.configure_mock(**{
+            '_record_dict_template_cache': sentinel.template_cache,
+            '_fix_body.return_value': sentinel.body,
+            'prepare_data.return_value': data,
+            'setting_error_event_info': MagicMock(),
+            'get_output_rk.return_value': sentinel.output_rk,
+            'get_output_bodies.side_effect': ZeroDivisionError,
+        })
+        with self.assertRaises(ZeroDivisionError):
+            self.meth.input_callback(sentinel.routing_key,
+                                     sentinel.body,
+                                     sentinel.properties)
+        self.assertEqual(self.mock.publish_output.mock_calls, [])
+        self.assertIsNone(self.mock._record_dict_template_cache)
+
+    @patch('n6.parsers.generic.FilePagedSequence')
+    def test__input_callback__stream_output(self, FilePagedSequence_mock):
+        data = MagicMock(**{'get.return_value': sentinel.rid})
+        self.mock.configure_mock(**{
+            'stream_output': True,
+            '_fix_body.return_value': sentinel.body,
+            'prepare_data.return_value': data,
+            'setting_error_event_info': MagicMock(),
+            'get_output_rk.return_value': sentinel.output_rk,
+            'iter_output_bodies.return_value': iter([sentinel.output_body1,
+                                                     sentinel.output_body2]),
+        })
+        self.meth.input_callback(sentinel.routing_key,
+                                 sentinel.body,
+                                 sentinel.properties)
+        self.assertEqual(self.mock.mock_calls, [
+            call._fix_body(sentinel.body),
+            call.prepare_data(sentinel.routing_key,
+                              sentinel.body,
+                              sentinel.properties),
+            call.prepare_data().get('properties.message_id'),
+            call.setting_error_event_info(sentinel.rid),
+            call.setting_error_event_info().__enter__(),
+            call.get_output_rk(data),
+            call.iter_output_bodies(data),
+            call.publish_output(routing_key=sentinel.output_rk,
+                                body=sentinel.output_body1),
+            call.limit_outbound_buffer(),
+            call.publish_output(routing_key=sentinel.output_rk,
+                                body=sentinel.output_body2),
+            call.limit_outbound_buffer(),
+            call.setting_error_event_info().__exit__(None, None, None),
+        ])
+        self.assertEqual(FilePagedSequence_mock.mock_calls, [])
 
     def test__prepare_data(self):
         data = self.meth.prepare_data(
@@ -414,6 +495,123 @@ class TestBaseParser(unittest.TestCase):
             call.parse(sentinel.data),
         ])
 
+    def test__iter_output_bodies(self):
+        parsed = [MagicMock(**{'__class__': RecordDict,
+                               'used_as_context_manager': True,
+                               'get_ready_json.return_value':
+                                   getattr(sentinel,
+                                           'output_body{}'.format(i))})
+                  for i in (1, 2)]
+        self.mock.configure_mock(**{
+            'parse.return_value': parsed,
+            'get_output_message_id.side_effect': [
+                sentinel.msg_A,
+                sentinel.msg_B,
+            ],
+            'setting_error_event_info': MagicMock(),
+            'postprocess_parsed.side_effect': (
+                lambda data, parsed, total, item_no: parsed
+            ),
+        })
+        output_bodies = self.meth.iter_output_bodies(sentinel.data)
+        self.assertEqual(self.mock.mock_calls, [])  # (it's a generator)
+        self.assertIs(next(output_bodies), sentinel.output_body1)
+        self.assertEqual(self.mock.mock_calls, [
+            call.parse(sentinel.data),
+            call.get_output_message_id(parsed[0]),
+            call.delete_too_long_address(parsed[0]),
+            call.setting_error_event_info(parsed[0]),
+            call.setting_error_event_info().__enter__(),
+            call.postprocess_parsed(sentinel.data,
+                                    parsed[0],
+                                    None,
+                                    item_no=1),
+            call.setting_error_event_info().__exit__(None, None, None),
+        ])
+        self.assertEqual(list(output_bodies), [sentinel.output_body2])
+        self.assertEqual(self.mock.mock_calls[7:], [
+            call.get_output_message_id(parsed[1]),
+            call.delete_too_long_address(parsed[1]),
+            call.setting_error_event_info(parsed[1]),
+            call.setting_error_event_info().__enter__(),
+            call.postprocess_parsed(sentinel.data,
+                                    parsed[1],
+                                    None,
+                                    item_no=2),
+            call.setting_error_event_info().__exit__(None, None, None),
+        ])
+        self.assertEqual(parsed[0].mock_calls, [
+            call.__setitem__('id', sentinel.msg_A),
+            call.get_ready_json(),
+        ])
+        self.assertEqual(parsed[1].mock_calls, [
+            call.__setitem__('id', sentinel.msg_B),
+            call.get_ready_json(),
+        ])
+
+    def test__iter_output_bodies__record_dict_not_used_as_context_manager(self):
+        parsed = [MagicMock(**{'__class__': RecordDict,
+                               'used_as_context_manager': False})
+                  for i in (1, 2)]
+        self.mock.configure_mock(**{'parse.return_value': parsed})
+        with self.assertRaises(AssertionError):
+            list(self.meth.iter_output_bodies(sentinel.data))
+        self.assertEqual(self.mock.method_calls, [
+            call.parse(sentinel.data),
+        ])
+
+    def test__iter_output_bodies__parse_yielded_no_items(self):
+        self.mock.configure_mock(**{'parse.return_value': iter([])})
+        with self.assertRaises(ValueError):
+            list(self.meth.iter_output_bodies(sentinel.data))
+        self.assertEqual(self.mock.method_calls, [
+            call.parse(sentinel.data),
+        ])
+
+    def test__iter_output_bodies__parse_yielded_no_items__allow_empty_results(self):
+        self.mock.configure_mock(**{'parse.return_value': iter([]),
+                                    'allow_empty_results': True})
+        self.assertEqual(list(self.meth.iter_output_bodies(sentinel.data)), [])
+        self.assertEqual(self.mock.mock_calls, [
+            call.parse(sentinel.data),
+        ])
+
+    def test__new_record_dict(self):
+        set_basic_items_calls = []
+        class MyParser(BaseParser):
+            default_binding_key = 'foo.bar'
+            constant_items = {
+                'restriction': 'public',
+                'confidence': 'low',
+                'category': 'bots',
+            }
+            record_dict_kwargs = {'log_nonstandard_names': False}
+            def set_basic_items(self, record_dict, data):
+                set_basic_items_calls.append(data['source'])
+                super(MyParser, self).set_basic_items(record_dict, data)
+        parser = MyParser.__new__(MyParser)
+        data = {'properties.message_id': '0123456789abcdef0123456789abcdef',
+                'source': 'foo.bar'}
+        expected = RecordDict(dict(MyParser.constant_items,
+                                   rid='0123456789abcdef0123456789abcdef',
+                                   source='foo.bar'))
+        rd1 = parser.new_record_dict(data)
+        rd2 = parser.new_record_dict(data)
+        rd3 = parser.new_record_dict(dict(data, source='foo.baz'))
+        # the basic items have been set only once per `data`
+        self.assertEqual(set_basic_items_calls, ['foo.bar', 'foo.baz'])
+        for rd in (rd1, rd2, rd3):
+            self.assertIs(type(rd), RecordDict)
+            self.assertTrue(rd.log_nonstandard_names)
+            self.assertIs(rd.context_manager_error_callback, parser.handle_parse_error)
+            self.assertFalse(rd.used_as_context_manager)
+        self.assertEqual(rd1, expected)
+        self.assertEqual(rd2, expected)
+        self.assertEqual(rd3, dict(expected, source='foo.baz'))
+        self.assertIsNot(rd1, rd2)
+        rd1['name'] = 'spam'
+        self.assertNotIn('name', rd2)
+
     def test__delete_too_long_address__address_is_ok(self):
         parsed = RecordDict()
         parsed['address'] = [{'ip': i+1} for i in xrange(MAX_IPS_IN_ADDRESS)]
@@ -601,6 +799,184 @@ class TestBaseParser(unittest.TestCase):
     # ...
 
 
+def _reference_get_output_message_id(self, parsed):
+    # the original (slow but simple) implementation of
+    # BaseParser.get_output_message_id() -- the ids generated
+    # by the actual implementation must always be the same
+    assert isinstance(parsed, RecordDict)
+    serialized = []
+    for k, v in sorted(self.iter_output_id_base_items(parsed)):
+        if isinstance(v, (list, tuple)):
+            v = ('{}'.format(self._prepare_for_deterministic_serialization(el))
+                 for el in v)
+            v = ','.join(sorted(v))
+        v = self._prepare_for_deterministic_serialization(v)
+        serialized.append("{},{}".format(k, v))
+    return hashlib.md5("\n".join(serialized)).hexdigest()
+
+
+class TestBaseParser__get_output_message_id__compatibility(unittest.TestCase):
+
+    # the ids must be exactly the same as those generated by the
+    # original implementation (see above) -- as they are used to
+    # detect duplicates of already stored events
+
+    CORPUS_SIZE = 3000
+
+    class _str(str): pass
+    class _unicode(unicode): pass
+    class _list(list): pass
+
+    def setUp(self):
+        self.parser = BaseParser.__new__(BaseParser)
+        self.rand = random.Random(42)
+
+    def _result_or_exc_type(self, func, *args):
+        try:
+            return func(*args)
+        except Exception as exc:
+            return type(exc)
+
+    def _assert_same_ids(self, parser, record_dicts):
+        got_ids = 0
+        for rd in record_dicts:
+            expected = self._result_or_exc_type(_reference_get_output_message_id, parser, rd)
+            actual = self._result_or_exc_type(parser.get_output_message_id, rd)
+            self.assertEqual(actual, expected, rd)
+            if isinstance(expected, str):
+                self.assertIs(type(actual), str)
+                got_ids += 1
+        return got_ids
+
+    def _random_text(self):
+        rand = self.rand
+        s = u''.join(rand.choice(u'abcXYZ019.-_:/ \'"\\\tąćęłńóśźżЖ☃')
+                     for _ in xrange(rand.randint(0, 12)))
+        return rand.choice([
+            s,
+            s.encode('utf-8'),
+            s.encode('ascii', 'ignore'),
+            s.encode('ascii', 'ignore').decode('ascii'),
+        ])
+
+    def _random_ip(self):
+        return '.'.join(str(self.rand.randint(0, 255)) for _ in xrange(4))
+
+    def _random_record_dict(self):
+        rand = self.rand
+        items = {
+            'category': rand.choice(['bots', 'cnc', 'phish', 'scanning']),
+            'source': rand.choice(['foo.bar', u'spam.ham']),
+            'restriction': 'public',
+            'confidence': 'low',
+            'rid': '%032x' % rand.getrandbits(128),
+            'time': '2019-0{}-1{} 1{}:00:0{}'.format(*(rand.randint(1, 9) for _ in xrange(4))),
+            '_do_not_resolve_fqdn_to_ip': True,
+        }
+        if rand.random() < 0.7:
+            items['address'] = [
+                dict({'ip': self._random_ip()},
+                     **rand.choice([{}, {'cc': 'PL'}, {'cc': u'DE', 'asn': rand.randint(1, 2**32 - 1)}]))
+                for _ in xrange(rand.randint(1, 4))]
+        if rand.random() < 0.5:
+            items['client'] = [rand.choice(['o1', u'o2', 'org-ąę']) for _ in xrange(rand.randint(1, 3))]
+        if rand.random() < 0.5:
+            path = self._random_text()
+            if isinstance(path, str):
+                path = path.decode('utf-8')
+            items['url'] = u'http://example.com/' + path
+        if rand.random() < 0.5:
+            items['fqdn'] = 'host{}.example.com'.format(rand.randint(0, 99))
+        if rand.random() < 0.5:
+            items['name'] = self._random_text() or 'foo'
+        if rand.random() < 0.3:
+            items['dport'] = rand.randint(0, 65535)
+            items['proto'] = rand.choice(['tcp', 'udp'])
+        if rand.random() < 0.3:
+            items['count'] = rand.randint(0, 1000)
+        if rand.random() < 0.3:
+            items['dip'] = self._random_ip()
+        if rand.random() < 0.3:
+            items['md5'] = '%032x' % rand.getrandbits(128)
+        return RecordDict(items)
+
+    def _random_scalar(self, illegal_ones=False):
+        rand = self.rand
+        choices = [
+            self._random_text,
+            lambda: rand.randint(-10, 10),
+            lambda: long(rand.randint(-10, 10)),
+            lambda: rand.getrandbits(100),
+            lambda: rand.choice([True, False]),
+        ]
+        if illegal_ones:
+            choices += [
+                lambda: rand.random(),
+                lambda: None,
+                lambda: datetime.datetime(2019, 1, 2, 3, 4, 5),
+                lambda: self._str('abc'),
+                lambda: self._unicode(u'x'),
+            ]
+        return rand.choice(choices)()
+
+    def _random_dict(self, illegal_ones=False):
+        rand = self.rand
+        keys = [self._random_text() for _ in xrange(rand.randint(0, 4))]
+        if illegal_ones and rand.random() < 0.2:
+            keys.append(rand.choice([1, 2.5, None, self._str('k'), (1, 2)]))
+        d = {k: self._random_scalar(illegal_ones=(illegal_ones and rand.random() < 0.3))
+             for k in keys}
+        if illegal_ones and rand.random() < 0.1:
+            d = collections.OrderedDict(d)
+        return d
+
+    def _random_value(self, illegal_ones=False):
+        rand = self.rand
+        def random_element():
+            return rand.choice([
+                lambda: self._random_scalar(illegal_ones=(illegal_ones and rand.random() < 0.2)),
+                lambda: self._random_dict(illegal_ones=illegal_ones),
+            ] + ([lambda: [1]] if illegal_ones else []))()
+        kind = rand.random()
+        if kind < 0.3:
+            return self._random_scalar(illegal_ones=illegal_ones)
+        if kind < 0.5:
+            return self._random_dict(illegal_ones=illegal_ones)
+        elements = [random_element() for _ in xrange(rand.randint(0, 4))]
+        return rand.choice([list, tuple] + ([self._list] if illegal_ones else []))(elements)
+
+    def test_realistic_record_dicts(self):
+        record_dicts = [self._random_record_dict() for _ in xrange(self.CORPUS_SIZE)]
+        got_ids = self._assert_same_ids(self.parser, record_dicts)
+        self.assertEqual(got_ids, self.CORPUS_SIZE)
+
+    def test_arbitrary_items(self):
+        class MyParser(BaseParser):
+            def iter_output_id_base_items(self, parsed):
+                return iter(items_of[id(parsed)])
+        parser = MyParser.__new__(MyParser)
+        items_of = {}
+        record_dicts = []
+        for i in xrange(self.CORPUS_SIZE):
+            illegal_ones = (i % 3 == 0)
+            keys = [self.rand.choice(['k{}', u'k{}', 'ką{}']).format(j)
+                    for j in xrange(self.rand.randint(0, 5))]
+            if i % 10 == 0 and keys:
+                keys.append(keys[0])   # (duplicate keys)
+            rd = RecordDict()
+            record_dicts.append(rd)
+            items_of[id(rd)] = [(k, self._random_value(illegal_ones=illegal_ones))
+                                for k in keys]
+        with warnings.catch_warnings():
+            # (sorting items whose keys are mixed non-ASCII str and
+            # unicode ones emits UnicodeWarning -- let's silence it)
+            warnings.simplefilter('ignore', UnicodeWarning)
+            got_ids = self._assert_same_ids(parser, record_dicts)
+        # (most of the ids should be successfully generated)
+        self.assertGreater(got_ids, self.CORPUS_SIZE // 2)
+        self.assertLess(got_ids, self.CORPUS_SIZE)
+
+
 class Test__get_output_bodies__results_for_concrete_parsers(unittest.TestCase):
 
     def setUp(self):
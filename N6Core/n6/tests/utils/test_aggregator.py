@@ -2,8 +2,13 @@
 
 # Copyright (c) 2013-2018 NASK. All rights reserved.
 
+import cPickle
 import datetime
+import glob
 import json
+import os.path
+import shutil
+import tempfile
 import unittest
 from collections import namedtuple
 
@@ -28,6 +33,7 @@ from n6.utils.aggregator import (
     SourceData,
     DEFAULT_TIME_TOLERANCE,
 )
+from n6lib.persistence_helpers import AppendOnlyRecordLog
 from n6lib.unit_test_helpers import TestCaseMixin
 
 
@@ -1431,6 +1437,43 @@ class TestAggregatorDataWrapper(unittest.TestCase):
                     self.assertTrue(self._aggregator_data_wrapper.aggr_data.sources[source].buffer)
 
 
+    def test_inactivity_deadlines_checked_in_consecutive_ticks(self):
+        sources = self._aggregator_data_wrapper.aggr_data.sources
+        tested_source_data = self._get_source_data_for_suppressed_events_tests(
+            self.tested_source_channel)
+        tested_source_data.time = datetime.datetime(2017, 6, 1, 10)
+        tested_source_data.last_event = datetime.datetime(2017, 6, 1, 14)
+        sources[self.tested_source_channel] = tested_source_data
+
+        def tick(utcnow):
+            with patch('n6.utils.aggregator.datetime') as datetime_mock:
+                datetime_mock.datetime.utcnow.return_value = utcnow
+                datetime_mock.timedelta.side_effect = (lambda *args, **kw:
+                                                       datetime.timedelta(*args, **kw))
+                return list(self._aggregator_data_wrapper.generate_suppresed_events_after_timeout())
+
+        self.assertEqual(tick(datetime.datetime(2017, 6, 2, 13)), [])
+        # the source has been active in the meantime
+        tested_source_data.last_event = datetime.datetime(2017, 6, 2, 13)
+        # a new source has appeared in the meantime
+        another_source_data = self._get_source_data_for_suppressed_events_tests(
+            self.other_source_channel)
+        another_source_data.time = datetime.datetime(2017, 6, 1, 10)
+        another_source_data.last_event = datetime.datetime(2017, 6, 1, 15)
+        sources[self.other_source_channel] = another_source_data
+        self.assertEqual(tick(datetime.datetime(2017, 6, 2, 16)),
+                         self._get_source_to_expected_events_mapping()[
+                             self.other_source_channel])
+        self.assertFalse(another_source_data.groups)
+        self.assertTrue(tested_source_data.groups)
+        self.assertEqual(tick(datetime.datetime(2017, 6, 3, 12)), [])
+        self.assertEqual(tick(datetime.datetime(2017, 6, 3, 14)),
+                         self._get_source_to_expected_events_mapping()[
+                             self.tested_source_channel])
+        self.assertFalse(tested_source_data.groups)
+        self.assertEqual(tick(datetime.datetime(2017, 6, 3, 16)), [])
+
+
     # helper methods
     def _get_source_data_for_suppressed_events_tests(self, source_name):
         source_data = SourceData(self.sample_time_tolerance)
@@ -1490,6 +1533,88 @@ class TestAggregatorDataWrapper(unittest.TestCase):
 
 
 
+@expand
+class TestHiFreqEventData(unittest.TestCase):
+
+    sample_payload = {
+        'id': 'c4ca4238a0b923820dcc509a6f75849b',
+        'source': 'testsource.testchannel',
+        '_group': 'group1',
+        'time': '2017-06-01 07:00:00',
+    }
+
+    # pickled by the version of `HiFreqEventData` that kept
+    # its attributes in the instance's `__dict__`
+    legacy_pickles = [
+        param(pickled=(
+            "ccopy_reg\n_reconstructor\np1\n(cn6.utils.aggregator\nHiFreqEventData\np2\n"
+            "c__builtin__\nobject\np3\nNtRp4\n(dp5\nS'count'\np6\nI5\nsS'payload'\np7\n(dp8\n"
+            "S'source'\np9\nS'testsource.testchannel'\np10\nsS'_group'\np11\nS'group1'\np12\n"
+            "sS'id'\np13\nS'c4ca4238a0b923820dcc509a6f75849b'\np14\nsS'time'\np15\n"
+            "S'2017-06-01 07:00:00'\np16\nssS'group'\np17\ng12\nsS'until'\np18\ncdatetime\n"
+            "datetime\np19\n(S'\\x07\\xe1\\x06\\x01\\t\\x00\\x00\\x00\\x00{'\ntRp20\n"
+            "sS'first'\np21\ng19\n(S'\\x07\\xe1\\x06\\x01\\x07\\x00\\x00\\x00\\x00\\x00'\n"
+            "tRp22\nsb.")).label('protocol 0'),
+        param(pickled=(
+            '\x80\x02cn6.utils.aggregator\nHiFreqEventData\nq\x01)\x81q\x02}q\x03(U\x05countq'
+            '\x04K\x05U\x07payloadq\x05}q\x06(U\x06sourceq\x07U\x16testsource.testchannelq\x08'
+            'U\x06_groupq\tU\x06group1q\nU\x02idq\x0bU c4ca4238a0b923820dcc509a6f75849bq\x0c'
+            'U\x04timeq\rU\x132017-06-01 07:00:00q\x0euU\x05groupq\x0fh\nU\x05untilq\x10'
+            'cdatetime\ndatetime\nq\x11U\n\x07\xe1\x06\x01\t\x00\x00\x00\x00{\x85Rq\x12'
+            'U\x05firstq\x13h\x11U\n\x07\xe1\x06\x01\x07\x00\x00\x00\x00\x00\x85Rq\x14ub.'
+        )).label('protocol 2'),
+    ]
+
+    def _assert_sample_state(self, hifreq_data):
+        self.assertEqual(hifreq_data.group, 'group1')
+        self.assertEqual(hifreq_data.first, datetime.datetime(2017, 6, 1, 7))
+        self.assertEqual(hifreq_data.until, datetime.datetime(2017, 6, 1, 9, 0, 0, 123))
+        self.assertEqual(hifreq_data.count, 5)
+        self.assertEqual(hifreq_data.payload, self.sample_payload)
+
+    def test_attributes(self):
+        hifreq_data = HiFreqEventData(self.sample_payload)
+        self.assertEqual(hifreq_data.first, datetime.datetime(2017, 6, 1, 7))
+        self.assertEqual(hifreq_data.until, datetime.datetime(2017, 6, 1, 7))
+        self.assertEqual(hifreq_data.count, 1)
+        hifreq_data.until = datetime.datetime(2017, 6, 1, 9, 0, 0, 123)
+        hifreq_data.count = 5
+        self._assert_sample_state(hifreq_data)
+        self.assertFalse(hasattr(hifreq_data, '__dict__'))
+
+    def test_payload_is_stored_as_a_copy(self):
+        payload = dict(self.sample_payload)
+        hifreq_data = HiFreqEventData(payload)
+        payload['id'] = 'c4ca4238a0b923820dcc509a6f758400'
+        hifreq_data.payload['id'] = 'c4ca4238a0b923820dcc509a6f758401'
+        self.assertEqual(hifreq_data.payload, self.sample_payload)
+        hifreq_data.update_payload({'id': 'c4ca4238a0b923820dcc509a6f758402'})
+        self.assertEqual(hifreq_data.payload['id'], 'c4ca4238a0b923820dcc509a6f758402')
+
+    def test_to_dict(self):
+        hifreq_data = HiFreqEventData(self.sample_payload)
+        hifreq_data.until = datetime.datetime(2017, 6, 1, 9)
+        hifreq_data.count = 5
+        expected = dict(self.sample_payload,
+                        count=5,
+                        until='2017-06-01 09:00:00',
+                        _first_time='2017-06-01 07:00:00')
+        self.assertEqual(hifreq_data.to_dict(), expected)
+        self.assertEqual(hifreq_data.payload, self.sample_payload)
+
+    @foreach(0, 2)
+    def test_pickle_roundtrip(self, protocol):
+        hifreq_data = HiFreqEventData(self.sample_payload)
+        hifreq_data.until = datetime.datetime(2017, 6, 1, 9, 0, 0, 123)
+        hifreq_data.count = 5
+        self._assert_sample_state(cPickle.loads(cPickle.dumps(hifreq_data, protocol)))
+
+    @foreach(legacy_pickles)
+    def test_unpickling_legacy_state(self, pickled):
+        self._assert_sample_state(cPickle.loads(pickled))
+
+
+
 class TestAggregatorData(unittest.TestCase):
 
     sample_source = 'testsource.testchannel'
@@ -1566,3 +1691,174 @@ class TestAggregatorData(unittest.TestCase):
         self.assertEqual(self.groups_hifreq_data, source_data.groups['group1'])
         self.assertEqual(self.buffer_hifreq_data, source_data.buffer['group1'])
         self.assertIs(source_data, self._aggregator_data.sources[self.sample_source])
+
+
+
+class TestAggregatorDataWrapperStatePersistence(unittest.TestCase):
+
+    sample_time_tolerance = 600
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._tmp_dir)
+        self._dbpath = os.path.join(self._tmp_dir, 'aggregator.pickle')
+        self._published_events = []
+        self._event_number = 0
+
+    def _make_aggregator(self, **kwargs):
+        aggregator = Aggregator.__new__(Aggregator)
+        aggregator.db = AggregatorDataWrapper(self._dbpath, self.sample_time_tolerance, **kwargs)
+        aggregator.publish_event = self._published_events.append
+        return aggregator
+
+    def _process(self, aggregator, source, group, time):
+        self._event_number += 1
+        data = {
+            'id': '{:032x}'.format(self._event_number),
+            'source': source,
+            '_group': group,
+            'time': time,
+        }
+        try:
+            aggregator.process_event(data)
+        except n6QueueProcessingException:
+            pass
+
+    def _process_sample_events(self, aggregator):
+        for source, group, time in [
+                ('testsource.testchannel', 'group1', '2017-06-01 07:00:00'),
+                ('testsource.testchannel', 'group2', '2017-06-01 07:10:00'),
+                ('testsource.testchannel', 'group1', '2017-06-01 07:20:00'),
+                ('othersource.otherchannel', 'group1', '2017-06-01 08:00:00'),
+                ('testsource.testchannel', 'group1', '2017-06-01 06:00:00'),  # (out of order)
+                ('testsource.testchannel', 'group2', '2017-06-01 20:00:00'),
+                ('othersource.otherchannel', 'group1', '2017-06-01 08:05:00'),
+                ('testsource.testchannel', 'group1', '2017-06-02 00:30:00'),
+                ('testsource.testchannel', 'group3', '2017-06-02 00:35:00')]:
+            self._process(aggregator, source, group, time)
+
+    @staticmethod
+    def _get_state(aggregator):
+        def hifreq_items(hifreq_data_dict):
+            return [(key, v.payload, v.first, v.until, v.count)
+                    for key, v in hifreq_data_dict.iteritems()]
+        return {
+            source: (sd.time, sd.last_event, sd.time_tolerance,
+                     hifreq_items(sd.groups), hifreq_items(sd.buffer))
+            for source, sd in aggregator.db.aggr_data.sources.iteritems()}
+
+    def test_state_restored_from_log_after_crash(self):
+        aggregator = self._make_aggregator()
+        self._process_sample_events(aggregator)
+        expected_state = self._get_state(aggregator)
+        self.assertTrue(expected_state)
+        self.assertFalse(os.path.exists(self._dbpath))
+        # (no stop() -- simulating a crash)
+        restarted = self._make_aggregator()
+        self.assertEqual(self._get_state(restarted), expected_state)
+        self.assertEqual(restarted.db.state_log.record_count, 8)
+
+    def test_state_restored_from_snapshot_and_log_after_crash(self):
+        aggregator = self._make_aggregator(state_log_max_records=3)
+        self._process_sample_events(aggregator)
+        expected_state = self._get_state(aggregator)
+        self.assertTrue(os.path.exists(self._dbpath))
+        self.assertEqual(aggregator.db.state_log.record_count, 2)
+        restarted = self._make_aggregator(state_log_max_records=3)
+        self.assertEqual(self._get_state(restarted), expected_state)
+        self.assertEqual(restarted.db.aggr_data.state_log_seq, 8)
+
+    def test_log_records_already_in_snapshot_are_not_replayed(self):
+        aggregator = self._make_aggregator()
+        self._process_sample_events(aggregator)
+        expected_state = self._get_state(aggregator)
+        # (simulating a crash just after storing a snapshot, before clearing the log)
+        with patch.object(aggregator.db.state_log, 'clear'):
+            aggregator.db.store_state()
+        restarted = self._make_aggregator()
+        self.assertEqual(self._get_state(restarted), expected_state)
+
+    def test_inactive_sources_cleanup_restored_after_crash(self):
+        aggregator = self._make_aggregator()
+        self._process_sample_events(aggregator)
+        inactive_sd = aggregator.db.aggr_data.sources['testsource.testchannel']
+        inactive_sd.last_event -= datetime.timedelta(days=2)
+        list(aggregator.db.generate_suppresed_events_after_timeout())
+        self.assertFalse(inactive_sd.groups)
+        expected_state = self._get_state(aggregator)
+        restarted = self._make_aggregator()
+        self.assertEqual(self._get_state(restarted), expected_state)
+
+    def test_corrupt_snapshot_with_nonempty_log(self):
+        aggregator = self._make_aggregator()
+        self._process_sample_events(aggregator)
+        aggregator.db.store_state()
+        inactive_sd = aggregator.db.aggr_data.sources['othersource.otherchannel']
+        inactive_sd.last_event -= datetime.timedelta(days=2)
+        list(aggregator.db.generate_suppresed_events_after_timeout())
+        self._process(aggregator, 'testsource.testchannel', 'group4', '2017-06-02 00:40:00')
+        aggregator.db.sync_state()
+        with open(self._dbpath, 'wb') as f:
+            f.write('corrupted\x00')
+        restarted = self._make_aggregator()
+        self.assertEqual(self._get_state(restarted), {})
+        self.assertEqual(restarted.db.aggr_data.state_log_seq, 0)
+        self.assertEqual(restarted.db.state_log.record_count, 0)
+        [moved_snapshot_path] = glob.glob(self._dbpath + '.unrestorable-*')
+        [moved_log_path] = glob.glob(self._dbpath + '.log.unrestorable-*')
+        self.assertEqual(moved_log_path,
+                         self._dbpath + '.log' + moved_snapshot_path[len(self._dbpath):])
+        with open(moved_snapshot_path, 'rb') as f:
+            self.assertEqual(f.read(), 'corrupted\x00')
+        self.assertEqual(len(list(AppendOnlyRecordLog(moved_log_path).iter_records())), 2)
+        # (the restarted aggregator works normally)
+        self._process(restarted, 'testsource.testchannel', 'group1', '2017-06-02 00:45:00')
+        expected_state = self._get_state(restarted)
+        self.assertEqual(list(expected_state), ['testsource.testchannel'])
+        self.assertEqual(self._get_state(self._make_aggregator()), expected_state)
+
+    def test_inactive_source_unknown_to_restored_state_is_skipped(self):
+        aggregator = self._make_aggregator()
+        self._process_sample_events(aggregator)
+        aggregator.db.store_state()
+        inactive_sd = aggregator.db.aggr_data.sources['othersource.otherchannel']
+        inactive_sd.last_event -= datetime.timedelta(days=2)
+        list(aggregator.db.generate_suppresed_events_after_timeout())
+        aggregator.db.sync_state()
+        os.remove(self._dbpath)   # (e.g., removed by the admin)
+        restarted = self._make_aggregator()
+        self.assertEqual(self._get_state(restarted), {})
+        self.assertEqual(restarted.db.aggr_data.state_log_seq, 9)
+
+    def test_idle_tick_syncs_state_log(self):
+        aggregator = self._make_aggregator(state_log_fsync_interval=3600)
+        aggregator._connection = MagicMock()
+        with patch('n6lib.persistence_helpers.os.fsync') as fsync_mock:
+            self._process_sample_events(aggregator)
+            self.assertEqual(fsync_mock.mock_calls, [])
+            aggregator.on_timeout()
+            fsync_mock.assert_called_once_with(aggregator.db.state_log._file.fileno())
+            aggregator.on_timeout()
+            self.assertEqual(len(fsync_mock.mock_calls), 1)
+        self.assertEqual(aggregator._connection.add_timeout.call_count, 2)
+
+    def test_stop_and_restart(self):
+        aggregator = self._make_aggregator()
+        self._process_sample_events(aggregator)
+        expected_state = self._get_state(aggregator)
+        aggregator.db.sync_state()
+        self._process(aggregator, 'testsource.testchannel', 'group1', '2017-06-01 00:00:00')
+        restarted = self._make_aggregator()
+        self.assertEqual(self._get_state(restarted), expected_state)
+
+    def test_truncated_log_tail_is_ignored(self):
+        aggregator = self._make_aggregator()
+        self._process_sample_events(aggregator)
+        aggregator.db.sync_state()
+        expected_state = self._get_state(self._make_aggregator())
+        with open(self._dbpath + '.log', 'ab') as f:
+            f.write('\x00\x00\x01')
+        restarted = self._make_aggregator()
+        self.assertEqual(self._get_state(restarted), expected_state)
+        self._process(restarted, 'testsource.testchannel', 'group4', '2017-06-02 00:40:00')
+        self.assertEqual(self._make_aggregator().db.state_log.record_count, 9)
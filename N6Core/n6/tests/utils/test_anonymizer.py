@@ -23,7 +23,10 @@ from unittest_expander import (
 from n6.utils.anonymizer import Anonymizer
 from n6lib.const import TYPE_ENUMS
 from n6lib.data_spec import N6DataSpec
-from n6lib.db_filtering_abstractions import RecordFacadeForPredicates
+from n6lib.db_filtering_abstractions import (
+    PredicateIndex,
+    RecordFacadeForPredicates,
+)
 from n6lib.unit_test_helpers import TestCaseMixin, MethodProxy
 from n6sdk.exceptions import (
     ResultKeyCleaningError,
@@ -368,6 +371,18 @@ class TestAnonymizer___get_resource_to_org_ids(TestCaseMixin, unittest.TestCase)
                 },
             }
 
+        def make_predicate_indexes():
+            # (here the predicates are plain functions, so
+            # all subsources are always index candidates)
+            return {
+                source_id: PredicateIndex({
+                    subsource_refint: predicate
+                    for subsource_refint, (predicate, _) in subsource_to_saai.iteritems()})
+                for source_id, subsource_to_saai in self.s_to_s_to_saai.iteritems()}
+
+        self.mock.auth_api.get_source_ids_to_stream_api_predicate_indexes.side_effect = \
+            make_predicate_indexes
+
 
     @foreach(
         param(
@@ -433,8 +448,13 @@ class TestAnonymizer___get_resource_to_org_ids(TestCaseMixin, unittest.TestCase)
     )
     def test_normal(self, event_data, expected_result):
         expected_mock_calls = [
+            call.auth_api.__enter__(),
             call.auth_api.get_source_ids_to_subs_to_stream_api_access_infos(),
         ]
+        if self.s_to_s_to_saai.get(event_data['source']):
+            expected_mock_calls.append(
+                call.auth_api.get_source_ids_to_stream_api_predicate_indexes())
+        expected_mock_calls.append(call.auth_api.__exit__(None, None, None))
 
         with patch('n6.utils.anonymizer.LOGGER') as LOGGER_mock:
             result = self.meth._get_resource_to_org_ids(self.event_type, event_data)
@@ -466,6 +486,46 @@ class TestAnonymizer___get_resource_to_org_ids(TestCaseMixin, unittest.TestCase)
         self.assertEqual(len(LOGGER_mock.error.mock_calls), 1)
 
 
+    def test_auth_api_data_not_refreshed_between_calls(self):
+        # the Auth API data (LDAP root node) are refreshed just after
+        # the first call -- unless the Auth API context is entered
+        s_to_s_to_saai_1 = self.s_to_s_to_saai
+        s_to_s_to_saai_2 = {'src.empty': {}}
+        current = [s_to_s_to_saai_1]
+        entered = [0]
+        def get_access_infos():
+            result = current[0]
+            if not entered[0]:
+                current[0] = s_to_s_to_saai_2
+            return result
+        def get_predicate_indexes():
+            self.s_to_s_to_saai = current[0]
+            return make_predicate_indexes()
+        make_predicate_indexes = (
+            self.mock.auth_api.get_source_ids_to_stream_api_predicate_indexes.side_effect)
+        self.mock.auth_api.get_source_ids_to_subs_to_stream_api_access_infos.side_effect = \
+            get_access_infos
+        self.mock.auth_api.get_source_ids_to_stream_api_predicate_indexes.side_effect = \
+            get_predicate_indexes
+        self.mock.auth_api.__enter__.side_effect = lambda: entered.__setitem__(0, entered[0] + 1)
+        self.mock.auth_api.__exit__.side_effect = (
+            lambda *_: entered.__setitem__(0, entered[0] - 1))
+        event_data = dict(
+            source='src.some-2',
+            client=['o5', 'o1', 'o3', 'o2'],
+        )
+
+        with patch('n6.utils.anonymizer.LOGGER') as LOGGER_mock:
+            result = self.meth._get_resource_to_org_ids(self.event_type, event_data)
+
+        self.assertEqual(result, dict(
+            inside=['o1', 'o2', 'o3'],
+            threats=['o2', 'o3', 'o5', 'o6', 'o8'],
+        ))
+        self.assertFalse(LOGGER_mock.error.mock_calls)
+        self.assertEqual(entered, [0])
+
+
 
 @expand
 class TestAnonymizer___get_result_dicts_and_output_body(TestCaseMixin, unittest.TestCase):
@@ -746,6 +806,8 @@ class TestAnonymizer___publish_output_data(TestCaseMixin, unittest.TestCase):
         }
         self.mock = MagicMock(__class__=Anonymizer)
         self.meth = MethodProxy(Anonymizer, self.mock, 'OUTPUT_RK_PATTERN')
+        self.mock._get_output_properties.side_effect = (
+            lambda org_id: getattr(sen, 'properties_' + org_id))
 
 
     @foreach(
@@ -758,27 +820,27 @@ class TestAnonymizer___publish_output_data(TestCaseMixin, unittest.TestCase):
                 call(
                     routing_key='inside.bots.hidden.42',
                     body=sen.output_body,
-                    prop_kwargs={'headers': {'n6-client-id': 'o3'}},
+                    properties=sen.properties_o3,
                 ),
                 call(
                     routing_key='inside.bots.hidden.42',
                     body=sen.output_body,
-                    prop_kwargs={'headers': {'n6-client-id': 'o2'}},
+                    properties=sen.properties_o2,
                 ),
                 call(
                     routing_key='threats.bots.hidden.42',
                     body=sen.output_body,
-                    prop_kwargs={'headers': {'n6-client-id': 'o8'}},
+                    properties=sen.properties_o8,
                 ),
                 call(
                     routing_key='threats.bots.hidden.42',
                     body=sen.output_body,
-                    prop_kwargs={'headers': {'n6-client-id': 'o5'}},
+                    properties=sen.properties_o5,
                 ),
                 call(
                     routing_key='threats.bots.hidden.42',
                     body=sen.output_body,
-                    prop_kwargs={'headers': {'n6-client-id': 'o3'}},
+                    properties=sen.properties_o3,
                 ),
             ],
         ).label('for both resources'),
@@ -791,12 +853,12 @@ class TestAnonymizer___publish_output_data(TestCaseMixin, unittest.TestCase):
                 call(
                     routing_key='inside.bots.hidden.42',
                     body=sen.output_body,
-                    prop_kwargs={'headers': {'n6-client-id': 'o3'}},
+                    properties=sen.properties_o3,
                 ),
                 call(
                     routing_key='inside.bots.hidden.42',
                     body=sen.output_body,
-                    prop_kwargs={'headers': {'n6-client-id': 'o2'}},
+                    properties=sen.properties_o2,
                 ),
             ],
         ).label('for "inside" only'),
@@ -809,17 +871,17 @@ class TestAnonymizer___publish_output_data(TestCaseMixin, unittest.TestCase):
                 call(
                     routing_key='threats.bots.hidden.42',
                     body=sen.output_body,
-                    prop_kwargs={'headers': {'n6-client-id': 'o8'}},
+                    properties=sen.properties_o8,
                 ),
                 call(
                     routing_key='threats.bots.hidden.42',
                     body=sen.output_body,
-                    prop_kwargs={'headers': {'n6-client-id': 'o5'}},
+                    properties=sen.properties_o5,
                 ),
                 call(
                     routing_key='threats.bots.hidden.42',
                     body=sen.output_body,
-                    prop_kwargs={'headers': {'n6-client-id': 'o3'}},
+                    properties=sen.properties_o3,
                 ),
             ],
         ).label('for "threats" only'),
@@ -855,17 +917,17 @@ class TestAnonymizer___publish_output_data(TestCaseMixin, unittest.TestCase):
             call(
                 routing_key='inside.bots.hidden.42',
                 body=sen.output_body,
-                prop_kwargs={'headers': {'n6-client-id': 'o3'}},
+                properties=sen.properties_o3,
             ),
             call(
                 routing_key='inside.bots.hidden.42',
                 body=sen.output_body,
-                prop_kwargs={'headers': {'n6-client-id': 'o2'}},
+                properties=sen.properties_o2,
             ),
             call(
                 routing_key='threats.bots.hidden.42',
                 body=sen.output_body,
-                prop_kwargs={'headers': {'n6-client-id': 'o8'}},
+                properties=sen.properties_o8,
             ),
         ]
         exc_type = ZeroDivisionError  # (just an example exception class)
@@ -909,5 +971,25 @@ class TestAnonymizer___publish_output_data(TestCaseMixin, unittest.TestCase):
 
 
 
+class TestAnonymizer___get_output_properties(unittest.TestCase):
+
+    def setUp(self):
+        self.mock = MagicMock(__class__=Anonymizer)
+        self.mock._org_id_to_output_properties = {}
+        self.mock.make_output_properties.side_effect = [sen.properties_o1, sen.properties_o2]
+        self.meth = MethodProxy(Anonymizer, self.mock)
+
+    def test(self):
+        self.assertIs(self.meth._get_output_properties('o1'), sen.properties_o1)
+        self.assertIs(self.meth._get_output_properties('o2'), sen.properties_o2)
+        self.assertIs(self.meth._get_output_properties('o1'), sen.properties_o1)
+        self.assertIs(self.meth._get_output_properties('o2'), sen.properties_o2)
+        self.assertEqual(self.mock.make_output_properties.mock_calls, [
+            call({'headers': {'n6-client-id': 'o1'}}),
+            call({'headers': {'n6-client-id': 'o2'}}),
+        ])
+
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -2,21 +2,35 @@
 
 # Copyright (c) 2013-2018 NASK. All rights reserved.
 
+import datetime
+import os
+import os.path
+import shutil
+import tempfile
 import unittest
 import json
+import cPickle
 
 from mock import (
     MagicMock,
     call,
     sentinel as sen,
 )
+from unittest_expander import (
+    expand,
+    foreach,
+    param,
+)
 
 from n6.utils.comparator import (
+    BlackListData,
     Comparator,
     ComparatorData,
     ComparatorDataWrapper,
     ComparatorState,
+    SourceData,
 )
+from n6lib.datetime_helpers import parse_iso_datetime_to_utc
 from n6lib.unit_test_helpers import TestCaseMixin
 
 
@@ -503,3 +517,354 @@ class TestComparator__message_flow(TestCaseMixin, unittest.TestCase):
             new_body = json.loads(call_kwargs['body'])
             deserialized_call_list.append(call(body=new_body, routing_key=call_kwargs['routing_key']))
         return deserialized_call_list
+
+
+class TestComparator__series_timeouts(TestCaseMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.time = 1000.0
+        self.comparator = Comparator.__new__(Comparator)
+        self.comparator.comparator_config = {'series_timeout': '100'}
+        self.comparator._connection = MagicMock()
+        self.comparator.state = ComparatorState(sen.irrelevant, time_func=lambda: self.time)
+        self.patch_object(ComparatorDataWrapper, 'store_state')
+        self.comparator.db = ComparatorDataWrapper.__new__(ComparatorDataWrapper)
+        self.comparator.db.comp_data = ComparatorData()
+        self.comparator.publish_output = MagicMock()
+
+    def _process_input(self, series_id, series_no, ip):
+        self.comparator._process_input({
+            '_bl-time': '2017-01-19 12:00:00',
+            '_bl-series-total': 3,
+            '_bl-series-no': series_no,
+            '_bl-series-id': series_id,
+            'expires': '2017-01-20 15:15:15',
+            'address': [{'ip': ip}],
+            'source': 'source.channel',
+            'id': ip.replace('.', '') * 4,
+        })
+
+    def test_no_timeouts_set_per_message(self):
+        self.comparator.start_publishing()
+        self.assertEqual(self.comparator._connection.add_timeout.mock_calls, [
+            call(10, self.comparator.check_series_timeouts),
+        ])
+        for series_no, ip in enumerate(['1.1.1.1', '2.2.2.2', '3.3.3.3'], 1):
+            self._process_input('a', series_no, ip)
+        self.assertEqual(self.comparator._connection.add_timeout.call_count, 1)
+        self.assertFalse(self.comparator._connection.remove_timeout.called)
+        self.assertEqual(self.comparator.state.open_series, {})
+
+    def test_series_timeout(self):
+        self._process_input('a', 1, '1.1.1.1')
+        self.time += 60
+        self._process_input('a', 2, '2.2.2.2')
+        self._process_input('b', 1, '3.3.3.3')
+        self.time += 99
+        self.comparator.check_series_timeouts()
+        self.assertEqual(sorted(self.comparator.state.open_series), ['a', 'b'])
+        source_data = self.comparator.db.comp_data.sources['source.channel']
+        self.assertEqual(source_data.flags, {('1.1.1.1',): 'a',
+                                             ('2.2.2.2',): 'a',
+                                             ('3.3.3.3',): 'b'})
+        self.time += 1
+        self.comparator.check_series_timeouts()
+        self.assertEqual(self.comparator.state.open_series, {})
+        self.assertEqual(source_data.flags, {})
+        self.assertEqual(self.comparator._connection.add_timeout.call_count, 2)
+        self.assertEqual(self.comparator.timeout_id,
+                         self.comparator._connection.add_timeout.return_value)
+
+    def test_check_interval_not_longer_than_series_timeout(self):
+        self.comparator.comparator_config['series_timeout'] = '3'
+        self.comparator.set_timeout()
+        self.assertEqual(self.comparator._connection.add_timeout.mock_calls, [
+            call(3, self.comparator.check_series_timeouts),
+        ])
+
+    def test_add_open_series_from_older_version(self):
+        self.comparator.state.add_open_series({
+            'a': {
+                'total': 3,
+                'timeout-id': None,
+                'msg-count': 1,
+                'msg-nums': [1],
+                'msg-ids': ['11111111111111111111111111111111'],
+                'source': 'source.channel',
+            },
+        })
+        self.assertEqual(self.comparator.state.open_series, {
+            'a': {
+                'total': 3,
+                'last-seen': 1000.0,
+                'msg-count': 1,
+                'msg-nums': {1},
+                'msg-ids': ['11111111111111111111111111111111'],
+                'source': 'source.channel',
+            },
+        })
+        self._process_input('a', 2, '2.2.2.2')
+        self._process_input('a', 3, '3.3.3.3')
+        self.assertEqual(self.comparator.state.open_series, {})
+
+
+class TestComparatorDataWrapper__persistence(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.dbpath = os.path.join(self.tmp_dir, 'comparator_db.pickle')
+        self.sources_dirpath = self.dbpath + '.sources'
+
+    def _process_series(self, db, source, series_id, ips):
+        for ip in ips:
+            db.process_new_message({
+                '_bl-time': '2017-01-19 12:00:00',
+                '_bl-series-id': series_id,
+                'expires': '2017-01-20 15:15:15',
+                'address': [{'ip': ip}],
+                'source': source,
+                'id': ip.replace('.', '') * 4,
+            })
+        list(db.process_deleted(source))
+
+    def _get_stored_files(self):
+        return sorted(os.listdir(self.sources_dirpath))
+
+    def test_only_finished_source_is_stored(self):
+        db = ComparatorDataWrapper(self.dbpath)
+        db.process_new_message({
+            '_bl-time': '2017-01-19 12:00:00',
+            '_bl-series-id': 'x',
+            'expires': '2017-01-20 15:15:15',
+            'address': [{'ip': '9.9.9.9'}],
+            'source': 'source.unfinished',
+            'id': '9' * 32,
+        })
+        self._process_series(db, 'source.one', 'a', ['1.1.1.1', '2.2.2.2'])
+        self.assertEqual(self._get_stored_files(), ['source.one.pickle'])
+        self.assertEqual(db.dirty_source_names, {'source.unfinished'})
+        os.utime(os.path.join(self.sources_dirpath, 'source.one.pickle'), (0, 0))
+        self._process_series(db, 'source.two', 'b', ['3.3.3.3'])
+        self.assertEqual(self._get_stored_files(), ['source.one.pickle', 'source.two.pickle'])
+        self.assertEqual(
+            os.path.getmtime(os.path.join(self.sources_dirpath, 'source.one.pickle')), 0)
+        db.store_state()
+        self.assertEqual(self._get_stored_files(),
+                         ['source.one.pickle', 'source.two.pickle', 'source.unfinished.pickle'])
+        self.assertFalse(db.dirty_source_names)
+
+    def test_sources_loaded_lazily(self):
+        db = ComparatorDataWrapper(self.dbpath)
+        self._process_series(db, 'source.one', 'a', ['1.1.1.1', '2.2.2.2'])
+        self._process_series(db, 'source.two', 'b', ['3.3.3.3'])
+        restarted = ComparatorDataWrapper(self.dbpath)
+        self.assertEqual(restarted.comp_data.sources, {})
+        source_data = restarted.get_sourcedata('source.two')
+        self.assertIsInstance(source_data, SourceData)
+        self.assertEqual(list(restarted.comp_data.sources), ['source.two'])
+        self.assertEqual(sorted(source_data.blacklist), [('3.3.3.3',)])
+        self.assertIs(restarted.get_sourcedata('source.two'), source_data)
+        self.assertEqual(sorted(restarted.get_sourcedata('source.one').blacklist),
+                         [('1.1.1.1',), ('2.2.2.2',)])
+        self.assertEqual(restarted.get_sourcedata('source.new').blacklist, {})
+
+    def test_legacy_state_migrated(self):
+        legacy_db = ComparatorDataWrapper.__new__(ComparatorDataWrapper)
+        legacy_db.comp_data = legacy_comp_data = ComparatorData()
+        self._process_series(legacy_db, 'source.one', 'a', ['1.1.1.1'])
+        legacy_source_data = legacy_comp_data.sources['source.one']
+        with open(self.dbpath, 'wb') as f:
+            cPickle.dump(legacy_comp_data, f)
+        db = ComparatorDataWrapper(self.dbpath)
+        self.assertFalse(os.path.exists(self.dbpath))
+        self.assertTrue(os.path.exists(self.dbpath + '.migrated'))
+        self.assertEqual(self._get_stored_files(), ['source.one.pickle'])
+        restarted = ComparatorDataWrapper(self.dbpath)
+        self.assertEqual(sorted(restarted.get_sourcedata('source.one').blacklist),
+                         sorted(legacy_source_data.blacklist))
+        self.assertEqual(db.dirty_source_names, set())
+
+    def test_storing_suspended(self):
+        db = ComparatorDataWrapper(self.dbpath)
+        db.suspend_storing_state()
+        self._process_series(db, 'source.one', 'a', ['1.1.1.1'])
+        db.store_state()
+        self.assertEqual(self._get_stored_files(), [])
+        self.assertEqual(db.dirty_source_names, {'source.one'})
+        db.resume_storing_state()
+        self.assertEqual(self._get_stored_files(), ['source.one.pickle'])
+
+
+class TestBlackListData(unittest.TestCase):
+
+    sample_payload = {
+        '_bl-series-id': '11111111111111111111111111111111',
+        '_bl-series-no': 1,
+        '_bl-series-total': 2,
+        '_bl-time': '2017-01-19 12:07:32',
+        'expires': '2017-01-20 15:15:15',
+        'address': [{'ip': '2.2.2.2', 'cc': 'XX'}, {'ip': '1.1.1.1'}],
+        'source': 'source.channel',
+        'id': '9104c0ad2339d9ab98f08761e7168ebd',
+    }
+
+    def test_attributes_and_payload(self):
+        event = BlackListData(self.sample_payload)
+        self.assertEqual(event.id, '9104c0ad2339d9ab98f08761e7168ebd')
+        self.assertEqual(event.expires, datetime.datetime(2017, 1, 20, 15, 15, 15))
+        expected_payload = {k: v for k, v in self.sample_payload.iteritems()
+                            if not k.startswith('_bl-series')}
+        self.assertEqual(event.payload, expected_payload)
+        self.assertIsNot(event.payload, event.payload)
+        event.update_payload({'expires': '2017-01-21 15:15:15'})
+        self.assertEqual(event.payload, dict(expected_payload, expires='2017-01-21 15:15:15'))
+        self.assertFalse(hasattr(event, '__dict__'))
+
+    def test_ips_digest(self):
+        digest = BlackListData(self.sample_payload).ips_digest
+        self.assertIsInstance(digest, str)
+        self.assertEqual(
+            BlackListData.get_ips_digest({'address': [{'ip': u'1.1.1.1'}, {'ip': u'2.2.2.2'}]}),
+            digest)
+        self.assertNotEqual(
+            BlackListData.get_ips_digest({'address': [{'ip': '1.1.1.1'}]}),
+            digest)
+        self.assertNotEqual(
+            BlackListData.get_ips_digest({'address': [{'ip': '1.1.1.1'}, {'ip': '2.2.2.22'}]}),
+            digest)
+        self.assertIsNone(BlackListData.get_ips_digest({'url': 'http://www.example.com'}))
+        self.assertIsNone(BlackListData.get_ips_digest({'address': []}))
+
+    def test_pickling(self):
+        event = BlackListData(self.sample_payload)
+        restored = cPickle.loads(cPickle.dumps(event, cPickle.HIGHEST_PROTOCOL))
+        self.assertEqual((restored.id, restored.ips_digest, restored.expires, restored.payload),
+                         (event.id, event.ips_digest, event.expires, event.payload))
+
+
+@expand
+class TestSourceData(unittest.TestCase):
+
+    # pickled by the version of `SourceData` that kept the flags as
+    # attributes of `BlackListData` instances (which kept all their
+    # attributes in the instance's `__dict__`)
+    legacy_pickles = [
+        param(pickled=(
+            "ccopy_reg\n_reconstructor\np1\n(cn6.utils.comparator\nSourceData\np2\nc__builtin"
+            "__\nobject\np3\nNtRp4\n(dp5\nS'blacklist'\np6\n(dp7\n(S'1.1.1.1'\np8\ntp9\ng1"
+            "\n(cn6.utils.comparator\nBlackListData\np10\ng3\nNtRp11\n(dp12\nS'url'\np13\nNsS"
+            "'ip'\np14\n(lp15\ng8\nasS'expires'\np16\ncdatetime\ndatetime\np17\n(S'\\x07\\xe1"
+            "\\x01\\x14\\x0f\\x0f\\x0f\\x00\\x00\\x00'\ntRp18\nsS'fqdn'\np19\nNsS'payload'"
+            "\np20\n(dp21\nS'_bl-series-id'\np22\nS'a'\nsS'_bl-time'\np23\nS'2017-01-19 12:00"
+            ":00'\np24\nsS'source'\np25\nS'source.channel'\np26\nsg16\nS'2017-01-20 15:15:15'"
+            "\np27\nsS'id'\np28\nS'1111111111111111'\np29\nsS'address'\np30\n(lp31\n(dp32\ng1"
+            "4\ng8\nsassg25\ng26\nsS'flag'\np33\nS'b'\nsg28\ng29\nsbs(S'2.2.2.2'\np34\ntp35"
+            "\ng1\n(g10\ng3\nNtRp36\n(dp37\ng13\nNsg14\n(lp38\ng34\nasg16\ng17\n(S'\\x07\\xe1"
+            "\\x01\\x14\\x0f\\x0f\\x0f\\x00\\x00\\x00'\ntRp39\nsg19\nNsg20\n(dp40\ng22\nS'a'"
+            "\nsg23\ng24\nsg25\ng26\nsg16\ng27\nsg28\nS'2222222222222222'\np41\nsg30\n(lp42"
+            "\n(dp43\ng14\ng34\nsassg25\ng26\nsg33\nNsg28\ng41\nsbssS'last_event'\np44\ng17"
+            "\n(S'\\x07\\xe1\\x01\\x13\\x0c\\x1e\\x00\\x00\\x00\\x00'\ntRp45\nsS'time'\np46"
+            "\ng17\n(S'\\x07\\xe1\\x01\\x13\\x0c\\x00\\x00\\x00\\x00\\x00'\ntRp47\nsb.")).label('protocol 0'),
+        param(pickled=(
+            '\x80\x02cn6.utils.comparator\nSourceData\nq\x01)\x81q\x02}q\x03(U\tblacklistq'
+            '\x04}q\x05(U\x071.1.1.1q\x06\x85cn6.utils.comparator\nBlackListData\nq\x07)\x81q'
+            '\x08}q\t(U\x03urlq\nNU\x02ipq\x0b]q\x0ch\x06aU\x07expiresq\rcdatetime\ndatetime'
+            '\nq\x0eU\n\x07\xe1\x01\x14\x0f\x0f\x0f\x00\x00\x00\x85Rq\x0fU\x04fqdnq\x10NU\x07'
+            'payloadq\x11}q\x12(U\r_bl-series-idq\x13U\x01aU\x08_bl-timeq\x14U\x132017-01-19 '
+            '12:00:00q\x15U\x06sourceq\x16U\x0esource.channelq\x17h\rU\x132017-01-20 15:15:15'
+            'q\x18U\x02idq\x19U\x101111111111111111q\x1aU\x07addressq\x1b]q\x1c}q\x1dh\x0bh'
+            '\x06sauh\x16h\x17U\x04flagq\x1eU\x01bh\x19h\x1aubU\x072.2.2.2q\x1f\x85h\x07)\x81'
+            'q }q!(h\nNh\x0b]q"h\x1fah\rh\x0eU\n\x07\xe1\x01\x14\x0f\x0f\x0f\x00\x00\x00\x85R'
+            'q#h\x10Nh\x11}q$(h\x13U\x01ah\x14h\x15h\x16h\x17h\rh\x18h\x19U\x1022222222222222'
+            '22q%h\x1b]q&}q\'h\x0bh\x1fsauh\x16h\x17h\x1eNh\x19h%ubuU\nlast_eventq(h\x0eU\n'
+            '\x07\xe1\x01\x13\x0c\x1e\x00\x00\x00\x00\x85Rq)U\x04timeq*h\x0eU\n\x07\xe1\x01'
+            '\x13\x0c\x00\x00\x00\x00\x00\x85Rq+ub.')).label('protocol 2'),
+    ]
+
+    def setUp(self):
+        self.source_data = SourceData()
+
+    def _process(self, ip, series_id, expires='2017-01-20 15:15:15',
+                 bl_time='2017-01-19 12:00:00'):
+        result = self.source_data.process_event({
+            '_bl-time': bl_time,
+            '_bl-series-id': series_id,
+            'expires': expires,
+            'address': [{'ip': ip}],
+            'source': 'source.channel',
+            'id': ip.replace('.', '') * 4,
+        })
+        self.source_data.update_time(parse_iso_datetime_to_utc(bl_time))
+        return result
+
+    def _process_deleted(self):
+        return sorted((type_, payload['address'][0]['ip'])
+                      for type_, payload in self.source_data.process_deleted())
+
+    def test_delist_and_expire(self):
+        for ip in ['1.1.1.1', '2.2.2.2', '3.3.3.3', '4.4.4.4']:
+            self._process(ip, 'a')
+        self.assertEqual(self._process_deleted(), [])
+        self.assertEqual(self.source_data.flags, {})
+        self._process('1.1.1.1', 'b', bl_time='2017-01-19 13:00:00')
+        self._process('2.2.2.2', 'b', bl_time='2017-01-19 13:00:00',
+                      expires='2017-01-19 12:30:00')
+        self._process('3.3.3.3', 'b', bl_time='2017-01-19 13:00:00',
+                      expires='2017-01-21 00:00:00')
+        self.assertEqual(sorted(self.source_data.flags),
+                         [('1.1.1.1',), ('2.2.2.2',), ('3.3.3.3',)])
+        self.assertEqual(self._process_deleted(), [('bl-delist', '4.4.4.4'),
+                                                   ('bl-expire', '2.2.2.2')])
+        self.assertEqual(sorted(self.source_data.blacklist), [('1.1.1.1',), ('3.3.3.3',)])
+        self._process('1.1.1.1', 'c', bl_time='2017-01-20 16:00:00')
+        self._process('3.3.3.3', 'c', bl_time='2017-01-20 16:00:00',
+                      expires='2017-01-21 00:00:00')
+        self.assertEqual(self._process_deleted(), [('bl-expire', '1.1.1.1')])
+        self.assertEqual(sorted(self.source_data.blacklist), [('3.3.3.3',)])
+
+    def test_clear_flags(self):
+        self._process('1.1.1.1', 'a')
+        self._process('2.2.2.2', 'a')
+        self._process_deleted()
+        self._process('1.1.1.1', 'b')
+        self._process('2.2.2.2', 'c')
+        self.source_data.clear_flags('b')
+        self.assertEqual(self.source_data.flags, {('2.2.2.2',): 'c'})
+        self.assertEqual(self.source_data._get_unseen_keys(), {('1.1.1.1',)})
+        self.assertEqual(self._process_deleted(), [('bl-delist', '1.1.1.1')])
+
+    def test_expiry_heap_is_not_pickled_and_is_compacted(self):
+        self._process('1.1.1.1', 'a')
+        for i in xrange(1100):
+            self._process('1.1.1.1', 'a',
+                          expires='2017-01-20 15:15:{:02}'.format(i % 60))
+        self.assertLess(len(self.source_data._expiry_heap), 1100)
+        restored = cPickle.loads(cPickle.dumps(self.source_data, cPickle.HIGHEST_PROTOCOL))
+        self.assertNotIn('_expiry_heap', vars(restored))
+        self.assertNotIn('_unseen_keys', vars(restored))
+        self.assertEqual(restored.flags, {('1.1.1.1',): 'a'})
+        self.assertEqual(len(restored._get_expiry_heap()), 1)
+        self.assertEqual(restored._get_unseen_keys(), set())
+
+    @foreach(legacy_pickles)
+    def test_unpickling_legacy_state(self, pickled):
+        source_data = cPickle.loads(pickled)
+        self.assertEqual(source_data.flags, {('1.1.1.1',): 'b'})
+        self.assertEqual(source_data.time, datetime.datetime(2017, 1, 19, 12))
+        self.assertFalse(any(hasattr(event, '_legacy_flag')
+                             for event in source_data.blacklist.itervalues()))
+        event = source_data.blacklist[('1.1.1.1',)]
+        self.assertEqual(event.id, '1111111111111111')
+        self.assertEqual(event.ips_digest, BlackListData.get_ips_digest(event.payload))
+        self.assertEqual(event.expires, datetime.datetime(2017, 1, 20, 15, 15, 15))
+        self.assertEqual(event.payload, {
+            '_bl-time': '2017-01-19 12:00:00',
+            'expires': '2017-01-20 15:15:15',
+            'address': [{'ip': '1.1.1.1'}],
+            'source': 'source.channel',
+            'id': '1111111111111111',
+        })
+        self.source_data = source_data
+        self.assertEqual(self._process('1.1.1.1', 'c'), (None, None))
+        self.assertEqual(self._process_deleted(), [('bl-delist', '2.2.2.2')])
@@ -3,10 +3,15 @@
 import collections
 import cPickle
 import datetime
+import heapq
 import json
 import os
 import os.path
 
+from n6.base.handoff import (
+    StateHandoffError,
+    StateHandoffMixin,
+)
 from n6.base.queue import (
     QueuedBase,
     n6QueueProcessingException,
@@ -14,6 +19,10 @@ from n6.base.queue import (
 from n6lib.config import Config
 from n6lib.datetime_helpers import parse_iso_datetime_to_utc
 from n6lib.log_helpers import get_logger, logging_configured
+from n6lib.persistence_helpers import (
+    AppendOnlyRecordLog,
+    dump_pickle_atomically,
+)
 from n6lib.record_dict import RecordDict
 
 
@@ -27,21 +36,79 @@ AGGREGATE_WAIT = 12
 SOURCE_INACTIVITY_TIMEOUT = 24
 
 # in seconds, tick between checks of inactive sources
-TICK_TIMEOUT = 3600
+# (note: each check is cheap -- only the sources whose inactivity
+# deadlines have passed are examined; see: AggregatorDataWrapper)
+TICK_TIMEOUT = 60
 
 # in seconds
 DEFAULT_TIME_TOLERANCE = 600
 
+# in seconds, max. time between appending to the state log and fsync()
+# (when no further events arrive, the pending fsync() is made on the
+# next tick -- see: TICK_TIMEOUT)
+DEFAULT_STATE_LOG_FSYNC_INTERVAL = 1.0
+
+# number of state log records after which a new snapshot is made
+# (and the log is cleared)
+DEFAULT_STATE_LOG_MAX_RECORDS = 100000
+
 
 class HiFreqEventData(object):
 
+    # Note: there may be very many instances of this class, so -- to
+    # keep the memory footprint small -- `__slots__` are used, times
+    # are stored as integer numbers of microseconds since the epoch,
+    # and the payload is stored pickled (the `until`, `first` and
+    # `payload` properties convert the values on the fly; note that
+    # each `payload` access gives a new dict).
+
+    __slots__ = ('group', '_until', '_first', 'count', '_pickled_payload')
+
     def __init__(self, payload):
         self.group = payload.get("_group")
         self.until = parse_iso_datetime_to_utc(payload.get('time'))
-        self.first = parse_iso_datetime_to_utc(payload.get('time'))
+        self._first = self._until
         self.count = 1  # XXX: see ticket #6243
         self.payload = payload
 
+    def __getstate__(self):
+        return (self.group, self._until, self._first, self.count, self._pickled_payload)
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # an instance pickled by an older version of this class
+            self.group = state['group']
+            self.until = state['until']
+            self.first = state['first']
+            self.count = state['count']
+            self.payload = state['payload']
+        else:
+            self.group, self._until, self._first, self.count, self._pickled_payload = state
+
+    @property
+    def until(self):
+        return _epoch_microseconds_to_datetime(self._until)
+
+    @until.setter
+    def until(self, dt):
+        self._until = _datetime_to_epoch_microseconds(dt)
+
+    @property
+    def first(self):
+        return _epoch_microseconds_to_datetime(self._first)
+
+    @first.setter
+    def first(self, dt):
+        self._first = _datetime_to_epoch_microseconds(dt)
+
+    @property
+    def payload(self):
+        return cPickle.loads(self._pickled_payload)
+
+    @payload.setter
+    def payload(self, payload):
+        self._pickled_payload = cPickle.dumps(payload, cPickle.HIGHEST_PROTOCOL)
+
     def to_dict(self):
         result = self.payload
         result['count'] = self.count
@@ -50,11 +117,24 @@ class HiFreqEventData(object):
         return result
 
     def update_payload(self, update_dict):
-        tmp = self.payload.copy()
+        tmp = self.payload
         tmp.update(update_dict)
         self.payload = tmp
 
 
+# (note: these are bound at import time, not looked up in the
+# `datetime` module's namespace at call time, deliberately)
+_EPOCH = datetime.datetime(1970, 1, 1)
+_ONE_MICROSECOND = datetime.timedelta(microseconds=1)
+
+def _datetime_to_epoch_microseconds(dt):
+    delta = dt - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+def _epoch_microseconds_to_datetime(microseconds):
+    return _EPOCH + _ONE_MICROSECOND * microseconds
+
+
 class SourceData(object):
 
     def __init__(self, time_tolerance):
@@ -171,8 +251,14 @@ class SourceData(object):
 
 class AggregatorData(object):
 
+    # the sequence number of the last state log record whose operation
+    # is already reflected in this object (note: the class attribute
+    # is a default for objects unpickled from older snapshots)
+    state_log_seq = 0
+
     def __init__(self):
         self.sources = {}
+        self.state_log_seq = 0
 
     def get_or_create_sourcedata(self, event, time_tolerance=DEFAULT_TIME_TOLERANCE):
         source = event['source']
@@ -188,27 +274,155 @@ class AggregatorData(object):
 
 class AggregatorDataWrapper(object):
 
-    def __init__(self, dbpath, time_tolerance):
+    """
+    A wrapper of AggregatorData that also takes care of its persistence.
+
+    The state is persisted incrementally: each completed operation
+    (processing of an event -- see: log_processed_event(); or handling
+    an inactive source -- see: generate_suppresed_events_after_timeout())
+    is appended to the state log file (`<dbpath>.log`); then, when the
+    state is being restored, the operations from the log are replayed
+    on the last snapshot (the `dbpath` file).  Every `state_log_max_records`
+    operations a new snapshot is stored and the log is cleared.  If the
+    snapshot exists but cannot be loaded, both files are moved aside
+    (renamed with the `.unrestorable-<UTC timestamp>` suffix) and the
+    state starts empty.
+    """
+
+    # (can be None -- then the state is persisted only by store_state())
+    state_log = None
+
+    # if true, no snapshots are stored (see: Aggregator's state handoff hooks)
+    snapshots_suspended = False
+
+    # if true, another process may still be appending to the state log
+    state_log_shared = False
+
+    # a heap of (<inactivity deadline>, <source name>) pairs -- built
+    # and updated lazily (see: _iter_inactive_sources())
+    _inactivity_deadline_heap = None
+    _sources_with_deadlines = None
+
+    def __init__(self, dbpath, time_tolerance,
+                 state_log_fsync_interval=DEFAULT_STATE_LOG_FSYNC_INTERVAL,
+                 state_log_max_records=DEFAULT_STATE_LOG_MAX_RECORDS,
+                 state_log_shared=False):
         self.aggr_data = None
         self.dbpath = dbpath
         self.time_tolerance = time_tolerance
+        self.state_log_max_records = state_log_max_records
+        self.state_log_shared = state_log_shared
+        state_log_path = self.dbpath + '.log'
         try:
             self.restore_state()
         except:
             LOGGER.error("Error restoring state from: %r", self.dbpath)
             self.aggr_data = AggregatorData()
+            if os.path.exists(self.dbpath):
+                # the state log records refer to the state from the
+                # snapshot that could not be loaded, so they must not
+                # be replayed on the empty state
+                self._move_aside_unrestorable_state(state_log_path)
+        self.state_log = AppendOnlyRecordLog(state_log_path, state_log_fsync_interval)
+        self.replay_state_log()
 
     def store_state(self):
         try:
-            with open(self.dbpath, "w") as f:
-                cPickle.dump(self.aggr_data, f)
-        except IOError:
+            dump_pickle_atomically(self.aggr_data, self.dbpath)
+        except (IOError, OSError):
             LOGGER.error("Error saving state to: %r", self.dbpath)
+        else:
+            if self.state_log is not None:
+                self.state_log.clear()
 
     def restore_state(self):
         with open(self.dbpath, "r") as f:
             self.aggr_data = cPickle.load(f)
 
+    def _move_aside_unrestorable_state(self, state_log_path):
+        # (both files are kept, with the same suffix, for investigation)
+        suffix = '.unrestorable-' + datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S%f')
+        for path in (self.dbpath, state_log_path):
+            if os.path.exists(path):
+                os.rename(path, path + suffix)
+                LOGGER.warning("Moved aside (without replaying/loading "
+                               "it): %r -> %r", path, path + suffix)
+
+    def replay_state_log(self):
+        """
+        Replay the operations from the state log which are not reflected
+        in the state yet (note: a subsequent call reads only the records
+        appended since the previous one).
+        """
+        replayed = 0
+        for record in self.state_log.iter_records(
+                start_offset=self.state_log.end_offset,
+                truncate_incomplete_tail=not self.state_log_shared):
+            seq, op_name, args = record
+            if seq <= self.aggr_data.state_log_seq:
+                # already reflected in the snapshot
+                continue
+            getattr(self, '_replay_' + op_name)(*args)
+            self.aggr_data.state_log_seq = seq
+            replayed += 1
+        if replayed:
+            LOGGER.info("Replayed %d operation(s) from the state log: %r",
+                        replayed, self.state_log.path)
+
+    def _replay_event(self, data, last_event):
+        source_data = self.aggr_data.get_or_create_sourcedata(data, self.time_tolerance)
+        try:
+            source_data.process_event(data)
+        except n6QueueProcessingException:
+            pass
+        for _ in source_data.generate_suppressed_events():
+            pass
+        source_data.last_event = last_event
+
+    def _replay_inactive_source(self, source, last_event):
+        source_data = self.aggr_data.sources.get(source)
+        if source_data is None:
+            # (the source is not known to the restored state -- e.g.,
+            # because the snapshot has been lost -- so there is nothing
+            # to clean up)
+            LOGGER.warning("Unknown source %r in the state log -- skipping "
+                           "its inactivity cleanup", source)
+            return
+        for _ in source_data.generate_suppressed_events_after_inactive():
+            pass
+        source_data.last_event = last_event
+
+    def _append_to_state_log(self, op_name, *args):
+        if self.state_log is None:
+            return
+        self.aggr_data.state_log_seq += 1
+        self.state_log.append((self.aggr_data.state_log_seq, op_name, args))
+        self._store_snapshot_if_due()
+
+    def _store_snapshot_if_due(self):
+        if (self.state_log.record_count >= self.state_log_max_records
+              and not self.snapshots_suspended):
+            LOGGER.info("Storing a snapshot of the state (the state log "
+                        "has reached %d records)", self.state_log.record_count)
+            self.store_state()
+
+    def suspend_snapshots(self):
+        self.snapshots_suspended = True
+
+    def resume_snapshots(self):
+        self.snapshots_suspended = False
+        if self.state_log is not None:
+            self._store_snapshot_if_due()
+
+    def sync_state(self):
+        """
+        Make sure that the state is persisted (to be called on stop).
+        """
+        if self.state_log is None:
+            self.store_state()
+        else:
+            self.state_log.close()
+
     def process_new_message(self, data):
         """Processes a message and validates agains db to detect suppressed event.
         Adds new entry to db if necessary (new) or updates entry.
@@ -229,6 +443,13 @@ class AggregatorDataWrapper(object):
         for event in source_data.generate_suppressed_events():
             yield event
 
+    def log_processed_event(self, data):
+        """Called after an event has been processed, and the resultant
+        events have been published, to record the operation in the state log.
+        """
+        source_data = self.aggr_data.get_or_create_sourcedata(data)
+        self._append_to_state_log('event', data, source_data.last_event)
+
     def generate_suppresed_events_after_timeout(self):
         """Scans all stored sources and based on real time
          (i.e. source has been inactive for defined time)
@@ -236,16 +457,60 @@ class AggregatorDataWrapper(object):
         """
         LOGGER.debug('Detecting inactive sources after tick timout')
         time_now = datetime.datetime.utcnow()
-        for source in self.aggr_data.sources.itervalues():
-            LOGGER.debug('Checking source: %r', source)
-            if source.last_event + datetime.timedelta(hours=SOURCE_INACTIVITY_TIMEOUT) < time_now:
-                LOGGER.debug('Source inactive. Generating suppressed events')
-                for type_, event in source.generate_suppressed_events_after_inactive():
-                    LOGGER.debug('%r: %r', type_, event)
-                    yield type_, event
-
-
-class Aggregator(QueuedBase):
+        for source_name, source in self._iter_inactive_sources(time_now):
+            LOGGER.debug('Source inactive: %r. Generating suppressed events', source)
+            for type_, event in source.generate_suppressed_events_after_inactive():
+                LOGGER.debug('%r: %r', type_, event)
+                yield type_, event
+            self._append_to_state_log('inactive_source', source_name, source.last_event)
+
+    def _iter_inactive_sources(self, time_now):
+        # Note: the deadlines in the heap are not updated when events
+        # are processed (that would be a cost paid for each event);
+        # instead, when a deadline is reached, the actual deadline
+        # (based on the source's current `last_event`) is checked,
+        # and -- if it is still in the future -- it is pushed back to
+        # the heap.  So only the sources whose (possibly outdated)
+        # deadlines have passed are examined, and each of them at
+        # most once per SOURCE_INACTIVITY_TIMEOUT.
+        heap = self._get_inactivity_deadline_heap()
+        due_source_names = []
+        while heap and heap[0][0] < time_now:
+            _, source_name = heapq.heappop(heap)
+            due_source_names.append(source_name)
+        for source_name in due_source_names:
+            source = self.aggr_data.sources[source_name]
+            deadline = self._get_inactivity_deadline(source)
+            if deadline < time_now:
+                deadline = time_now + datetime.timedelta(hours=SOURCE_INACTIVITY_TIMEOUT)
+                heapq.heappush(heap, (deadline, source_name))
+                yield source_name, source
+            else:
+                heapq.heappush(heap, (deadline, source_name))
+
+    def _get_inactivity_deadline_heap(self):
+        heap = self._inactivity_deadline_heap
+        if heap is None:
+            heap = self._inactivity_deadline_heap = []
+            self._sources_with_deadlines = set()
+        # (sources are never removed, so a source not in the heap yet
+        # can be detected just by comparing the numbers of them)
+        if len(self._sources_with_deadlines) != len(self.aggr_data.sources):
+            for source_name, source in self.aggr_data.sources.iteritems():
+                if source_name not in self._sources_with_deadlines:
+                    heapq.heappush(heap, (self._get_inactivity_deadline(source), source_name))
+                    self._sources_with_deadlines.add(source_name)
+        return heap
+
+    @staticmethod
+    def _get_inactivity_deadline(source):
+        if source.last_event is None:
+            # (no event has been processed for the source yet)
+            return datetime.datetime.min
+        return source.last_event + datetime.timedelta(hours=SOURCE_INACTIVITY_TIMEOUT)
+
+
+class Aggregator(StateHandoffMixin, QueuedBase):
 
     input_queue = {"exchange": "event",
                    "exchange_type": "topic",
@@ -256,6 +521,8 @@ class Aggregator(QueuedBase):
                     "exchange_type": "topic"
                     }
 
+    supports_trusted_record_dict_input = True
+
     def __init__(self, **kwargs):
         config = Config(required={"aggregator": ("dbpath", "time_tolerance")})
         self.aggregator_config = config["aggregator"]
@@ -275,7 +542,16 @@ class Aggregator(QueuedBase):
             raise Exception('stop aggregator, remember to set the rights'
                             ' for user, which runs aggregator,  path:',
                             self.aggregator_config["dbpath"])
-        self.db = AggregatorDataWrapper(self.aggregator_config["dbpath"], int(self.aggregator_config["time_tolerance"]))
+        self.state_handoff_socket_path = self.aggregator_config["dbpath"] + '.handoff.sock'
+        self.begin_state_handoff()
+        self.db = AggregatorDataWrapper(
+            self.aggregator_config["dbpath"],
+            int(self.aggregator_config["time_tolerance"]),
+            state_log_fsync_interval=float(self.aggregator_config.get(
+                "state_log_fsync_interval", DEFAULT_STATE_LOG_FSYNC_INTERVAL)),
+            state_log_max_records=int(self.aggregator_config.get(
+                "state_log_max_records", DEFAULT_STATE_LOG_MAX_RECORDS)),
+            state_log_shared=self.state_handoff_pending)
         self.timeout_id = None # id of the 'tick' timeout that executes source cleanup
 
     def run(self):
@@ -294,6 +570,9 @@ class Aggregator(QueuedBase):
         for type_, event in self.db.generate_suppresed_events_after_timeout():
             if event is not None:
                 self.publish_event((type_, event))
+        # (the fsync interval is checked only when appending to the state
+        # log, so -- if no events come -- the last records are synced here)
+        self.db.state_log.sync()
         self.set_timeout()
 
     def process_event(self, data):
@@ -306,6 +585,7 @@ class Aggregator(QueuedBase):
         for type_, event in self.db.generate_suppresed_events_for_source(data):
             if event is not None:
                 self.publish_event((type_, event))
+        self.db.log_processed_event(data)
 
     # XXX: can be removed after resolving ticket #6324
     def _clean_count_related_stuff(self, cleaned_payload):
@@ -339,7 +619,7 @@ class Aggregator(QueuedBase):
         self.timeout_id = self._connection.add_timeout(TICK_TIMEOUT, self.on_timeout)
 
     def input_callback(self, routing_key, body, properties):
-        record_dict = RecordDict.from_json(body)
+        record_dict = self.record_dict_from_json(RecordDict, body, properties)
         with self.setting_error_event_info(record_dict):
             data = dict(record_dict) ## FIXME?: maybe it could be just the record_dict?
             if "_group" not in data:
@@ -347,9 +627,41 @@ class Aggregator(QueuedBase):
             self.process_event(data)
 
     def stop(self):
-        self.db.store_state()
+        if not self.state_handed_off:
+            self.db.sync_state()
         super(Aggregator, self).stop()
 
+    # State handoff hooks (see: n6.base.handoff.StateHandoffMixin).
+    # The new instance loads the state from the snapshot and the state
+    # log (while the old instance keeps appending to the log, with
+    # snapshots suspended), and then catches up by replaying the rest
+    # of the log -- so the delta is just the last sequence number.
+
+    def prepare_state_handoff(self):
+        self.db.suspend_snapshots()
+
+    def abort_state_handoff(self):
+        self.db.resume_snapshots()
+
+    def get_state_handoff_delta(self):
+        if self.timeout_id is not None:
+            self._connection.remove_timeout(self.timeout_id)
+            self.timeout_id = None
+        self.db.state_log.sync()
+        return {'state_log_seq': self.db.aggr_data.state_log_seq}
+
+    def catch_up_state_handoff(self):
+        self.db.replay_state_log()
+
+    def apply_state_handoff_delta(self, delta):
+        self.db.replay_state_log()
+        if self.db.aggr_data.state_log_seq != delta['state_log_seq']:
+            raise StateHandoffError(
+                'state log sequence number mismatch: {} (the old instance '
+                'reported: {})'.format(self.db.aggr_data.state_log_seq,
+                                       delta['state_log_seq']))
+        self.db.state_log_shared = False
+
 
 def main():
     with logging_configured():
@@ -56,6 +56,7 @@ class Anonymizer(QueuedBase):
         super(Anonymizer, self).__init__(**kwargs)
         self.auth_api = AuthAPI()
         self.data_spec = N6DataSpec()
+        self._org_id_to_output_properties = {}
 
     def input_callback(self, routing_key, body, properties):
         # NOTE: we do not need to use n6lib.record_dict.RecordDict here,
@@ -109,23 +110,33 @@ class Anonymizer(QueuedBase):
             inside_org_ids = set()
             threats_org_ids = set()
             source = event_data['source']
-            subsource_to_saa_info = (
-                self.auth_api.get_source_ids_to_subs_to_stream_api_access_infos().get(source))
-            if subsource_to_saa_info:
-                predicate_ready_dict = RecordFacadeForPredicates(event_data, self.data_spec)
-                client_org_ids = set(
-                    org_id.decode('ascii', 'strict')
-                    for org_id in event_data.get('client', ()))
-                for subsource_refint, (
-                        predicate, res_to_org_ids) in subsource_to_saa_info.iteritems():
-                    subs_inside_org_ids = res_to_org_ids['inside'] & client_org_ids
-                    subs_threats_org_ids = res_to_org_ids['threats']
-                    if not subs_inside_org_ids and not subs_threats_org_ids:
-                        continue
-                    if not predicate(predicate_ready_dict):
-                        continue
-                    inside_org_ids.update(subs_inside_org_ids)
-                    threats_org_ids.update(subs_threats_org_ids)
+            # (the access infos and the predicate index must come from
+            # the same Auth API data, i.e., the same LDAP root node)
+            with self.auth_api:
+                subsource_to_saa_info = (
+                    self.auth_api.get_source_ids_to_subs_to_stream_api_access_infos().get(source))
+                if subsource_to_saa_info:
+                    predicate_index = (
+                        self.auth_api.get_source_ids_to_stream_api_predicate_indexes()[source])
+                    predicate_ready_dict = RecordFacadeForPredicates(event_data, self.data_spec)
+                    client_org_ids = set(
+                        org_id.decode('ascii', 'strict')
+                        for org_id in event_data.get('client', ()))
+                    # note: thanks to the index, only the subsources whose
+                    # predicates *may* be satisfied are taken into account
+                    # (and, for them, only the residual parts of the
+                    # predicates need to be evaluated)
+                    for subsource_refint, residual_predicate in (
+                            predicate_index.iter_matching_candidates(predicate_ready_dict)):
+                        _, res_to_org_ids = subsource_to_saa_info[subsource_refint]
+                        subs_inside_org_ids = res_to_org_ids['inside'] & client_org_ids
+                        subs_threats_org_ids = res_to_org_ids['threats']
+                        if not subs_inside_org_ids and not subs_threats_org_ids:
+                            continue
+                        if not residual_predicate(predicate_ready_dict):
+                            continue
+                        inside_org_ids.update(subs_inside_org_ids)
+                        threats_org_ids.update(subs_threats_org_ids)
             return {
                 'inside': sorted(
                     org_id.decode('ascii', 'strict')
@@ -208,7 +219,7 @@ class Anonymizer(QueuedBase):
                     self.publish_output(
                         routing_key=output_rk,
                         body=output_body,
-                        prop_kwargs={'headers': {'n6-client-id': org_id}})
+                        properties=self._get_output_properties(org_id))
                 except:
                     LOGGER.error(
                         'Could not send an anonymized data record, for '
@@ -234,6 +245,18 @@ class Anonymizer(QueuedBase):
                     done_org_ids.append(org_id)
                     del res_org_ids[-1]
 
+    def _get_output_properties(self, org_id):
+        # note: the output properties (which differ only in the
+        # `n6-client-id` header) are made once per organization and
+        # then reused -- as the same event is typically published
+        # for many organizations
+        try:
+            return self._org_id_to_output_properties[org_id]
+        except KeyError:
+            properties = self.make_output_properties({'headers': {'n6-client-id': org_id}})
+            self._org_id_to_output_properties[org_id] = properties
+            return properties
+
 
 def main():
     with logging_configured():
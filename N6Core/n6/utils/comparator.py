@@ -1,14 +1,21 @@
 # Copyright (c) 2013-2018 NASK. All rights reserved.
 
 import datetime
+import errno
+import hashlib
+import heapq
 import json
 import cPickle
 import os
 import os.path
+import time
+import urllib
 
 from n6lib.config import Config
 from n6lib.datetime_helpers import parse_iso_datetime_to_utc
 from n6lib.log_helpers import get_logger, logging_configured
+from n6lib.persistence_helpers import dump_pickle_atomically
+from n6.base.handoff import StateHandoffMixin
 from n6.base.queue import (
     QueuedBase,
     n6QueueProcessingException,
@@ -18,57 +25,126 @@ from n6.base.queue import (
 LOGGER = get_logger(__name__)
 
 
+# the interval (in seconds) between checks whether any open series
+# has timed out (but no longer than the `series_timeout` config option)
+SERIES_TIMEOUT_CHECK_INTERVAL = 10
+
+
 class BlackListData(object):
-    
+
+    # Note: there may be very many instances of this class, so -- to
+    # keep the memory footprint small -- `__slots__` are used, the IPs
+    # (being compared to detect a change) are kept only as a digest,
+    # and the payload is stored pickled, without the series-specific
+    # items (the `payload` property converts it on the fly; note that
+    # each `payload` access gives a new dict).
+
+    __slots__ = ('id', 'ips_digest', 'expires', '_pickled_payload', '_legacy_flag')
+
     def __init__(self, payload):
         self.id = payload.get("id")
-        self.source = payload.get("source")
-        self.url = payload.get("url")
-        self.fqdn = payload.get("fqdn")
-        self.ip = [str(addr["ip"]) for addr in payload.get("address")] if payload.get("address") is not None else []
-        self.flag = payload.get("flag")
+        self.ips_digest = self.get_ips_digest(payload)
         self.expires = parse_iso_datetime_to_utc(payload.get("expires"))
-        self.payload = payload.copy()
-        
+        self.payload = payload
+
+    def __getstate__(self):
+        return (self.id, self.ips_digest, self.expires, self._pickled_payload)
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # an instance pickled by an older version of this class
+            # (the flag is to be taken by SourceData.__setstate__())
+            self.id = state['id']
+            self.ips_digest = self._make_ips_digest(state['ip'])
+            self.expires = state['expires']
+            self.payload = state['payload']
+            if state.get('flag') is not None:
+                self._legacy_flag = state['flag']
+        else:
+            self.id, self.ips_digest, self.expires, self._pickled_payload = state
+
+    @classmethod
+    def get_ips_digest(cls, payload):
+        address = payload.get("address")
+        return cls._make_ips_digest(addr["ip"] for addr in address) if address is not None else None
+
+    @staticmethod
+    def _make_ips_digest(ips):
+        ips = sorted(str(ip) for ip in ips)
+        return hashlib.md5(' '.join(ips)).digest()[:8] if ips else None
+
+    @property
+    def payload(self):
+        return cPickle.loads(self._pickled_payload)
+
+    @payload.setter
+    def payload(self, payload):
+        payload = {k: v for k, v in payload.iteritems() if not k.startswith("_bl-series")}
+        self._pickled_payload = cPickle.dumps(payload, cPickle.HIGHEST_PROTOCOL)
+
     def to_dict(self):
         return self.payload
-    
+
     def update_payload(self, update_dict):
-        tmp = self.payload.copy()
-        tmp.update(update_dict)
-        self.payload = tmp
+        payload = self.payload
+        payload.update(update_dict)
+        self.payload = payload
 
 
 class SourceData(object):
 
+    """
+    The state of a black list source.
+
+    The keys of the events seen in the current series are collected
+    in the `flags` dict (mapping them to the series ids), and removed
+    from the set of the keys not seen yet -- so when the series is
+    finished, the delisted events are just the ones whose keys are
+    left in that set (rather than being found by checking each event
+    of the black list); and the expired ones are taken from a heap
+    ordered by the expiry time (see: process_deleted()).
+    """
+
+    # the two attributes below are built lazily (they are not pickled)
+
+    # the set of the keys of the events not seen in the current series
+    # (i.e., `blacklist` keys minus `flags` keys)
+    _unseen_keys = None
+
+    # a heap of (<expires>, <event key>) pairs; it may contain stale
+    # items (for removed events or for changed `expires`), they are
+    # skipped when popped
+    _expiry_heap = None
+
     def __init__(self):
         self.time = None  # current time tracked for source (based on event _bl-time)
         # real time of the last event (used to trigger cleanup if source is inactive)
         self.last_event = None
         self.blacklist = {}  # current state of black list
+        self.flags = {}  # event key -> id of the series the event was seen in
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_unseen_keys', None)
+        state.pop('_expiry_heap', None)
+        return state
+
+    def __setstate__(self, state):
+        if 'flags' not in state:
+            # legacy state: the flags were kept as attributes of events
+            state['flags'] = flags = {}
+            for key, event in state['blacklist'].iteritems():
+                flag = getattr(event, '_legacy_flag', None)
+                if flag is not None:
+                    flags[key] = flag
+                    del event._legacy_flag
+        self.__dict__.update(state)
 
     def update_time(self, event_time):
         if event_time > self.time:
             self.time = event_time
         self.last_event = datetime.datetime.now()  ## FIXME unused variable ?
 
-    def _are_ips_different(self, ips_old, ips_new):
-        """
-        Compare lists of ips.
-        
-        Returns:
-            True if lists different
-            False if lists the same
-        """
-        if ips_old is None and ips_new is None:
-            return False
-        if (ips_old is None and ips_new is not None) or (ips_old is not None and ips_new is None):
-            return True
-        if sorted(ips_old) == sorted(ips_new):
-            return False
-        else:
-            return True
-        
     def get_event_key(self, data):
         if data.get("url") is not None:
             return data.get("url")
@@ -94,60 +170,77 @@ class SourceData(object):
 
         event_key = self.get_event_key(data)
         event = self.blacklist.get(event_key)
+        self.flags[event_key] = data.get("_bl-series-id")
+        self._get_unseen_keys().discard(event_key)
 
         if event is None:
             # new bl event
-            new_event = BlackListData(data)
-            new_event.flag = data.get("_bl-series-id")
-            self.blacklist[event_key] = new_event
-            return 'bl-new', new_event.payload
+            self._add_event(event_key, BlackListData(data))
+            return 'bl-new', data.copy()
         else:
             # existing
-            ips_old = event.ip
-            ips_new = [x["ip"] for x in data.get("address")] if data.get("address") is not None else []
-            if self._are_ips_different(ips_old, ips_new):
+            if BlackListData.get_ips_digest(data) != event.ips_digest:
                 data["replaces"] = event.id
-                new_event = BlackListData(data)
-                new_event.flag = data.get("_bl-series-id")
-                self.blacklist[event_key] = new_event
-                return "bl-change", new_event.payload
-            elif parse_iso_datetime_to_utc(data.get("expires")) != event.expires:
-                event.expires = parse_iso_datetime_to_utc(data.get("expires"))
-                event.flag = data.get("_bl-series-id")
+                self._add_event(event_key, BlackListData(data))
+                return "bl-change", data.copy()
+            expires = parse_iso_datetime_to_utc(data.get("expires"))
+            if expires != event.expires:
+                event.expires = expires
                 event.update_payload({"expires": data.get("expires")})
-                self.blacklist[event_key] = event
+                self._push_expiry(event_key, event)
                 return "bl-update", event.payload
             else:
-                event.flag = data.get("_bl-series-id")
-                self.blacklist[event_key] = event
-                return None, event.payload
+                # (no payload, as nothing is to be published)
+                return None, None
 
     def process_deleted(self):
-
+        blacklist = self.blacklist
         ret_value = []
-        for key, event in list(self.blacklist.iteritems()):
-            if event.flag is None:
-                value = event.payload.copy()
-                if key in self.blacklist:
-                    del self.blacklist[key]
-                # yield "bl-delist", value
-                ret_value.append(["bl-delist", value])
-                continue
-            if event.expires < self.time:
-                value = event.payload.copy()
-                if key in self.blacklist:
-                    del self.blacklist[key]
-                # yield "bl-expire", value
-                ret_value.append(["bl-expire", value])
-                continue
-            event.flag = None
+        for key in self._get_unseen_keys():
+            ret_value.append(["bl-delist", blacklist.pop(key).payload])
+        heap = self._get_expiry_heap()
+        while heap and heap[0][0] < self.time:
+            expires, key = heapq.heappop(heap)
+            event = blacklist.get(key)
+            if event is not None and event.expires == expires:
+                del blacklist[key]
+                ret_value.append(["bl-expire", event.payload])
+        self.flags.clear()
+        self._unseen_keys = set(blacklist)
         return ret_value
 
     def clear_flags(self, flag_id):
-        for key, event in list(self.blacklist.iteritems()):
-            if event.flag == flag_id:
-                event.flag = None
-                self.blacklist[key] = event
+        keys = [key for key, flag in self.flags.iteritems() if flag == flag_id]
+        for key in keys:
+            del self.flags[key]
+        self._get_unseen_keys().update(keys)
+
+    def _add_event(self, event_key, event):
+        self.blacklist[event_key] = event
+        self._push_expiry(event_key, event)
+
+    def _push_expiry(self, event_key, event):
+        heap = self._get_expiry_heap()
+        if len(heap) > 2 * len(self.blacklist) + 1000:
+            # (too many stale items)
+            heap = self._expiry_heap = None
+            heap = self._get_expiry_heap()
+        heapq.heappush(heap, (event.expires, event_key))
+
+    def _get_unseen_keys(self):
+        unseen_keys = self._unseen_keys
+        if unseen_keys is None:
+            unseen_keys = self._unseen_keys = set(self.blacklist)
+            unseen_keys.difference_update(self.flags)
+        return unseen_keys
+
+    def _get_expiry_heap(self):
+        heap = self._expiry_heap
+        if heap is None:
+            heap = self._expiry_heap = [(event.expires, key)
+                                        for key, event in self.blacklist.iteritems()]
+            heapq.heapify(heap)
+        return heap
 
     def __repr__(self):
         return repr(self.groups)
@@ -171,32 +264,133 @@ class ComparatorData(object):
 
 class ComparatorDataWrapper(object):
 
+    """
+    A wrapper of ComparatorData that also takes care of its persistence.
+
+    The state of each source is stored in a separate file (in the
+    `<dbpath>.sources` directory), only when the source has been
+    modified -- typically, when a series of the source is finished
+    (see: clear_flags() and process_deleted()); and all modified
+    sources are stored by store_state() (called on stop).  The files
+    are loaded lazily, when a source is accessed for the first time.
+
+    A legacy state file (`dbpath`, containing the whole pickled
+    ComparatorData) is migrated automatically.
+    """
+
+    # the directory of per-source state files (None means: no persistence)
+    sources_dirpath = None
+
+    # the names of the sources modified since they were stored
+    # (note: the set is created when a source is modified for the
+    # first time; None means: no sources modified)
+    dirty_source_names = None
+
+    # if true, nothing is stored, only `dirty_source_names` is updated
+    # (see: Comparator's state handoff hooks)
+    storing_suspended = False
+
     def __init__(self, dbpath):
-        self.comp_data = None
+        self.comp_data = ComparatorData()
         self.dbpath = dbpath
-        try:
-            self.restore_state()
-        except:
-            LOGGER.error("Error restoring state from: %r", self.dbpath)
-            self.comp_data = ComparatorData()
+        self.sources_dirpath = dbpath + '.sources'
+        if not os.path.isdir(self.sources_dirpath):
+            os.makedirs(self.sources_dirpath, 0700)
+        if os.path.isfile(self.dbpath):
+            self._migrate_legacy_state()
+
+    def get_sourcedata(self, source_name):
+        sources = self.comp_data.sources
+        source_data = sources.get(source_name)
+        if source_data is None:
+            source_data = self._load_sourcedata(source_name)
+            if source_data is not None:
+                sources[source_name] = source_data
+            else:
+                source_data = self.comp_data.get_or_create_sourcedata(source_name)
+        return source_data
 
-    def store_state(self):
-        try:
-            with open(self.dbpath, "w") as f:
-                cPickle.dump(self.comp_data, f)
-        except IOError:
-            LOGGER.error("Error saving state to: %r", self.dbpath)
+    def store_state(self, source_name=None):
+        """
+        Store the state of the given source, or -- if `source_name`
+        is not specified -- of all modified sources.
+        """
+        if (self.sources_dirpath is None or
+              not self.dirty_source_names or
+              self.storing_suspended):
+            return
+        if source_name is None:
+            source_names = list(self.dirty_source_names)
+        elif source_name in self.dirty_source_names:
+            source_names = [source_name]
+        else:
+            return
+        for name in source_names:
+            try:
+                dump_pickle_atomically(self.comp_data.sources[name],
+                                       self._get_source_filepath(name))
+            except (IOError, OSError):
+                LOGGER.error("Error saving state of source %r to: %r",
+                             name, self._get_source_filepath(name))
+            else:
+                self.dirty_source_names.discard(name)
+
+    def suspend_storing_state(self):
+        self.storing_suspended = True
+
+    def resume_storing_state(self):
+        self.storing_suspended = False
+        self.store_state()
 
-    def restore_state(self):
-        with open(self.dbpath, "r") as f:
-            self.comp_data = cPickle.load(f)
+    def mark_source_as_modified(self, source_name):
+        if self.dirty_source_names is None:
+            self.dirty_source_names = set()
+        self.dirty_source_names.add(source_name)
+
+    def _get_source_filepath(self, source_name):
+        return os.path.join(self.sources_dirpath,
+                            urllib.quote(source_name, safe='') + '.pickle')
+
+    def _load_sourcedata(self, source_name):
+        if self.sources_dirpath is None:
+            return None
+        filepath = self._get_source_filepath(source_name)
+        try:
+            with open(filepath, 'rb') as f:
+                return cPickle.load(f)
+        except IOError as exc:
+            if exc.errno != errno.ENOENT:
+                LOGGER.error("Error restoring state of source %r from: %r",
+                             source_name, filepath)
+        except Exception:
+            LOGGER.error("Error restoring state of source %r from: %r",
+                         source_name, filepath)
+        return None
+
+    def _migrate_legacy_state(self):
+        try:
+            with open(self.dbpath, 'rb') as f:
+                legacy_comp_data = cPickle.load(f)
+        except Exception:
+            LOGGER.error("Error restoring state from: %r", self.dbpath)
+            return
+        for source_name, source_data in legacy_comp_data.sources.iteritems():
+            if self._load_sourcedata(source_name) is None:
+                self.comp_data.sources[source_name] = source_data
+                self.mark_source_as_modified(source_name)
+        self.store_state()
+        if not self.dirty_source_names:
+            os.rename(self.dbpath, self.dbpath + '.migrated')
+            LOGGER.info("The legacy state file %r has been migrated to %r",
+                        self.dbpath, self.sources_dirpath)
 
     def process_new_message(self, data):
         """Processes a message and validates agains db to detect new/change/update.
         Adds new entry to db if necessary (new) or updates entry (change/update) and
         stores flag in db for processed event.
         """
-        source_data = self.comp_data.get_or_create_sourcedata(data['source'])
+        source_data = self.get_sourcedata(data['source'])
+        self.mark_source_as_modified(data['source'])
         result = source_data.process_event(data)
         source_data.update_time(parse_iso_datetime_to_utc(data['_bl-time']))
         return result
@@ -204,37 +398,41 @@ class ComparatorDataWrapper(object):
     def clear_flags(self, source, flag_id):
         """Cleans up flags in the db after processing complete blacklist
         """
-        source_data = self.comp_data.get_or_create_sourcedata(source)
+        source_data = self.get_sourcedata(source)
+        self.mark_source_as_modified(source)
         source_data.clear_flags(flag_id)
-        self.store_state()
+        self.store_state(source)
 
     def process_deleted(self, source):
         """Finds unflagged and expired messages for a bl_name (deleted) and generates delist/expire messages.
         Removes entries from db.
         """
 
-        source_data = self.comp_data.get_or_create_sourcedata(source)
+        source_data = self.get_sourcedata(source)
+        self.mark_source_as_modified(source)
         for event in source_data.process_deleted():
             yield event
-        self.store_state()
+        self.store_state(source)
 
 
 class ComparatorState(object):
 
-    def __init__(self, cleanup_time):
+    def __init__(self, cleanup_time, time_func=time.time):
         """
         closed_series = {series-id: expires_time, #time.time when the closed series expires and should be removed
                          ...}
         open_series = {series-id: {"total": int, #total number of messages in a series
                                    "msg-count": int #number of messages seen so far
-                                   "msg-nums": [int, ...], #message numbers of seen messages
+                                   "msg-nums": set([int, ...]), #message numbers of seen messages
                                    "msg-ids": [str, ...], #ids of the seen messages
-                                   "timeout-id": str, #id of the created timeout for a serie
+                                   "last-seen": float, #time.time of the last message of a serie
+                                   "source": str, #source the serie belongs to
                                     }
                        ...}
         """
         self.open_series = dict()
         self.cleanup_time = cleanup_time
+        self._time_func = time_func
 
     def is_series_complete(self, series_id):
         """Verify if the series is complete"""
@@ -267,14 +465,17 @@ class ComparatorState(object):
         """
         if message["_bl-series-id"] not in self.open_series:
             self.open_series[message["_bl-series-id"]] = {"total": int(message["_bl-series-total"]),
-                                                         "timeout-id": None,
+                                                         "last-seen": None,
                                                          "msg-count": 0,
-                                                         "msg-nums": [],
-                                                         "msg-ids": []
+                                                         "msg-nums": set(),
+                                                         "msg-ids": [],
+                                                         "source": message["source"],
                                                          }
-        self.open_series[message["_bl-series-id"]]["msg-count"] += 1
-        self.open_series[message["_bl-series-id"]]["msg-nums"].append(int(message["_bl-series-no"]))
-        self.open_series[message["_bl-series-id"]]["msg-ids"].append(message["id"])
+        series = self.open_series[message["_bl-series-id"]]
+        series["last-seen"] = self._time_func()
+        series["msg-count"] += 1
+        series["msg-nums"].add(int(message["_bl-series-no"]))
+        series["msg-ids"].append(message["id"])
         # print "received message series %s: %d of %d" % (message["_bl-series-id"],
         #                                                 self.open_series[message["_bl-series-id"]]["msg-count"],
         #                                                 self.open_series[message["_bl-series-id"]]["total"])
@@ -285,20 +486,28 @@ class ComparatorState(object):
         assert series_id in self.open_series
         del self.open_series[series_id]
 
-    def save_timeout(self, series_id, timeout_id):
-        """Save timeout id for a given series
+    def add_open_series(self, open_series):
+        """Add open series taken over from another instance
         """
-        assert series_id in self.open_series
-        self.open_series[series_id]["timeout-id"] = timeout_id
-
-    def get_timeout(self, series_id):
-        """Get timeout id for a given series
+        for series_id, series in open_series.iteritems():
+            series = dict(series)
+            # (series from an older version of the comparator)
+            series.pop("timeout-id", None)
+            series["msg-nums"] = set(series["msg-nums"])
+            series.setdefault("last-seen", self._time_func())
+            self.open_series[series_id] = series
+
+    def get_timed_out_series(self, series_timeout):
+        """Get (series id, source) pairs of the series whose last message
+        arrived at least series_timeout seconds ago
         """
-        assert series_id in self.open_series
-        return self.open_series[series_id]["timeout-id"]
+        deadline = self._time_func() - series_timeout
+        return [(series_id, series["source"])
+                for series_id, series in self.open_series.iteritems()
+                if series["last-seen"] <= deadline]
 
 
-class Comparator(QueuedBase):
+class Comparator(StateHandoffMixin, QueuedBase):
 
     input_queue = {"exchange": "event",
                    "exchange_type": "topic",
@@ -309,6 +518,9 @@ class Comparator(QueuedBase):
                     "exchange_type": "topic"
                     }
 
+    # id of the 'tick' timeout that executes check_series_timeouts()
+    timeout_id = None
+
     def __init__(self, **kwargs):
         config = Config(required={"comparator": ("dbpath", "series_timeout", "cleanup_time")})
         self.comparator_config = config["comparator"]
@@ -329,10 +541,26 @@ class Comparator(QueuedBase):
                             ' for user, which runs comparator,  path:',
                             self.comparator_config["dbpath"])
         self.state = ComparatorState(int(self.comparator_config["cleanup_time"]))
+        self.state_handoff_socket_path = self.comparator_config["dbpath"] + '.handoff.sock'
+        self.begin_state_handoff()
         self.db = ComparatorDataWrapper(self.comparator_config["dbpath"])
 
+    def start_publishing(self):
+        self.set_timeout()
+
+    def check_series_timeouts(self):
+        """Callback called periodically: calls on_series_timeout()
+        for the series whose messages have not arrived within
+        series_timeout from the last msg.
+        """
+        series_timeout = int(self.comparator_config['series_timeout'])
+        for series_id, source in self.state.get_timed_out_series(series_timeout):
+            LOGGER.warning("Series %r (of %r) timed out", series_id, source)
+            self.on_series_timeout(source, series_id)
+        self.set_timeout()
+
     def on_series_timeout(self, source, series_id):
-        """Callback called when the messages for a given series have
+        """Called when the messages for a given series have
         not arrived within series_timeout from the last msg.
         Cleans up the flags in the db and closes the series in ComparatorState
         """
@@ -351,7 +579,6 @@ class Comparator(QueuedBase):
         generates bl-delist, bl-expire messages from db.
         Close the series in ComparatorState
         """
-        self.remove_timeout(series_id)
         for event in self.db.process_deleted(bl_name):
             self.publish_event(event)
         self.state.close_series(series_id)
@@ -377,17 +604,15 @@ class Comparator(QueuedBase):
         body = json.dumps(payload)
         self.publish_output(routing_key=rk, body=body)
 
-    def set_timeout(self, source, series_id):
-        self.remove_timeout(series_id)
-        timeout_id = self._connection.add_timeout(
-            int(self.comparator_config['series_timeout']),
-            lambda: self.on_series_timeout(source, series_id))
-        self.state.save_timeout(series_id, timeout_id)
+    def set_timeout(self):
+        interval = min(SERIES_TIMEOUT_CHECK_INTERVAL,
+                       int(self.comparator_config['series_timeout']))
+        self.timeout_id = self._connection.add_timeout(interval, self.check_series_timeouts)
 
-    def remove_timeout(self, series_id):
-        timeout_id = self.state.get_timeout(series_id)
-        if timeout_id is not None:
-            self._connection.remove_timeout(timeout_id)
+    def remove_timeout(self):
+        if self.timeout_id is not None:
+            self._connection.remove_timeout(self.timeout_id)
+            self.timeout_id = None
 
     def validate_bl_headers(self, message):
         if ('_bl-series-id' not in message or
@@ -413,16 +638,45 @@ class Comparator(QueuedBase):
         if not self.state.is_message_valid(data):
             raise n6QueueProcessingException("Invalid message for a series: {}".format(data))
         self.state.update_series(data)
-        self.set_timeout(data["source"], data["_bl-series-id"])
         self.process_event(data)
         if self.state.is_series_complete(data["_bl-series-id"]):
             LOGGER.info("Finalizing series: %r", data["_bl-series-id"])
             self.finalize_series(data["_bl-series-id"], data["source"])
 
     def stop(self):
-        self.db.store_state()
+        if not self.state_handed_off:
+            self.db.store_state()
         super(Comparator, self).stop()
 
+    # State handoff hooks (see: n6.base.handoff.StateHandoffMixin).
+    # The new instance loads the persisted state (which is not
+    # overwritten by the old instance in the meantime), and then
+    # receives the sources not stored by the old instance (i.e., the
+    # modified ones) and the open series.
+
+    def prepare_state_handoff(self):
+        self.db.suspend_storing_state()
+
+    def abort_state_handoff(self):
+        self.db.resume_storing_state()
+
+    def get_state_handoff_delta(self):
+        self.remove_timeout()
+        return {
+            "sources": {name: self.db.comp_data.sources[name]
+                        for name in (self.db.dirty_source_names or ())},
+            "open_series": self.state.open_series,
+        }
+
+    def apply_state_handoff_delta(self, delta):
+        for source_name, source_data in delta["sources"].iteritems():
+            self.db.comp_data.sources[source_name] = source_data
+            self.db.mark_source_as_modified(source_name)
+        self.state.add_open_series(delta["open_series"])
+        # (the old instance does not store them anymore, so they
+        # would be lost if this instance was terminated abruptly)
+        self.db.store_state()
+
 
 def main():
     with logging_configured():
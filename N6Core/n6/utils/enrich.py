@@ -39,6 +39,14 @@ class Enricher(QueuedBase):
         'exchange_type': 'topic',
     }
 
+    # the output messages are marked as containing ready record dicts
+    # (see: QueuedBase.record_dict_from_json())
+    basic_prop_kwargs = dict(
+        QueuedBase.basic_prop_kwargs,
+        headers={RecordDict.TRUSTED_JSON_HEADER: RecordDict.TRUSTED_JSON_VERSION})
+
+    supports_trusted_record_dict_input = True
+
     single_instance = False
 
     #
@@ -80,7 +88,7 @@ class Enricher(QueuedBase):
     # Main activity
 
     def input_callback(self, routing_key, body, properties):
-        data = RecordDict.from_json(body)
+        data = self.record_dict_from_json(RecordDict, body, properties)
         with self.setting_error_event_info(data):
             enriched = self.enrich(data)
             rk = replace_segment(routing_key, 1, 'enriched')
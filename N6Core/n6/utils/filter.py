@@ -42,6 +42,14 @@ class Filter(ConfigMixin, QueuedBase):
         'exchange_type': 'topic',
     }
 
+    # the output messages are marked as containing ready record dicts
+    # (see: QueuedBase.record_dict_from_json())
+    basic_prop_kwargs = dict(
+        QueuedBase.basic_prop_kwargs,
+        headers={RecordDict.TRUSTED_JSON_HEADER: RecordDict.TRUSTED_JSON_VERSION})
+
+    supports_trusted_record_dict_input = True
+
     config_spec = '''
         [filter]
         categories_filtered_through_fqdn_only = :: list_of_str
@@ -57,7 +65,7 @@ class Filter(ConfigMixin, QueuedBase):
         super(Filter, self).__init__(**kwargs)
 
     def input_callback(self, routing_key, body, properties):
-        record_dict = RecordDict.from_json(body)
+        record_dict = self.record_dict_from_json(RecordDict, body, properties)
         with self.setting_error_event_info(record_dict):
             client, urls_matched = self.get_client_and_urls_matched(
                 record_dict,
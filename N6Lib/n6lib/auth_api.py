@@ -31,6 +31,7 @@ from n6lib.db_events import n6NormalizedData
 from n6lib.db_filtering_abstractions import (
     BaseCond,
     PredicateConditionBuilder,
+    PredicateIndex,
     SQLAlchemyConditionBuilder,
 )
 from n6lib.log_helpers import get_logger
@@ -483,6 +484,37 @@ class AuthAPI(object):
             root_node,
             org_id_to_node)
 
+    # note: @deep_copying_result is not used here because the result is
+    #       purely read-only (and deep-copying it on each call would
+    #       defeat its purpose)
+    @cached_basing_on_ldap_root_node
+    def get_source_ids_to_stream_api_predicate_indexes(self):
+        """
+        Get a dict that maps source ids to inverted indexes of Stream
+        (STOMP) API subsource predicates.
+
+        Returns a dict (typically already cached):
+
+        {
+            <source id>: <an n6lib.db_filtering_abstractions.PredicateIndex
+                          instance whose keys are subsource DNs (strings)>,
+            ...
+        }
+
+        The sources and subsources covered are exactly the same as in
+        the result of get_source_ids_to_subs_to_stream_api_access_infos();
+        the indexed conditions are the same as those whose predicates
+        are included in that result.  Thanks to that, for a given
+        record, it is possible to select the subsources whose predicates
+        may be satisfied (and to evaluate only their residual parts)
+        instead of evaluating all predicates for the record's source.
+        """
+        root_node = self.get_ldap_root_node()
+        org_id_to_node = root_node['ou']['orgs'].get('o', {})
+        return self._make_source_ids_to_stream_api_predicate_indexes(
+            root_node,
+            org_id_to_node)
+
     @deep_copying_result  # <- just defensive programming
     @cached_basing_on_ldap_root_node
     def get_source_ids_to_notification_access_info_mappings(self):
@@ -695,15 +727,8 @@ class AuthAPI(object):
     def _make_source_ids_to_subs_to_stream_api_access_infos(self, root_node, org_id_to_node):
         result = {}
         cond_builder = PredicateConditionBuilder()
-        grouped_set = self._get_org_subsource_az_tuples(root_node, org_id_to_node)
-        for org_id, subsource_refint, access_zone in sorted(grouped_set):  # (deterministic order)
-            org = org_id_to_node[org_id]
-            if not self._is_flag_enabled_for_org(org, org_id, 'n6stream-api-enabled'):
-                continue
-            resource_id = ACCESS_ZONE_TO_RESOURCE_ID[access_zone]
-            if not self._is_resource_enabled_for_org(resource_id, org, org_id):
-                continue
-            source_id = get_dn_segment_value(subsource_refint, 1)
+        for (org_id, subsource_refint, access_zone, source_id
+             ) in self._iter_stream_api_org_subsource_az_source_tuples(root_node, org_id_to_node):
             subsource_to_saa_info = result.setdefault(source_id, {})
             saa_info = subsource_to_saa_info.get(subsource_refint)
             if saa_info is None:
@@ -742,6 +767,35 @@ class AuthAPI(object):
                     org_id in az_to_org_ids[access_zone]))
         return result
 
+    def _make_source_ids_to_stream_api_predicate_indexes(self, root_node, org_id_to_node):
+        source_id_to_subs_to_cond = {}
+        cond_builder = PredicateConditionBuilder()
+        for (_, subsource_refint, _, source_id
+             ) in self._iter_stream_api_org_subsource_az_source_tuples(root_node, org_id_to_node):
+            subsource_to_cond = source_id_to_subs_to_cond.setdefault(source_id, {})
+            if subsource_refint not in subsource_to_cond:
+                subsource_to_cond[subsource_refint] = (
+                    self._get_condition_for_subsource_and_full_access_flag(
+                        root_node, source_id, subsource_refint, cond_builder))
+        return {
+            source_id: PredicateIndex(subsource_to_cond)
+            for source_id, subsource_to_cond in source_id_to_subs_to_cond.iteritems()}
+
+    def _iter_stream_api_org_subsource_az_source_tuples(self, root_node, org_id_to_node):
+        # yields (<org id>, <subsource DN>, <access zone>, <source id>) tuples
+        # -- only for organizations for whom Stream API and the REST API
+        # resource corresponding to the access zone are enabled
+        grouped_set = self._get_org_subsource_az_tuples(root_node, org_id_to_node)
+        for org_id, subsource_refint, access_zone in sorted(grouped_set):  # (deterministic order)
+            org = org_id_to_node[org_id]
+            if not self._is_flag_enabled_for_org(org, org_id, 'n6stream-api-enabled'):
+                continue
+            resource_id = ACCESS_ZONE_TO_RESOURCE_ID[access_zone]
+            if not self._is_resource_enabled_for_org(resource_id, org, org_id):
+                continue
+            source_id = get_dn_segment_value(subsource_refint, 1)
+            yield org_id, subsource_refint, access_zone, source_id
+
     def _make_source_ids_to_notification_access_info_mappings(self, root_node, org_id_to_node):
         ### TODO later?: get rid of code duplication with the
         ### _make_source_ids_to_subs_to_stream_api_access_infos()
@@ -28,6 +28,7 @@ import threading
 import time
 import traceback
 import weakref
+import zlib
 from importlib import import_module
 
 from pkg_resources import cleanup_resources
@@ -280,7 +281,10 @@ class FilePagedSequence(collections.MutableSequence):
 
     Under the hood, the sequence is "paged" -- only the current page
     (consisting of a defined number of items) is kept in memory; other
-    pages are pickled and saved as temporary files.
+    pages are pickled (optionally, also compressed) and saved in a
+    temporary spill file (one per sequence; a page is saved only if it
+    has been modified since it was loaded; a modified page is stored in
+    its previous place within the file if it fits there).
 
     The interface is similar to the built-in list's one, except that:
 
@@ -291,9 +295,12 @@ class FilePagedSequence(collections.MutableSequence):
     * index() accepts only one argument (does not accept the `start` and
       `stop` range limiting arguments);
     * all sequence items must be picklable;
-    * the constructor accepts an additional argument: `page_size` --
-      being the number of items each page may consist of (its default
-      value is 1000);
+    * the constructor accepts additional arguments:
+      * `page_size` -- being the number of items each page may consist
+        of (its default value is 1000);
+      * `compress_level` -- being the zlib compression level (1-9) of
+        the saved pages, or 0 (the default) if they are not to be
+        compressed;
     * there are additional methods:
       * clear() -- use it instead of `del seq[:]`;
       * close() -- you should call it when you no longer use the sequence
@@ -308,8 +315,11 @@ class FilePagedSequence(collections.MutableSequence):
     undefined (i.e., apart from an exception being raised, the sequence may
     be left in a defective, inconsistent state).
 
-    Temporary directory and files are created leazily -- no disk operations
-    are performed at all if all data fit on one page.
+    Modifying an item *in place* (rather than assigning a new value with
+    `seq[i] = ...`) is *not* guaranteed to be reflected in the sequence.
+
+    The temporary file is created leazily -- no disk operations are
+    performed at all if all data fit on one page.
 
     The implementation is *not* thread-safe.
 
@@ -572,15 +582,13 @@ class FilePagedSequence(collections.MutableSequence):
     Traceback (most recent call last):
     IndexError
 
-    >>> osp.exists(seq._dir)
-    True
-    >>> sorted(os.listdir(seq._dir))
-    ['0', '1', '2']
+    >>> sorted(seq._page_locations)
+    [0, 1, 2]
     >>> seq.close()
     >>> list(seq)
     []
-    >>> osp.exists(seq._dir)
-    False
+    >>> seq._file.closed
+    True
 
     >>> seq2 = FilePagedSequence('abc', page_size=3)
     >>> list(seq2)
@@ -590,32 +598,43 @@ class FilePagedSequence(collections.MutableSequence):
     >>> seq2.extend('d')          # (now page 0 must be saved)
     >>> seq2._filesystem_used()
     True
-    >>> osp.exists(seq2._dir)
-    True
-    >>> sorted(os.listdir(seq2._dir))
-    ['0']
+    >>> sorted(seq2._page_locations)
+    [0]
     >>> seq2.extend('ef')
-    >>> sorted(os.listdir(seq2._dir))
-    ['0']
+    >>> sorted(seq2._page_locations)
+    [0]
     >>> seq2.extend('g')          # (now page 1 must be saved)
-    >>> sorted(os.listdir(seq2._dir))
-    ['0', '1']
+    >>> sorted(seq2._page_locations)
+    [0, 1]
     >>> seq2[0]                   # (now page 2 must be saved)
     'a'
-    >>> sorted(os.listdir(seq2._dir))
-    ['0', '1', '2']
+    >>> sorted(seq2._page_locations)
+    [0, 1, 2]
+    >>> file_end = seq2._file_end
+    >>> seq2[4]                   # (page 0 has not been modified -> not saved)
+    'e'
+    >>> seq2[0] = 'A'
+    >>> seq2[4]                   # (page 0 saved in its previous place)
+    'e'
+    >>> seq2._file_end == file_end
+    True
+    >>> seq2[0] = 'A' * 100
+    >>> seq2[4]                   # (page 0 saved at the end of the file)
+    'e'
+    >>> seq2._file_end > file_end
+    True
     >>> seq2.pop()
     'g'
-    >>> sorted(os.listdir(seq2._dir))
-    ['0', '1', '2']
+    >>> list(seq2) == ['A' * 100, 'b', 'c', 'd', 'e', 'f']
+    True
     >>> seq2.clear()
-    >>> sorted(os.listdir(seq2._dir))
-    ['0', '1', '2']
+    >>> seq2._page_locations
+    {}
     >>> seq2.close()
     >>> seq2._filesystem_used()
     True
-    >>> osp.exists(seq2._dir)
-    False
+    >>> seq2._file.closed
+    True
     >>> list(seq2)
     []
 
@@ -639,12 +658,12 @@ class FilePagedSequence(collections.MutableSequence):
     ...     not seq4._filesystem_used()
     ...     seq4.append(['d'])
     ...     seq4._filesystem_used()
-    ...     osp.exists(seq4._dir)
-    ...     sorted(os.listdir(seq4._dir)) == ['0']
+    ...     not seq4._file.closed
+    ...     sorted(seq4._page_locations) == [0]
     ...     seq4[2] = {'ZZZ': 333}
-    ...     sorted(os.listdir(seq4._dir)) == ['0', '1']
+    ...     sorted(seq4._page_locations) == [0, 1]
     ...     list(seq4) == [('bar', 2), {'x'}, {'ZZZ': 333}, ['d']]
-    ...     osp.exists(seq4._dir)
+    ...     not seq4._file.closed
     ...
     True
     True
@@ -658,15 +677,31 @@ class FilePagedSequence(collections.MutableSequence):
     True
     True
     True
-    >>> osp.exists(seq4._dir)
-    False
+    >>> seq4._file.closed
+    True
+
+    >>> seq5 = FilePagedSequence(xrange(10), page_size=3, compress_level=6)
+    >>> list(seq5)
+    [0, 1, 2, 3, 4, 5, 6, 7, 8, 9]
+    >>> seq5[1] = 'x' * 1000
+    >>> seq5[9]
+    9
+    >>> seq5._page_locations[0][1] < 1000   # (compressed)
+    True
+    >>> seq5[1] == 'x' * 1000
+    True
+    >>> seq5.close()
     """
 
-    def __init__(self, iterable=(), page_size=1000):
+    def __init__(self, iterable=(), page_size=1000, compress_level=0):
         self._page_size = page_size
+        self._compress_level = compress_level
         self._cur_len = 0
         self._cur_page_no = None
         self._cur_page_data = []
+        self._cur_page_modified = False
+        self._page_locations = {}  # page number -> (offset, length, capacity)
+        self._file_end = 0
         self._closed = False
         self.extend(iterable)
 
@@ -680,6 +715,17 @@ class FilePagedSequence(collections.MutableSequence):
     def __setitem__(self, index, value):
         local_index = self._local_index(index)
         self._cur_page_data[local_index] = value
+        self._cur_page_modified = True
+
+    def __iter__(self):
+        page_size = self._page_size
+        index = 0
+        while index < self._cur_len:
+            page_no, local_index = divmod(index, page_size)
+            if page_no != self._cur_page_no:
+                self._switch_to(page_no)
+            yield self._cur_page_data[local_index]
+            index += 1
 
     def __reversed__(self):
         for i in xrange(len(self) - 1, -1, -1):
@@ -690,6 +736,7 @@ class FilePagedSequence(collections.MutableSequence):
         if page_no != self._cur_page_no:
             self._switch_to(page_no, new=(local_index == 0))
         self._cur_page_data.append(value)
+        self._cur_page_modified = True
         self._cur_len += 1
 
     def pop(self, index=-1):
@@ -698,6 +745,7 @@ class FilePagedSequence(collections.MutableSequence):
                                       'than -1 is not supported')
         local_index = self._local_index(-1)
         value = self._cur_page_data.pop(local_index)
+        self._cur_page_modified = True
         self._cur_len -= 1
         return value
 
@@ -722,26 +770,29 @@ class FilePagedSequence(collections.MutableSequence):
     def clear(self):
         self._cur_page_data = []
         self._cur_page_no = None
+        self._cur_page_modified = False
         self._cur_len = 0
+        # (the space within the spill file will be reused)
+        self._page_locations.clear()
+        self._file_end = 0
 
     def close(self):
         if not self._closed:
             self.clear()
             if self._filesystem_used():
-                for filename in os.listdir(self._dir):
-                    os.remove(osp.join(self._dir, filename))
-                os.rmdir(self._dir)
+                self._file.close()
             self._closed = True
 
     #
     # Non-public stuff
 
     @reify
-    def _dir(self):
-        return tempfile.mkdtemp(prefix='n6-FilePagedSequence-tmp')
+    def _file(self):
+        # (the file is removed automatically when closed)
+        return tempfile.TemporaryFile(prefix='n6-FilePagedSequence-tmp')
 
     def _filesystem_used(self):
-        return '_dir' in self.__dict__
+        return '_file' in self.__dict__
 
     def _local_index(self, index):
         if isinstance(index, slice):
@@ -757,22 +808,40 @@ class FilePagedSequence(collections.MutableSequence):
             raise IndexError
 
     def _switch_to(self, page_no, new=False):
-        if self._cur_page_no is not None:
-            # save the current page
-            with open(self._get_page_filename(self._cur_page_no), 'wb') as f:
-                cPickle.dump(self._cur_page_data, f, -1)
+        if self._cur_page_no is not None and self._cur_page_modified:
+            self._save_cur_page()
         if new:
             # initialize a new page...
             self._cur_page_data = []
         else:
             # load an existing page...
-            with open(self._get_page_filename(page_no), 'rb') as f:
-                self._cur_page_data = cPickle.load(f)
+            self._cur_page_data = self._load_page(page_no)
         # ...and set it as the current one
         self._cur_page_no = page_no
-
-    def _get_page_filename(self, page_no):
-        return osp.join(self._dir, str(page_no))
+        self._cur_page_modified = False
+
+    def _save_cur_page(self):
+        data = cPickle.dumps(self._cur_page_data, cPickle.HIGHEST_PROTOCOL)
+        if self._compress_level:
+            data = zlib.compress(data, self._compress_level)
+        length = len(data)
+        offset, _, capacity = self._page_locations.get(self._cur_page_no, (None, 0, 0))
+        if length > capacity:
+            # (the page does not fit in its previous place -- if any)
+            offset = self._file_end
+            capacity = length
+            self._file_end += length
+        self._file.seek(offset)
+        self._file.write(data)
+        self._page_locations[self._cur_page_no] = offset, length, capacity
+
+    def _load_page(self, page_no):
+        offset, length, _ = self._page_locations[page_no]
+        self._file.seek(offset)
+        data = self._file.read(length)
+        if self._compress_level:
+            data = zlib.decompress(data)
+        return cPickle.loads(data)
 
     #
     # Unittest helper (to test a code that makes use of instances of the class)
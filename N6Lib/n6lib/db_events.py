@@ -293,3 +293,9 @@ class n6NormalizedData(Base):
             result_dict['client'] = client
 
         return result_dict
+
+
+# names of the `event` table's columns -- in the order of the table's
+# columns (see: n6lib.record_dict.RecordDict.iter_db_rows())
+n6NormalizedData.column_names = tuple(
+    column.name for column in n6NormalizedData.__table__.columns)
@@ -2,6 +2,7 @@
 
 # Copyright (c) 2013-2018 NASK. All rights reserved.
 
+import bisect
 from operator import eq, gt, ge, lt, le, contains
 
 import sqlalchemy
@@ -119,11 +120,15 @@ class _PredicateCondMixin(object):
 
     @reify
     def predicate(self):
-        return self.make_predicate_func()
+        return self.make_compiled_predicate_func()
 
     def make_predicate_func(self):
         raise NotImplementedError
 
+    def make_compiled_predicate_func(self):
+        # (see: _PredicateCompiler below)
+        return _PredicateCompiler(self).compile()
+
 
 class _PredicateMultiCondMixin(_PredicateCondMixin):
 
@@ -160,10 +165,7 @@ class PredicateColumnCond(_PredicateCondMixin, AbstractColumnCond):
             if val is _not_found:
                 return False
             if val is None:
-                raise ValueError(
-                    'values being None are not supported (None found '
-                    'for column {!r} in the record: {!r})'.format(
-                        column_name, record))
+                _raise_value_is_none(column_name, record)
             if reverse_operands:
                 return op_func(op_arg, val)
             else:
@@ -193,6 +195,260 @@ class PredicateOrCond(_PredicateMultiCondMixin, AbstractOrCond):
     RESULT_FOR_NOTHING = False
 
 
+# the compiler of Predicate*Cond trees:
+
+class _PredicateCompiler(object):
+
+    """
+    A compiler that turns a tree of Predicate*Cond instances into the
+    source code of one Python function, and then compile()s it.
+
+    The resultant predicate behaves exactly like the one made with
+    the make_predicate_func() method of the root condition (a nested
+    closure tree), but is much cheaper to call: the whole tree is
+    evaluated inline (in one frame, with local/global variable
+    lookups only); `in_()` conditions are checked against frozensets
+    (if possible), consecutive `between()` conditions on the same
+    column are merged into one loop over precomputed ranges, and the
+    values of `_ComparableMultiValue` instances are iterated over
+    directly.
+
+    >>> b = PredicateConditionBuilder()
+    >>> cond = b.and_(
+    ...     b['source'] == 'foo.bar',
+    ...     b.or_(b['asn'].in_([1, 2]),
+    ...           b['ip'].between(10, 20),
+    ...           b['ip'].between(15, 30)),
+    ...     b.not_(b['restriction'] == 'internal'))
+    >>> pred = _PredicateCompiler(cond).compile()
+    >>> pred({'source': 'foo.bar', 'restriction': 'public',
+    ...       'asn': _ComparableMultiValue([3, 2])})
+    True
+    >>> pred({'source': 'foo.bar', 'restriction': 'public',
+    ...       'ip': _ComparableMultiValue([1, 25])})
+    True
+    >>> pred({'source': 'foo.bar', 'restriction': 'internal', 'ip': 25})
+    False
+    >>> pred({'source': 'foo.bar', 'restriction': 'public', 'ip': 31})
+    False
+    >>> pred({'source': 'foo.bar', 'ip': None})   # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+      ...
+    ValueError: ...
+    """
+
+    _COMPARISON_OP_TO_SYMBOL = {
+        eq: '==',
+        gt: '>',
+        ge: '>=',
+        lt: '<',
+        le: '<=',
+    }
+
+    def __init__(self, cond):
+        self._cond = cond
+        self._namespace = {
+            '_NOT_FOUND': object(),
+            '_ComparableMultiValue': _ComparableMultiValue,
+            '_raise_value_is_none': _raise_value_is_none,
+        }
+        self._const_names = {}
+        self._lines = []
+
+    def compile(self):
+        self._lines[:] = ['def _predicate(record):']
+        self._gen_cond(self._cond, 1)
+        self._lines.append('    return r')
+        source = '\n'.join(self._lines) + '\n'
+        code = compile(source, '<compiled predicate>', 'exec')
+        exec code in self._namespace
+        predicate = self._namespace['_predicate']
+        predicate.source = source
+        return predicate
+
+    # code generation helpers
+
+    def _emit(self, depth, line):
+        self._lines.append('    ' * depth + line)
+
+    def _const(self, value):
+        # (note: we do not use value-based deduplication as the
+        # values are not necessarily hashable)
+        name = self._const_names.get(id(value))
+        if name is None:
+            name = '_c{}'.format(len(self._const_names))
+            self._const_names[id(value)] = name
+            self._namespace[name] = value
+        return name
+
+    def _gen_cond(self, cond, depth):
+        # generates code that evaluates `cond` and assigns the
+        # result (True or False) to the `r` local variable
+        if isinstance(cond, PredicateAndCond):
+            self._gen_multi_cond(cond.conditions, depth, stop_on=False)
+        elif isinstance(cond, PredicateOrCond):
+            self._gen_multi_cond(cond.conditions, depth, stop_on=True)
+        elif isinstance(cond, PredicateNotCond):
+            self._gen_cond(cond.cond, depth)
+            self._emit(depth, 'r = not r')
+        elif isinstance(cond, PredicateColumnCond):
+            self._gen_column_cond(cond, depth)
+        else:
+            # some other kind of condition (we just call its predicate)
+            func_name = self._const(cond.make_predicate_func())
+            self._emit(depth, 'r = bool({}(record))'.format(func_name))
+
+    def _gen_multi_cond(self, conditions, depth, stop_on):
+        if stop_on:
+            # (alternative)
+            groups = self._group_between_conds(conditions)
+        else:
+            # (conjunction)
+            groups = list(conditions)
+        if not groups:
+            self._emit(depth, 'r = {!r}'.format(not stop_on))
+        elif len(groups) == 1:
+            self._gen_group(groups[0], depth)
+        else:
+            # a one-pass loop (so that `break` can be used to
+            # short-circuit the evaluation without deep nesting)
+            self._emit(depth, 'while 1:')
+            for group in groups[:-1]:
+                self._gen_group(group, depth + 1)
+                self._emit(depth + 1, 'if {}r:'.format('' if stop_on else 'not '))
+                self._emit(depth + 2, 'break')
+            self._gen_group(groups[-1], depth + 1)
+            self._emit(depth + 1, 'break')
+
+    def _group_between_conds(self, conditions):
+        # consecutive `between()` conditions on the same column
+        # (with integer bounds) are grouped together (so that they
+        # can be checked in one loop -- see: _gen_group())
+        groups = []
+        for cond in conditions:
+            if self._is_mergeable_between_cond(cond):
+                if groups:
+                    prev = groups[-1]
+                    if (isinstance(prev, list) and
+                          prev[0].column_name == cond.column_name):
+                        prev.append(cond)
+                        continue
+                groups.append([cond])
+            else:
+                groups.append(cond)
+        return groups
+
+    def _gen_group(self, group, depth):
+        if isinstance(group, list):
+            if len(group) == 1:
+                self._gen_column_cond(group[0], depth)
+            else:
+                self._gen_merged_between_conds(group, depth)
+        else:
+            self._gen_cond(group, depth)
+
+    @staticmethod
+    def _is_mergeable_between_cond(cond):
+        return (isinstance(cond, PredicateColumnCond) and
+                cond.op_func is _apply_between_op and
+                not cond.reverse_operands and
+                all(isinstance(bound, (int, long)) for bound in cond.op_arg))
+
+    def _gen_column_cond(self, cond, depth):
+        op_func = cond.op_func
+        op_arg = cond.op_arg
+        if cond.reverse_operands:
+            if op_func is contains and self._is_frozenset_convertible(op_arg):
+                self._gen_column_value_test(cond.column_name, depth, lambda x, d: (
+                    self._gen_membership_test(x, op_arg, d)))
+                return
+        elif op_func in self._COMPARISON_OP_TO_SYMBOL:
+            expr = 'x {} {}'.format(self._COMPARISON_OP_TO_SYMBOL[op_func],
+                                    self._const(op_arg))
+            self._gen_column_value_test(cond.column_name, depth, lambda x, d: (
+                self._emit(d, 'hit = {}'.format(expr))))
+            return
+        elif op_func is _apply_between_op:
+            min_value, max_value = op_arg
+            expr = '{} <= x <= {}'.format(self._const(min_value), self._const(max_value))
+            self._gen_column_value_test(cond.column_name, depth, lambda x, d: (
+                self._emit(d, 'hit = {}'.format(expr))))
+            return
+        # any other operation: just call the operator function
+        # (exactly as the closure-based predicate does)
+        operands = [self._const(op_arg), 'v']
+        if not cond.reverse_operands:
+            operands.reverse()
+        self._gen_column_value_fetch(cond.column_name, depth)
+        self._emit(depth + 1, 'r = bool({}({}, {}))'.format(self._const(op_func), *operands))
+
+    def _gen_merged_between_conds(self, conds, depth):
+        # merging overlapping ranges (the result is the same
+        # for any totally ordered values)
+        ranges = []
+        for min_value, max_value in sorted(cond.op_arg for cond in conds):
+            if ranges and min_value <= ranges[-1][1]:
+                ranges[-1][1] = max(ranges[-1][1], max_value)
+            else:
+                ranges.append([min_value, max_value])
+        ranges_name = self._const(tuple(map(tuple, ranges)))
+        def gen_test(x, d):
+            self._emit(d, 'hit = False')
+            self._emit(d, 'for lo, hi in {}:'.format(ranges_name))
+            self._emit(d + 1, 'if x < lo:')
+            self._emit(d + 2, 'break')
+            self._emit(d + 1, 'if x <= hi:')
+            self._emit(d + 2, 'hit = True')
+            self._emit(d + 2, 'break')
+        self._gen_column_value_test(conds[0].column_name, depth, gen_test)
+
+    def _gen_membership_test(self, x, op_arg, depth):
+        self._emit(depth, 'try:')
+        self._emit(depth + 1, 'hit = x in {}'.format(self._const(frozenset(op_arg))))
+        self._emit(depth, 'except TypeError:')
+        self._emit(depth + 1, 'hit = x in {}'.format(self._const(op_arg)))
+
+    @staticmethod
+    def _is_frozenset_convertible(op_arg):
+        if not isinstance(op_arg, (list, tuple, set, frozenset)):
+            return False
+        try:
+            frozenset(op_arg)
+        except TypeError:
+            return False
+        return True
+
+    def _gen_column_value_fetch(self, column_name, depth):
+        # generates code that gets the column value as `v` and
+        # then opens an `else:` block (to be filled by the caller)
+        column_name_const = self._const(column_name)
+        self._emit(depth, 'v = record.get({}, _NOT_FOUND)'.format(column_name_const))
+        self._emit(depth, 'if v is _NOT_FOUND:')
+        self._emit(depth + 1, 'r = False')
+        self._emit(depth, 'elif v is None:')
+        self._emit(depth + 1, '_raise_value_is_none({}, record)'.format(column_name_const))
+        self._emit(depth, 'else:')
+
+    def _gen_column_value_test(self, column_name, depth, gen_test):
+        # `gen_test(<var name>, <depth>)` should generate code that
+        # assigns to `hit` the result of testing the `x` variable
+        self._gen_column_value_fetch(column_name, depth)
+        self._emit(depth + 1, 'r = False')
+        self._emit(depth + 1, 'for x in (v._values if v.__class__ is _ComparableMultiValue '
+                              'else (v,)):')
+        gen_test('x', depth + 2)
+        self._emit(depth + 2, 'if hit:')
+        self._emit(depth + 3, 'r = True')
+        self._emit(depth + 3, 'break')
+
+
+def _raise_value_is_none(column_name, record):
+    raise ValueError(
+        'values being None are not supported (None found '
+        'for column {!r} in the record: {!r})'.format(
+            column_name, record))
+
+
 
 #
 # Data filtering condition builder classes
@@ -1487,6 +1743,208 @@ class _ComparableMultiValue(object):
 
 
 
+class PredicateIndex(object):
+
+    """
+    An inverted index of predicate conditions that makes it possible to
+    quickly select -- for a given record -- the keys whose conditions
+    can be satisfied, *without* evaluating all the conditions.
+
+    Constructor args/kwargs:
+        `key_to_cond`:
+            A dict that maps keys (e.g., subsource DNs) to condition
+            objects made with PredicateConditionBuilder (or to plain
+            predicate functions -- then they are treated as
+            non-indexable ones).
+
+    For each condition, the first of its top-level conjuncts that is
+    *indexable* -- i.e., that is an `==`/`in_()` condition on one of
+    the INDEXED_EQUALITY_COLUMNS or a `between()` condition on one of
+    the INDEXED_RANGE_COLUMNS, or an alternative (`or_()`) of such
+    conditions -- is put into the index; the remaining conjuncts make
+    up the *residual* predicate.  Keys whose conditions do not have any
+    indexable conjunct are always candidates (then the residual
+    predicate is just the whole predicate).
+
+    The iter_matching_candidates() method takes a record (typically, a
+    RecordFacadeForPredicates instance) and generates (<key>, <residual
+    predicate>) pairs -- *only* for the keys whose indexed conjunct is
+    satisfied; a key's condition is satisfied if and only if the key
+    is generated *and* its residual predicate returns True.
+
+    >>> b = PredicateConditionBuilder()
+    >>> index = PredicateIndex({
+    ...     'bots': b.and_(b['category'].in_(['bots', 'cnc']),
+    ...                    b.not_(b['restriction'] == 'internal')),
+    ...     'net': b.and_(b['ip'].between(10, 20)),
+    ...     'any': b.not_(b['name'] == 'foo'),
+    ...     'func': (lambda record: True),
+    ... })
+    >>> def matching(record):
+    ...     return sorted(key for key, residual_predicate
+    ...                   in index.iter_matching_candidates(record)
+    ...                   if residual_predicate(record))
+
+    >>> matching({'category': 'bots', 'restriction': 'public', 'name': 'foo'})
+    ['bots', 'func']
+    >>> matching({'category': 'cnc', 'restriction': 'internal', 'ip': 15})
+    ['any', 'func', 'net']
+    >>> matching({'category': 'phish', 'ip': _ComparableMultiValue([1, 20])})
+    ['any', 'func', 'net']
+    >>> matching({'category': 'phish', 'ip': 21})
+    ['any', 'func']
+    """
+
+    INDEXED_EQUALITY_COLUMNS = frozenset(['category', 'name', 'restriction', 'cc', 'asn'])
+    INDEXED_RANGE_COLUMNS = frozenset(['ip'])
+
+    def __init__(self, key_to_cond):
+        self._key_to_predicate = {}
+        self._key_to_residual_predicate = {}
+        self._always_candidate_keys = []
+        self._column_to_value_to_keys = {}
+        self._column_to_ranges = {}
+        for key, cond in sorted(key_to_cond.iteritems()):  # (sorting to make the order deterministic)
+            self._add(key, cond)
+        self._column_to_range_segments = {
+            column: self._make_range_segments(ranges)
+            for column, ranges in self._column_to_ranges.iteritems()}
+        del self._column_to_ranges
+
+    def iter_matching_candidates(self, record, _missing=object()):
+        candidate_keys = set(self._always_candidate_keys)
+        try:
+            for column, value_to_keys in self._column_to_value_to_keys.iteritems():
+                value = record.get(column, _missing)
+                if value is _missing:
+                    continue
+                if value is None:
+                    raise _IndexNotApplicable
+                for val in _iter_record_values(value):
+                    keys = value_to_keys.get(val)
+                    if keys:
+                        candidate_keys.update(keys)
+            for column, (boundaries, segments) in self._column_to_range_segments.iteritems():
+                value = record.get(column, _missing)
+                if value is _missing:
+                    continue
+                if value is None:
+                    raise _IndexNotApplicable
+                for val in _iter_record_values(value):
+                    candidate_keys.update(segments[bisect.bisect_right(boundaries, val)])
+        except (_IndexNotApplicable, TypeError):
+            # (e.g., a None or unhashable value -- so we fall back to
+            # the whole predicates, to behave *exactly* as they do)
+            return self._key_to_predicate.iteritems()
+        key_to_residual_predicate = self._key_to_residual_predicate
+        return ((key, key_to_residual_predicate[key]) for key in candidate_keys)
+
+    def _add(self, key, cond):
+        if not isinstance(cond, BaseCond):
+            # a plain predicate function
+            self._key_to_predicate[key] = self._key_to_residual_predicate[key] = cond
+            self._always_candidate_keys.append(key)
+            return
+        self._key_to_predicate[key] = cond.predicate
+        conjuncts = list(_iter_flattened_conds(cond, AbstractAndCond))
+        for i, conjunct in enumerate(conjuncts):
+            index_entries = self._get_index_entries(conjunct)
+            if index_entries is not None:
+                residual_conjuncts = conjuncts[:i] + conjuncts[i+1:]
+                break
+        else:
+            self._key_to_residual_predicate[key] = cond.predicate
+            self._always_candidate_keys.append(key)
+            return
+        for column, values, value_range in index_entries:
+            if value_range is None:
+                value_to_keys = self._column_to_value_to_keys.setdefault(column, {})
+                for val in values:
+                    value_to_keys.setdefault(val, set()).add(key)
+            else:
+                self._column_to_ranges.setdefault(column, []).append(value_range + (key,))
+        self._key_to_residual_predicate[key] = PredicateAndCond(*residual_conjuncts).predicate
+
+    def _get_index_entries(self, cond):
+        # returns a list of (<column>, <values or None>, <(min, max) or None>)
+        # or None (if the condition is not indexable)
+        index_entries = []
+        for disjunct in _iter_flattened_conds(cond, AbstractOrCond):
+            if not isinstance(disjunct, AbstractColumnCond):
+                return None
+            column = disjunct.column_name
+            if column in self.INDEXED_EQUALITY_COLUMNS:
+                if disjunct.label == 'eq' and not disjunct.reverse_operands:
+                    values = (disjunct.op_arg,)
+                elif (disjunct.label == 'contains' and disjunct.reverse_operands and
+                      isinstance(disjunct.op_arg, (list, tuple, set, frozenset))):
+                    values = tuple(disjunct.op_arg)
+                else:
+                    return None
+                if not all(_is_hashable(val) for val in values):
+                    return None
+                index_entries.append((column, values, None))
+            elif column in self.INDEXED_RANGE_COLUMNS and disjunct.label == 'between':
+                min_value, max_value = disjunct.op_arg
+                if not (isinstance(min_value, (int, long)) and
+                        isinstance(max_value, (int, long))):
+                    return None
+                index_entries.append((column, None, (min_value, max_value)))
+            else:
+                return None
+        if not index_entries:
+            # (an empty alternative is never satisfied -- but let's
+            # keep it simple and treat it as non-indexable)
+            return None
+        return index_entries
+
+    @staticmethod
+    def _make_range_segments(ranges):
+        # returns a pair: (<sorted segment boundaries>, <list of key sets>)
+        # -- where the key set at the index returned by `bisect_right(
+        # <boundaries>, <value>)` is the set of the keys whose ranges
+        # contain the value
+        boundaries = sorted(
+            set(min_value for min_value, _, _ in ranges) |
+            set(max_value + 1 for _, max_value, _ in ranges))
+        interned = {}
+        segments = [frozenset()]
+        for segment_start in boundaries:
+            keys = frozenset(
+                key for min_value, max_value, key in ranges
+                if min_value <= segment_start <= max_value)
+            segments.append(interned.setdefault(keys, keys))
+        return boundaries, segments
+
+
+class _IndexNotApplicable(Exception):
+    pass
+
+
+def _iter_flattened_conds(cond, multi_cond_class):
+    if isinstance(cond, multi_cond_class):
+        for subcond in cond.conditions:
+            for c in _iter_flattened_conds(subcond, multi_cond_class):
+                yield c
+    else:
+        yield cond
+
+
+def _is_hashable(value):
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+
+def _iter_record_values(value):
+    if isinstance(value, _ComparableMultiValue):
+        return value._values
+    return (value,)
+
+
+
 if __name__ == '__main__':
     from n6lib.unit_test_helpers import run_module_doctests
     run_module_doctests()
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2019 NASK. All rights reserved.
+
+import cPickle
+import errno
+import os
+import os.path
+import struct
+import time
+import zlib
+
+from n6lib.log_helpers import get_logger
+
+
+LOGGER = get_logger(__name__)
+
+
+
+class AppendOnlyRecordLog(object):
+
+    r"""
+    A file-based, append-only log of picklable records -- intended to be
+    used (together with periodic snapshots, see: dump_pickle_atomically())
+    to persist the state of a component incrementally (so that, e.g., an
+    abrupt termination does not cause the loss of the whole state).
+
+    Constructor args/kwargs:
+        `path`:
+            The path of the log file (it will be created if it does not
+            exist; if it exists new records will be appended to it).
+        `fsync_interval` (default: 0):
+            The maximum time (in seconds) between appending a record
+            and synchronizing the file's state with the storage device
+            (using os.fsync()).  If it is 0 (or negative) each append()
+            is followed by fsync().  Note that -- regardless of this
+            setting -- each appended record is immediately flushed to
+            the operating system (so a termination of the process
+            itself, e.g., because of SIGKILL, does not cause any data
+            loss; the `fsync_interval` window is relevant only for
+            crashes of the whole system).
+        `time_func` (default: time.time):
+            A function used to determine current time.
+
+    Each record is stored as a frame consisting of: the length of the
+    pickled data and their CRC32 checksum (as two 4-byte unsigned
+    integers), followed by the pickled data.  When iterating over the
+    records (see: iter_records()) an incomplete or corrupted frame at
+    the end of the file (e.g., being the result of a crash during a
+    write) is logged and truncated.
+
+    >>> import tempfile, shutil
+    >>> tmp_dir = tempfile.mkdtemp()
+    >>> path = os.path.join(tmp_dir, 'example.log')
+    >>> log = AppendOnlyRecordLog(path)
+    >>> log.append(('foo', 1))
+    >>> log.append({'bar': [u'spam']})
+    >>> log.record_count
+    2
+    >>> list(log.iter_records())
+    [('foo', 1), {'bar': [u'spam']}]
+    >>> log.close()
+
+    >>> with open(path, 'ab') as f:
+    ...     f.write('\x00\x00\x00')   # (e.g., a crash during a write)
+    >>> log = AppendOnlyRecordLog(path)
+    >>> list(log.iter_records())
+    [('foo', 1), {'bar': [u'spam']}]
+    >>> log.append(42)
+    >>> list(log.iter_records())
+    [('foo', 1), {'bar': [u'spam']}, 42]
+    >>> log.record_count
+    3
+    >>> offset = log.end_offset
+    >>> log.append('spam')
+    >>> list(log.iter_records(start_offset=offset))
+    ['spam']
+    >>> log.record_count
+    4
+    >>> log.clear()
+    >>> list(log.iter_records())
+    []
+    >>> log.record_count
+    0
+    >>> log.close()
+    >>> shutil.rmtree(tmp_dir)
+    """
+
+    _FRAME_HEADER = struct.Struct('>II')
+
+    def __init__(self, path, fsync_interval=0, time_func=time.time):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self._time_func = time_func
+        self._file = open(path, 'ab')
+        self._last_fsync_time = self._time_func()
+        self._fsync_pending = False
+        self.record_count = 0
+        self.end_offset = 0
+        self._counted_size = 0   # (the size of the part of the file covered by `record_count`)
+
+    def __repr__(self):
+        return '<{} {!r}>'.format(self.__class__.__name__, self.path)
+
+    def append(self, record):
+        data = cPickle.dumps(record, cPickle.HIGHEST_PROTOCOL)
+        header = self._FRAME_HEADER.pack(len(data), zlib.crc32(data) & 0xffffffff)
+        self._file.write(header + data)
+        self._file.flush()
+        self.record_count += 1
+        self._counted_size = self._file.tell()
+        self._fsync_pending = True
+        if self._time_func() - self._last_fsync_time >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        """Make sure that all appended records are written to the storage device."""
+        if self._fsync_pending:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._fsync_pending = False
+        self._last_fsync_time = self._time_func()
+
+    def iter_records(self, start_offset=0, truncate_incomplete_tail=True):
+        """
+        Iterate over the records in the log.
+
+        Kwargs:
+            `start_offset` (default: 0):
+                The file offset to start from -- typically, the value
+                of the `end_offset` attribute after a previous
+                iteration (to read only the records appended since
+                then).
+            `truncate_incomplete_tail` (default: True):
+                Whether an incomplete or corrupted frame at the end of
+                the file should be truncated.  It should be set to
+                False if another process may still be appending to the
+                log (then such a frame is just not read yet).
+
+        The `record_count` attribute is updated accordingly, and the
+        `end_offset` attribute is set to the offset just after the last
+        record read.
+        """
+        self._file.flush()
+        if start_offset == 0:
+            self.record_count = 0
+            self._counted_size = 0
+        self.end_offset = start_offset
+        with open(self.path, 'rb') as f:
+            f.seek(start_offset)
+            while True:
+                header = f.read(self._FRAME_HEADER.size)
+                if not header:
+                    break
+                data = None
+                if len(header) == self._FRAME_HEADER.size:
+                    length, checksum = self._FRAME_HEADER.unpack(header)
+                    data = f.read(length)
+                    if len(data) != length or zlib.crc32(data) & 0xffffffff != checksum:
+                        data = None
+                if data is None:
+                    if truncate_incomplete_tail:
+                        LOGGER.warning('Incomplete or corrupted record found at the end of '
+                                       '%r (at byte %d) -- it will be truncated.',
+                                       self.path, self.end_offset)
+                        self._truncate(self.end_offset)
+                    break
+                self.end_offset = f.tell()
+                if self.end_offset > self._counted_size:
+                    self.record_count += 1
+                    self._counted_size = self.end_offset
+                yield cPickle.loads(data)
+
+    def clear(self):
+        """Remove all records (typically, just after a snapshot has been made)."""
+        self._truncate(0)
+        self.record_count = 0
+        self.end_offset = 0
+        self._counted_size = 0
+
+    def close(self):
+        if not self._file.closed:
+            self.sync()
+            self._file.close()
+
+    def _truncate(self, size):
+        self._file.flush()
+        self._file.truncate(size)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._fsync_pending = False
+        self._last_fsync_time = self._time_func()
+
+
+
+def dump_pickle_atomically(obj, path):
+    """
+    Pickle the given object to a file in such a way that the file
+    (at the given `path`) always contains either the previous content
+    or the new one, in its entirety (even if the system crashes in the
+    middle of the operation).
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        cPickle.dump(obj, f, cPickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+    _fsync_dir(os.path.dirname(os.path.abspath(path)))
+
+
+def _fsync_dir(dir_path):
+    try:
+        dir_fd = os.open(dir_path, os.O_RDONLY)
+    except OSError as exc:
+        if exc.errno != errno.EACCES:
+            raise
+        return
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+
+if __name__ == '__main__':
+    from n6lib.unit_test_helpers import run_module_doctests
+    run_module_doctests()
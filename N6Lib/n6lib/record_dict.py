@@ -6,23 +6,23 @@
 # TODO: more comments + docs
 #
 
+import abc
 import base64
+import calendar
 import collections
 import copy
+import datetime
 import functools
 import json
+import random
 import re
-import sys
-
-try:
-    from bson.json_util import dumps
-except ImportError:
-    print >> sys.stderr, "Warning: bson is required to run parsers"
+import types
 
 from n6lib.class_helpers import AsciiMixIn, attr_repr
 from n6lib.common_helpers import (
     LimitedDict,
     ascii_str,
+    ip_str_to_int,
     ipv4_to_str,
     provide_surrogateescape,
     string_as_bytes,
@@ -116,6 +116,59 @@ def preceded_by(*adjusters):
     return decorator
 
 
+def memoized_adjuster(adjuster, max_size=1000):
+    """
+    Wrap a pure adjuster, so that its results are cached.
+
+    A pure adjuster's result (or raised exception) depends only on the
+    value and on the record dict's class.  For example, a
+    make_adjuster_using_data_spec()-made adjuster without
+    `on_too_long`.
+
+    Only values and results of the simple immutable types (str,
+    unicode, int, etc.) are cached.  An exception is cached too, unless
+    it has the `propagate_it_anyway` attribute.  When the number of
+    cached entries reaches `max_size`, the cache is cleared.  So it
+    makes sense to use this wrapper only for low-cardinality fields,
+    such as `category`.
+
+    Cache hits and misses are counted (see:
+    RecordDict.get_memoized_adjusters_stats()).
+    """
+    cache = {}
+    counters = [0, 0]   # [<hits>, <misses>]
+    def _memoized_adjuster(self, value):
+        value_type = type(value)
+        if value_type not in _IMMUTABLE_READY_VALUE_TYPES:
+            return adjuster(self, value)
+        key = (self.__class__, value_type, value)
+        cached = cache.get(key)
+        if cached is not None:
+            counters[0] += 1
+            result, exc = cached
+            if exc is not None:
+                raise exc
+            return result
+        counters[1] += 1
+        if len(cache) >= max_size:
+            cache.clear()
+        try:
+            result = adjuster(self, value)
+        except Exception as exc:
+            if not hasattr(exc, 'propagate_it_anyway'):
+                cache[key] = (None, exc)
+            raise
+        if type(result) in _IMMUTABLE_READY_VALUE_TYPES:
+            cache[key] = (result, None)
+        return result
+    _memoized_adjuster._factory_names = getattr(
+          adjuster, '_factory_names', frozenset())
+    # additional attrs for introspection:
+    _memoized_adjuster._memo_cache = cache
+    _memoized_adjuster._memo_counters = counters
+    return _memoized_adjuster
+
+
 def adjuster_factory(adjuster_template_func):
     """
     Decorator for making adjuster factories.
@@ -354,18 +407,118 @@ def trim_domain_seq(value, max_length):
     return [trim_domain(v, max_length) for v in value]
 
 
+#
+# Auxiliary functions
+
+_IMMUTABLE_READY_VALUE_TYPES = frozenset([
+    str, unicode, int, long, float, bool, type(None),
+])
+
+def _copy_ready_value(value):
+    """
+    Make a deep copy of a (JSON-like) record dict value.
+
+    It is much faster than copy.deepcopy() for the structures record
+    dict values consist of (nested dicts/lists/tuples of strings and
+    numbers); for any other objects copy.deepcopy() is used.
+    """
+    value_type = type(value)
+    if value_type in _IMMUTABLE_READY_VALUE_TYPES:
+        return value
+    if value_type is dict:
+        return {key: _copy_ready_value(val) for key, val in value.iteritems()}
+    if value_type is list:
+        return map(_copy_ready_value, value)
+    if value_type is tuple:
+        return tuple(map(_copy_ready_value, value))
+    return copy.deepcopy(value)
+
+def _json_default(obj):
+    # Used as the `default` argument for json.dumps() -- to produce
+    # output identical to what bson.json_util.dumps() (formerly used
+    # by RecordDict.get_ready_json()) produced for the same data.
+    if isinstance(obj, datetime.datetime):
+        offset = obj.utcoffset()
+        if offset is not None:
+            obj = obj - offset
+        return {'$date': int(calendar.timegm(obj.timetuple()) * 1000 +
+                             obj.microsecond // 1000)}
+    if isinstance(obj, collections.Mapping):
+        return collections.OrderedDict(obj.iteritems())
+    if hasattr(obj, '__iter__'):
+        return list(obj)
+    raise TypeError('{!r} is not JSON serializable'.format(obj))
+
+
 #
 # The actual record dict classes
 
+class _MutableMappingWithSlots(object):
+
+    """
+    An equivalent of collections.MutableMapping that defines `__slots__`.
+
+    In Python 2.7 the `collections` ABCs do not define `__slots__`, so
+    instances of their subclasses always have `__dict__`.  This class
+    provides the same mixin methods instead, and it is registered as
+    a virtual subclass of collections.MutableMapping (so isinstance()
+    checks against the `collections` ABCs still work).
+    """
+
+    __slots__ = ()
+    __hash__ = None
+
+    # (used by the pop() method copied from collections.MutableMapping)
+    _MutableMapping__marker = collections.MutableMapping._MutableMapping__marker
+
+for _name in ('__contains__', '__eq__', '__ne__',
+              'get', 'keys', 'items', 'values',
+              'iterkeys', 'itervalues', 'iteritems',
+              'pop', 'popitem', 'clear', 'update', 'setdefault'):
+    setattr(_MutableMappingWithSlots, _name,
+            getattr(collections.MutableMapping, _name).im_func)
+del _name
+
+collections.MutableMapping.register(_MutableMappingWithSlots)
+
+
+class _RecordDictMeta(abc.ABCMeta):
+
+    """
+    The metaclass of record dict classes: for each such class it
+    compiles (once, when the class is created) the mapping of the
+    settable keys to the respective adjusters (see:
+    RecordDict._compile_adjusters()).
+    """
+
+    def __init__(cls, name, bases, attrs):
+        super(_RecordDictMeta, cls).__init__(name, bases, attrs)
+        cls._compile_adjusters()
+
+
 ### CR: TODO: docstrings for public methods
 ### (especially get_ready_dict et consortes...)
 
-class RecordDict(collections.MutableMapping):
+class RecordDict(_MutableMappingWithSlots):
 
     """
     Record dict class for non-blacklist events.
     """
 
+    __metaclass__ = _RecordDictMeta
+
+    # no per-instance `__dict__` (record dicts may be kept in memory in
+    # large numbers); note: subclasses should also define `__slots__`
+    # (at least an empty one) to preserve that
+    __slots__ = (
+        '_dict',
+        '_ready_json',   # the cached result of get_ready_json() (or None)
+        '_mutable_value_handed_out',   # if true, get_ready_json() does not cache
+        'log_nonstandard_names',
+        'context_manager_error_callback',
+        'used_as_context_manager',
+    )
+
     _ADJUSTER_PREFIX = 'adjust_'
     _APPENDER_PREFIX = 'append_'
 
@@ -422,35 +575,106 @@ class RecordDict(collections.MutableMapping):
         'url_pattern',
     })
 
+    # the name and the value of the AMQP header with which n6 components
+    # mark messages whose bodies have been produced by get_ready_json()
+    # (see: from_json() with `trusted=True`); the value should be
+    # incremented whenever the keys or adjusters are changed in such a
+    # way that data serialized earlier could not be trusted anymore
+    TRUSTED_JSON_HEADER = 'n6-record-dict-json'
+    TRUSTED_JSON_VERSION = 1
+
+    # for the following keys, values deserialized from trusted JSON
+    # (see: from_json()) need to be converted to get the same types
+    # the adjusters would produce
+    trusted_json_converters = {
+        'time': str,
+        'modified': str,
+        'until': str,
+        'expires': str,
+        'enriched': tuple,
+        '_first_time': str,
+        '_bl-time': str,
+        '_bl-current-time': str,
+        '_url_data_ready': (lambda value: dict(
+            value,
+            url_orig=string_as_bytes(value['url_orig']))),
+    }
+
     #
     # Instantiation-related methods
 
     @classmethod
-    def from_json(cls, json_string, **kwargs):
-        return cls(json.loads(json_string), **kwargs)
+    def from_json(cls, json_string, trusted=False, validation_rate=0.0, **kwargs):
+        """
+        Make a record dict from a JSON string.
+
+        Args:
+            `json_string`:
+                A JSON-serialized dict.
+
+        Kwargs:
+            `trusted` (default: False):
+                If true, `json_string` must be the result of the
+                get_ready_json() method of a record dict of the same
+                class -- then the values are stored *without* passing
+                them through the adjusters (except a few simple type
+                conversions, see: `trusted_json_converters`); the keys
+                are still checked.  It should be set to true only if
+                the JSON string comes from another n6 component (see:
+                `TRUSTED_JSON_HEADER`).
+            `validation_rate` (default: 0.0):
+                Relevant only if `trusted` is true: the probability
+                that the values *are* passed through the adjusters
+                after all, and the results are compared with the
+                values that would be stored without that (any
+                differences are logged as errors) -- to be set to
+                a small non-zero value to detect (in a production
+                environment) if the data are not as normalized as
+                they are supposed to be.
+            Other keyword arguments are passed to the constructor.
+        """
+        items = json.loads(json_string)
+        if not trusted:
+            return cls(items, **kwargs)
+        if validation_rate and random.random() < validation_rate:
+            return cls._from_trusted_items_validated(items, kwargs)
+        record_dict = cls(**kwargs)
+        record_dict._dict = cls._prepare_trusted_items(items)
+        return record_dict
+
+    @classmethod
+    def _prepare_trusted_items(cls, items):
+        ######## silently ignore the legacy item
+        items.pop('__preserved_custom_keys__', None)
+        ######## ^^^ (to be removed later)
+        illegal_keys = items.viewkeys() - cls._settable_keys
+        if illegal_keys:
+            raise RuntimeError('for {}, keys {} are illegal'
+                               .format(cls.__name__,
+                                       ', '.join(map(repr, sorted(illegal_keys)))))
+        converters = cls.trusted_json_converters
+        for key in converters.viewkeys() & items.viewkeys():
+            items[key] = converters[key](items[key])
+        return items
+
+    @classmethod
+    def _from_trusted_items_validated(cls, items, kwargs):
+        record_dict = cls(_copy_ready_value(items), **kwargs)
+        trusted_items = cls._prepare_trusted_items(items)
+        if trusted_items != record_dict._dict or any(
+                type(value) is not type(record_dict._dict[key])
+                for key, value in trusted_items.iteritems()):
+            LOGGER.error('Values deserialized from trusted JSON differ from the '
+                         'adjusted ones!  Trusted: %r, adjusted: %r',
+                         trusted_items, record_dict._dict)
+        return record_dict
 
     def __init__(self, iterable_or_mapping=(),
                  log_nonstandard_names=False,
                  context_manager_error_callback=None):
         self._dict = {}
-        self._settable_keys = (self.required_keys |
-                               self.optional_keys)
-
-        # to catch some kinds of bugs early...
-        duplicated = self.required_keys & self.optional_keys
-        if duplicated:
-            raise ValueError('{} has keys declared both '
-                             'as required and optional: {}'
-                             .format(self.__class__.__name__,
-                                     ', '.join(sorted(duplicated))))
-
-        missing_adjusters = [key for key in self._settable_keys
-                             if not hasattr(self, self._adjuster_name(key))]
-        if missing_adjusters:
-            raise TypeError('{!r} has no adjusters for keys: {}'
-                             .format(self,
-                                     ', '.join(sorted(missing_adjusters))))
-
+        self._ready_json = None
+        self._mutable_value_handed_out = False
         self.log_nonstandard_names = log_nonstandard_names
 
         # context-manager (__enter__/__exit__) -related stuff
@@ -463,34 +687,192 @@ class RecordDict(collections.MutableMapping):
     def _adjuster_name(cls, key):
         return cls._ADJUSTER_PREFIX + key.replace('-', '')
 
+    @classmethod
+    def _compile_adjusters(cls):
+        # Called by the metaclass when the class is created. Sets the
+        # `_settable_keys` and `_adjusters` class attributes; the latter
+        # is a dict that maps each settable key to a plain function
+        # accepting two arguments: the record dict and the value (or to
+        # None if the adjuster is set to None -- meaning that values are
+        # to be stored unchanged).
+
+        # to catch some kinds of bugs early...
+        duplicated = cls.required_keys & cls.optional_keys
+        if duplicated:
+            raise ValueError('{} has keys declared both '
+                             'as required and optional: {}'
+                             .format(cls.__name__,
+                                     ', '.join(sorted(duplicated))))
+
+        settable_keys = cls.required_keys | cls.optional_keys
+        adjusters = {}
+        missing_adjusters = []
+        for key in settable_keys:
+            try:
+                adjuster = getattr(cls, cls._adjuster_name(key))
+            except AttributeError:
+                missing_adjusters.append(key)
+            else:
+                adjusters[key] = cls._get_plain_adjuster_func(adjuster)
+        if missing_adjusters:
+            raise TypeError('{} has no adjusters for keys: {}'
+                            .format(cls.__name__,
+                                    ', '.join(sorted(missing_adjusters))))
+
+        cls._settable_keys = frozenset(settable_keys)
+        cls._adjusters = adjusters
+
+    @classmethod
+    def get_memoized_adjusters_stats(cls):
+        """
+        Get the cache hit/miss counters of the memoized adjusters
+        (see: memoized_adjuster()).
+
+        Returns:
+            A dict that maps each key whose adjuster is memoized to
+            a `(<number of cache hits>, <number of cache misses>)`
+            tuple.  Note that the counters are shared by the
+            record dict classes that share the adjusters.
+
+        It can be used, e.g., to log a report showing which memoized
+        adjusters actually benefit from caching.
+        """
+        return {key: tuple(adjuster._memo_counters)
+                for key, adjuster in cls._adjusters.iteritems()
+                if hasattr(adjuster, '_memo_counters')}
+
+    @staticmethod
+    def _get_plain_adjuster_func(adjuster):
+        if adjuster is None:
+            return None
+        if isinstance(adjuster, types.MethodType) and adjuster.im_self is None:
+            # (a typical case: an unbound method)
+            return adjuster.im_func
+        # (e.g., a static method or a class method)
+        return lambda self, value: adjuster(value)
+
     #
     # Output-related methods
 
     def get_ready_dict(self):
+        ready_dict = self._get_ready_items()
+        for key, value in ready_dict.iteritems():
+            if type(value) not in _IMMUTABLE_READY_VALUE_TYPES:
+                ready_dict[key] = _copy_ready_value(value)
+        return ready_dict
+
+    def get_ready_json(self):
+        # (the result is cached until the record dict is modified; but
+        # once any of its mutable values has been handed out -- see:
+        # __getitem__() -- it is no longer cached, as that value can be
+        # modified in place at any time later)
+        ready_json = self._ready_json
+        if ready_json is None:
+            ready_json = json.dumps(self._get_ready_items(), default=_json_default)
+            if not self._mutable_value_handed_out:
+                self._ready_json = ready_json
+        return ready_json
+
+    def _get_ready_items(self):
+        # Note: the returned dict is a *shallow* copy of `_dict`, i.e.,
+        # its values may be the same (mutable) objects the record dict
+        # keeps -- so it must not be exposed to code that could modify
+        # them (get_ready_dict() exposes a deep copy).
         current_keys = set(self._dict)
         assert self._settable_keys >= current_keys
         missing_keys = self.required_keys - current_keys
         if missing_keys:
             raise ValueError('missing keys: ' +
                              ', '.join(sorted(missing_keys)))
-        ready_dict = copy.deepcopy(self._dict)
+        ready_items = self._dict.copy()
         ######## provide the legacy item
         ######## (needed by old version of RecordDict, in not-yet-updated components)
-        used_custom_keys = self.data_spec.custom_field_keys.intersection(ready_dict)
+        used_custom_keys = self.data_spec.custom_field_keys.intersection(ready_items)
         if used_custom_keys:
-            ready_dict['__preserved_custom_keys__'] = sorted(used_custom_keys)
+            ready_items['__preserved_custom_keys__'] = sorted(used_custom_keys)
         ######## ^^^ (to be removed later)
-        return ready_dict
-
-    def get_ready_json(self):
-        # changed from json.dumps on bson.dumps
-        ### XXX: why? bson.json_utils.dumps() pre-converts some values, but is it necessary???
-        return dumps(self.get_ready_dict())
+        return ready_items
 
     def iter_db_items(self):
-        # to be cloned later (see below)
-        item_prototype = {key: value
-                          for key, value in self.get_ready_dict().iteritems()
+        item_prototype, address_list = self._get_db_item_prototype()
+
+        # depending on "address" provide one or more database items (dicts)
+        if address_list:
+            # the `address` list was present and not empty
+            # -> db item for each list item (each db item containing
+            # `ip`[/`cc`/`asn`] of the list item + the whole `address`)
+            for addr in address_list:
+                # cloning the prototype dict...
+                db_item = item_prototype.copy()
+                # ...and updating the copy with particular address data
+                db_item.update(addr)
+                yield db_item
+        else:
+            # the `address` list was *empty* or *not* present
+            # -> only one db item *without* `address`, `ip` etc.
+            yield item_prototype
+
+    def iter_db_rows(self, column_names):
+        """
+        A variant of iter_db_items() that yields tuples of values
+        instead of dicts.
+
+        Args:
+            `column_names`:
+                A sequence of database column names (typically, the
+                `n6lib.db_events.n6NormalizedData.column_names` tuple).
+
+        Yields:
+            For each item that would be yielded by iter_db_items():
+            a tuple of its values, ordered according to `column_names`
+            (None for absent items; items whose keys are not in
+            `column_names`, such as `client`, are omitted), with the
+            `ip` and `dip` values converted to ints (`ip` is 0 if there
+            is no address -- just as it is stored in the database).
+        """
+        layout = self._get_db_row_layout(column_names)
+        column_names, ip_index, cc_index, asn_index, dip_index = layout
+        item_prototype, address_list = self._get_db_item_prototype()
+        row_prototype = map(item_prototype.get, column_names)
+        if dip_index is not None and row_prototype[dip_index] is not None:
+            row_prototype[dip_index] = ip_str_to_int(row_prototype[dip_index])
+        if address_list:
+            for addr in address_list:
+                row = list(row_prototype)
+                if ip_index is not None:
+                    row[ip_index] = ip_str_to_int(addr['ip'])
+                if cc_index is not None:
+                    row[cc_index] = addr.get('cc')
+                if asn_index is not None:
+                    row[asn_index] = addr.get('asn')
+                yield tuple(row)
+        else:
+            if ip_index is not None:
+                row_prototype[ip_index] = 0
+            yield tuple(row_prototype)
+
+    # maps tuples of column names to the "layouts" of db rows
+    # (see: _get_db_row_layout())
+    _db_row_layouts = {}
+
+    @classmethod
+    def _get_db_row_layout(cls, column_names):
+        column_names = tuple(column_names)
+        layout = cls._db_row_layouts.get(column_names)
+        if layout is None:
+            index_of = {name: i for i, name in enumerate(column_names)}.get
+            layout = cls._db_row_layouts[column_names] = (
+                column_names,
+                index_of('ip'),
+                index_of('cc'),
+                index_of('asn'),
+                index_of('dip'))
+        return layout
+
+    def _get_db_item_prototype(self):
+        # to be cloned later (see: iter_db_items())
+        item_prototype = {key: _copy_ready_value(value)
+                          for key, value in self._get_ready_items().iteritems()
                           if not key.startswith('_')}  # no internal keys
 
         # pop actual custom items and place them in the "custom" field
@@ -502,25 +884,13 @@ class RecordDict(collections.MutableMapping):
         if custom_items:
             item_prototype['custom'] = custom_items
 
-        # depending on "address" provide one or more database items (dicts)
         address_list = item_prototype.pop('address', None)  # NOTE: deleting `address`
         if address_list:
-            # the `address` list was present and not empty
-            # -> db item for each list item (each db item containing
-            # `ip`[/`cc`/`asn`] of the list item + the whole `address`)
             item_prototype['address'] = address_list  # restore
             all_addr_keys_are_legal = {'ip', 'cc', 'asn'}.issuperset
             for addr in address_list:
                 assert 'ip' in addr and all_addr_keys_are_legal(addr)
-                # cloning the prototype dict...
-                db_item = item_prototype.copy()
-                # ...and updating the copy with particular address data
-                db_item.update(addr)
-                yield db_item
-        else:
-            # the `address` list was *empty* or *not* present
-            # -> only one db item *without* `address`, `ip` etc.
-            yield item_prototype
+        return item_prototype, address_list
 
     # *EXPERIMENTAL* (likely to be changed or removed in the future
     # without any warning/deprecation/etc.)
@@ -531,10 +901,39 @@ class RecordDict(collections.MutableMapping):
             assert isinstance(url_data.get('url_orig'), str)
             url_orig = base64.urlsafe_b64decode(url_data['url_orig'])
             item_prototype['url'] = make_provisional_url_search_key(url_orig)  # [sic]
-            custom_items['url_data'] = url_data
+            custom_items['url_data'] = _copy_ready_value(url_data)
 
     __repr__ = attr_repr('_dict')
 
+    #
+    # Pickling/copying support (needed because of `__slots__`)
+
+    def __getstate__(self):
+        state = dict(getattr(self, '__dict__', ()))   # (for subclasses without `__slots__`)
+        for name in RecordDict.__slots__:
+            if name not in self._UNPICKLED_SLOT_NAMES and hasattr(self, name):
+                state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        self._ready_json = None
+        self._mutable_value_handed_out = False
+        has_instance_dict = hasattr(self, '__dict__')
+        for name, value in state.iteritems():
+            # (states pickled by older versions may contain names of
+            # attributes that are now class-level, e.g. `_settable_keys`)
+            if name in self._OBSOLETE_STATE_NAMES:
+                continue
+            if name in RecordDict.__slots__ or has_instance_dict:
+                setattr(self, name, value)
+
+    # names that may be present in states pickled by older versions
+    # (when instances kept all their attributes in `__dict__`)
+    _OBSOLETE_STATE_NAMES = frozenset({'_settable_keys'})
+
+    # names of the slots that are not included in the state
+    _UNPICKLED_SLOT_NAMES = frozenset({'_ready_json', '_mutable_value_handed_out'})
+
     #
     # MutableMapping interface implementation
 
@@ -545,15 +944,23 @@ class RecordDict(collections.MutableMapping):
         return len(self._dict)
 
     def __getitem__(self, key):
-        return self._dict[key]
+        value = self._dict[key]
+        if type(value) not in _IMMUTABLE_READY_VALUE_TYPES:
+            # the value may be modified in place by the caller (now or
+            # at any time later)
+            self._mutable_value_handed_out = True
+            self._ready_json = None
+        return value
 
     def __delitem__(self, key):
         del self._dict[key]
+        self._ready_json = None
 
     def __setitem__(self, key, value):
         ######## silently ignore the legacy item
         if key == '__preserved_custom_keys__': return
         ######## ^^^ (to be removed later)
+        self._ready_json = None
         target_key = self.setitem_key_to_target_key.get(key, key)
         try:
             self._dict[target_key] = self._get_adjusted_value(key, value)
@@ -564,29 +971,24 @@ class RecordDict(collections.MutableMapping):
                 raise
 
     def _get_adjusted_value(self, key, value):
-        if key not in self._settable_keys:
-            raise RuntimeError('for {!r}, key {!r} is illegal'
-                               .format(self, key))
-
-        adjuster_method_name = self._adjuster_name(key)
         try:
-            adjuster = getattr(self, adjuster_method_name)
-        except AttributeError:
-            raise RuntimeError('{!r} has no adjuster for key {!r}'
+            adjuster = self._adjusters[key]
+        except KeyError:
+            raise RuntimeError('for {!r}, key {!r} is illegal'
                                .format(self, key))
         if adjuster is None:
             # adjuster explicitly set to None -> passing value unchanged
             return value
 
         try:
-            return adjuster(value)
+            return adjuster(self, value)
         except Exception as exc:
             if getattr(exc, 'propagate_it_anyway', False):
                 raise
             adjuster_error_msg = ('{!r}.{}({value!r}) raised '
                                   '{exc.__class__.__name__}: {exc}'
                                   .format(self,
-                                          adjuster_method_name,
+                                          self._adjuster_name(key),
                                           value=value,
                                           exc=exc))
             raise AdjusterError(adjuster_error_msg)
@@ -614,6 +1016,43 @@ class RecordDict(collections.MutableMapping):
 
     __copy__ = copy
 
+    def derive(self, **kwargs):
+        """
+        Make a new record dict containing the same items -- *without*
+        passing their (already adjusted) values through the adjusters
+        again (mutable values are copied, immutable ones are shared).
+
+        Kwargs:
+            Passed to the constructor (e.g., `log_nonstandard_names`
+            or `context_manager_error_callback`; note that they are
+            *not* inherited from this record dict).
+
+        Returns:
+            A new instance of the same class.
+
+        Typically, this method is used to create many record dicts
+        containing the same constant items (see, e.g.:
+        n6.parsers.generic.BaseParser.new_record_dict()) -- a
+        "template" record dict needs to be populated with them only
+        once.
+
+        >>> template = RecordDict({'category': 'bots', 'client': ['o1']})
+        >>> rd = template.derive()
+        >>> rd == template
+        True
+        >>> rd['client'].append(u'o2')
+        >>> rd['client']
+        [u'o1', u'o2']
+        >>> template['client']
+        [u'o1']
+        """
+        record_dict = self.__class__(**kwargs)
+        record_dict._dict = {
+            key: (value if type(value) in _IMMUTABLE_READY_VALUE_TYPES
+                  else _copy_ready_value(value))
+            for key, value in self._dict.iteritems()}
+        return record_dict
+
     #
     # Context manager interface
 
@@ -640,15 +1079,15 @@ class RecordDict(collections.MutableMapping):
 
     adjust_id = make_adjuster_using_data_spec('id')
     adjust_rid = make_adjuster_using_data_spec('rid')
-    adjust_source = make_adjuster_using_data_spec('source')
-    adjust_origin = make_adjuster_using_data_spec('origin')
-    adjust_restriction = make_adjuster_using_data_spec('restriction')
-    adjust_confidence = make_adjuster_using_data_spec('confidence')
-    adjust_category = make_adjuster_using_data_spec('category')
+    adjust_source = memoized_adjuster(make_adjuster_using_data_spec('source'))
+    adjust_origin = memoized_adjuster(make_adjuster_using_data_spec('origin'))
+    adjust_restriction = memoized_adjuster(make_adjuster_using_data_spec('restriction'))
+    adjust_confidence = memoized_adjuster(make_adjuster_using_data_spec('confidence'))
+    adjust_category = memoized_adjuster(make_adjuster_using_data_spec('category'))
     adjust_md5 = make_adjuster_using_data_spec('md5')
     adjust_sha1 = make_adjuster_using_data_spec('sha1')
     adjust_sha256 = make_adjuster_using_data_spec('sha256')
-    adjust_proto = make_adjuster_using_data_spec('proto')
+    adjust_proto = memoized_adjuster(make_adjuster_using_data_spec('proto'))
     adjust_sport = make_adjuster_using_data_spec('sport')
     adjust_dport = make_adjuster_using_data_spec('dport')
     adjust_count = make_adjuster_using_data_spec('count')
@@ -697,7 +1136,7 @@ class RecordDict(collections.MutableMapping):
     adjust_target = make_adjuster_using_data_spec(
         'target', on_too_long=trim)
 
-    adjust_type = make_adjuster_using_data_spec('_type')
+    adjust_type = memoized_adjuster(make_adjuster_using_data_spec('_type'))
 
     # generic internal field adjusters
     adjust__do_not_resolve_fqdn_to_ip = ensure_isinstance(bool)
@@ -728,7 +1167,7 @@ class RecordDict(collections.MutableMapping):
         make_adjuster_applying_callable(str))          # will transform it to str
 
     # bl-only non-internal field adjusters
-    adjust_status = make_adjuster_using_data_spec('status')
+    adjust_status = memoized_adjuster(make_adjuster_using_data_spec('status'))
     adjust_replaces = make_adjuster_using_data_spec('replaces')
 
     # bl-only internal field adjusters
@@ -945,8 +1384,7 @@ class RecordDict(collections.MutableMapping):
     def __getattr__(self, name):
         if name.startswith(self._APPENDER_PREFIX):
             key = name[len(self._APPENDER_PREFIX):]
-            adjuster_method_name = self._adjuster_name(key)
-            adjuster = getattr(self, adjuster_method_name, None)
+            adjuster = self._adjusters.get(key)
             if self._is_multiadjuster(adjuster):
                 def appender(singular_value):
                     value_seq = list(self.get(key, []))
@@ -968,6 +1406,8 @@ class BLRecordDict(RecordDict):
     Record dict class for blacklist events (slightly harder restricted).
     """
 
+    __slots__ = ()
+
     required_keys = RecordDict.required_keys | {'expires'}
     optional_keys = RecordDict.optional_keys - {'expires'}
 
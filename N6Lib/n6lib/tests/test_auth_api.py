@@ -37,6 +37,8 @@ from n6lib.auth_related_test_helpers import (
     EXAMPLE_SOURCE_IDS_TO_SUBS_TO_STREAM_API_ACCESS_INFOS,
     EXAMPLE_SOURCE_IDS_TO_NOTIFICATION_ACCESS_INFO_MAPPINGS,
 )
+from n6lib.data_spec import N6DataSpec
+from n6lib.db_filtering_abstractions import RecordFacadeForPredicates
 from n6lib.record_dict import RecordDict
 from n6lib.unit_test_helpers import (
     MethodProxy,
@@ -530,6 +532,74 @@ class TestAuthAPI__get_source_ids_to_subs_to_stream_api_access_infos(
         self.assert_problematic_orgs_logged(LOGGER_error_mock, {'o6', 'o8', 'o9'})
 
 
+class TestAuthAPI__get_source_ids_to_stream_api_predicate_indexes(
+        _AuthAPILdapDataBasedMethodTestMixIn,
+        unittest.TestCase):
+
+    EXAMPLE_ADDRESSES = [
+        {'ip': '10.20.30.40', 'asn': 1, 'cc': 'PL'},
+        {'ip': '10.20.30.41'},
+        {'ip': '192.168.0.255', 'asn': 4},
+        {'ip': '192.168.1.0', 'cc': 'PL'},
+        {'ip': '1.2.3.4', 'asn': 5, 'cc': 'DE'},
+        {'ip': '11.0.0.0', 'asn': 6},
+    ]
+
+    def _iter_example_records(self, source_id):
+        address_lists = [[]]
+        address_lists.extend([addr] for addr in self.EXAMPLE_ADDRESSES)
+        address_lists.extend(map(list, itertools.combinations(self.EXAMPLE_ADDRESSES, 2)))
+        for category, name, restriction, address in itertools.product(
+                ['bots', 'cnc', 'phish', None],
+                ['foo', 'bar', None],
+                ['public', 'need-to-know', 'internal'],
+                address_lists):
+            record = {'source': source_id, 'restriction': restriction}
+            if category is not None:
+                record['category'] = category
+            if name is not None:
+                record['name'] = name
+            if address:
+                record['address'] = address
+            yield record
+
+    @patch('n6lib.auth_api.LOGGER.error', new_callable=_make_LOGGER_error_mock)
+    def test_exhaustively_consistent_with_stream_api_access_infos(self, LOGGER_error_mock):
+        # see: n6lib.auth_related_test_helpers
+        search_flat_return_value = EXAMPLE_SEARCH_RAW_RETURN_VALUE
+        data_spec = N6DataSpec()
+
+        with self.standard_context(search_flat_return_value):
+            source_ids_to_indexes = self.auth_api.get_source_ids_to_stream_api_predicate_indexes()
+            source_ids_to_subs_to_saa_infos = (
+                self.auth_api.get_source_ids_to_subs_to_stream_api_access_infos())
+
+        self.assertEqual(set(source_ids_to_indexes),
+                         set(EXAMPLE_SOURCE_IDS_TO_SUBS_TO_STREAM_API_ACCESS_INFOS))
+        self.assertEqual(set(source_ids_to_indexes),
+                         set(source_ids_to_subs_to_saa_infos))
+        for source_id, predicate_index in sorted(source_ids_to_indexes.iteritems()):
+            subsource_to_saa_info = source_ids_to_subs_to_saa_infos[source_id]
+            matched_subsources = set()
+            for record in self._iter_example_records(source_id):
+                facade = RecordFacadeForPredicates(record, data_spec)
+                expected = {
+                    subsource_refint
+                    for subsource_refint, (predicate, _) in subsource_to_saa_info.iteritems()
+                    if predicate(facade)}
+                facade = RecordFacadeForPredicates(record, data_spec)
+                actual = {
+                    subsource_refint
+                    for subsource_refint, residual_predicate in (
+                        predicate_index.iter_matching_candidates(facade))
+                    if residual_predicate(facade)}
+                self.assertEqual(actual, expected, record)
+                self.assertLessEqual(actual, set(subsource_to_saa_info))
+                matched_subsources.update(actual)
+            # (making sure that the test is not a trivial one)
+            self.assertTrue(matched_subsources)
+
+
 class TestAuthAPI__get_stream_api_enabled_org_ids(_AuthAPILdapDataBasedMethodTestMixIn,
                                                   unittest.TestCase):
 
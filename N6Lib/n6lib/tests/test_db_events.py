@@ -20,10 +20,12 @@ from unittest_expander import (
     param,
 )
 
+from n6lib.datetime_helpers import parse_iso_datetime_to_utc
 from n6lib.db_events import (
     IPAddress,
     n6NormalizedData,
 )
+from n6lib.record_dict import RecordDict
 from n6lib.unit_test_helpers import MethodProxy
 
 
@@ -157,6 +159,42 @@ class Test__n6NormalizedData(unittest.TestCase):
         self.assertEqual(n6NormalizedData._ip_column_names, ('dip', 'ip'))
         self.assertEqual(n6NormalizedData._no_ip_placeholders, {'0.0.0.0', 0, -1})
 
+    def test_column_names(self):
+        self.assertEqual(n6NormalizedData.column_names,
+                         tuple(c.name for c in n6NormalizedData.__table__.columns))
+        self.assertEqual(set(n6NormalizedData.column_names),
+                         set(n6NormalizedData._n6columns))
+
+    def test_record_dict_rows_equivalent_to_instances(self):
+        rd = RecordDict({
+            'id': 32 * '3',
+            'rid': 32 * '4',
+            'source': 'foo.bar',
+            'restriction': 'public',
+            'confidence': 'low',
+            'category': 'bots',
+            'time': '2014-04-01 01:07:42',
+            'address': [{'ip': '1.2.3.4', 'cc': 'PL', 'asn': 123}, {'ip': '5.6.7.8'}],
+            'dip': '10.20.30.40',
+            'client': ['o1'],
+            'additional_data': 'foo',
+        })
+        ip_type = IPAddress()
+        column_names = n6NormalizedData.column_names
+        rows = list(rd.iter_db_rows(column_names))
+        items = list(rd.iter_db_items())
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(len(items), 2)
+        for row, item in zip(rows, items):
+            obj = n6NormalizedData(**item)
+            for name, value in zip(column_names, row):
+                expected = getattr(obj, name)
+                if name in ('ip', 'dip'):
+                    expected = ip_type.process_bind_param(expected, None)
+                elif name in ('time', 'expires', 'modified') and value is not None:
+                    value = parse_iso_datetime_to_utc(value)
+                self.assertEqual(value, expected, name)
+
     def _get_sql_repr(self, col):
         type_name = (
             str(col.type) if not isinstance(col.type, sqlalchemy.types.Enum)
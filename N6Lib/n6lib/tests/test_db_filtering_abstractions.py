@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013-2019 NASK. All rights reserved.
+
+import random
+import unittest
+
+from n6lib.data_spec import N6DataSpec
+from n6lib.db_filtering_abstractions import (
+    PredicateConditionBuilder,
+    RecordFacadeForPredicates,
+)
+
+
+class TestCompiledPredicates(unittest.TestCase):
+
+    # the compiled predicates (see: _PredicateCompiler) must behave
+    # exactly like the closure-based ones (see: make_predicate_func())
+
+    RANDOM_SEED = 42
+    NUMBER_OF_CONDITIONS = 300
+    NUMBER_OF_RECORDS = 300
+
+    CATEGORIES = ['bots', 'cnc', 'phish', 'malurl']
+    NAMES = ['foo', 'bar', u'bąz']
+    RESTRICTIONS = ['public', 'need-to-know', 'internal']
+    ASNS = [1, 2, 3, 400, 65536]
+    CCS = ['PL', 'DE', 'US']
+    IPS = ['0.0.0.1', '10.0.0.0', '10.255.255.255', '11.0.0.0',
+           '192.168.0.1', '192.168.1.1', '255.255.255.255']
+
+    def setUp(self):
+        self.rand = random.Random(self.RANDOM_SEED)
+        self.builder = PredicateConditionBuilder()
+        self.data_spec = N6DataSpec()
+
+    def _random_column_cond(self):
+        b = self.builder
+        rand = self.rand
+        kind = rand.choice(['category', 'name', 'restriction', 'asn', 'cc', 'ip', 'ip'])
+        if kind == 'ip':
+            min_ip = rand.choice([0, 167772160, 184549375, 3232235520, 4294967295])
+            return b['ip'].between(min_ip, min_ip + rand.choice([0, 255, 16777215]))
+        values = {
+            'category': self.CATEGORIES,
+            'name': self.NAMES,
+            'restriction': self.RESTRICTIONS,
+            'asn': self.ASNS,
+            'cc': self.CCS,
+        }[kind]
+        op = rand.choice(['eq', 'in', 'in', 'gt', 'le'])
+        if op == 'eq':
+            return b[kind] == rand.choice(values)
+        if op == 'gt':
+            return b[kind] > rand.choice(values)
+        if op == 'le':
+            return b[kind] <= rand.choice(values)
+        return b[kind].in_(rand.sample(values, rand.randint(1, len(values))))
+
+    def _random_cond(self, depth=0):
+        b = self.builder
+        rand = self.rand
+        if depth >= 3 or rand.random() < 0.3:
+            return self._random_column_cond()
+        kind = rand.choice(['and', 'or', 'or', 'not'])
+        if kind == 'not':
+            return b.not_(self._random_cond(depth + 1))
+        subconditions = [self._random_cond(depth + 1)
+                         for _ in xrange(rand.randint(0, 5))]
+        return (b.and_ if kind == 'and' else b.or_)(*subconditions)
+
+    def _random_record(self):
+        rand = self.rand
+        record = {'source': 'foo.bar'}
+        for key, values in [('category', self.CATEGORIES),
+                            ('name', self.NAMES),
+                            ('restriction', self.RESTRICTIONS)]:
+            if rand.random() < 0.8:
+                record[key] = rand.choice(values)
+        address = []
+        for _ in xrange(rand.randint(0, 3)):
+            addr = {'ip': rand.choice(self.IPS)}
+            if rand.random() < 0.7:
+                addr['asn'] = rand.choice(self.ASNS)
+            if rand.random() < 0.7:
+                addr['cc'] = rand.choice(self.CCS)
+            address.append(addr)
+        if address:
+            record['address'] = address
+        return record
+
+    @staticmethod
+    def _call(predicate, record):
+        try:
+            return bool(predicate(record))
+        except ValueError:
+            return ValueError
+
+    def test_compiled_and_closure_based_predicates_are_equivalent(self):
+        records = [self._random_record() for _ in xrange(self.NUMBER_OF_RECORDS)]
+        results_seen = set()
+        for _ in xrange(self.NUMBER_OF_CONDITIONS):
+            cond = self._random_cond()
+            closure_based = cond.make_predicate_func()
+            compiled = cond.make_compiled_predicate_func()
+            for record in records:
+                expected = self._call(closure_based, RecordFacadeForPredicates(record,
+                                                                               self.data_spec))
+                actual = self._call(compiled, RecordFacadeForPredicates(record,
+                                                                        self.data_spec))
+                self.assertEqual(actual, expected, (cond, record, compiled.source))
+                results_seen.add(expected)
+        self.assertEqual(results_seen, {True, False})
+
+    def test_values_being_None_are_not_supported(self):
+        b = self.builder
+        for cond in [b['name'] == 'foo',
+                     b['name'].in_(['foo', 'bar']),
+                     b.or_(b['ip'].between(1, 2), b['ip'].between(5, 6))]:
+            for predicate in [cond.make_predicate_func(),
+                              cond.make_compiled_predicate_func()]:
+                with self.assertRaises(ValueError):
+                    predicate({'name': None, 'ip': None})
+
+    def test_predicate_attribute_is_compiled(self):
+        cond = self.builder['category'].in_(['bots', 'cnc'])
+        self.assertTrue(cond.predicate.source.startswith('def _predicate(record):'))
+        self.assertIs(cond.predicate, cond.predicate)
+        self.assertTrue(cond.predicate({'category': 'cnc'}))
+        self.assertFalse(cond.predicate({'category': 'phish'}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,6 +7,7 @@ import copy
 import cPickle
 import datetime
 import itertools
+import json
 import operator
 import random
 import re
@@ -14,6 +15,7 @@ import sys
 import unittest
 from UserDict import IterableUserDict
 
+from bson.json_util import dumps as bson_dumps
 from mock import (
     MagicMock,
     Mock,
@@ -23,7 +25,7 @@ from mock import (
 )
 
 from n6lib.class_helpers import AsciiMixIn
-from n6lib.common_helpers import CIDict, picklable
+from n6lib.common_helpers import CIDict, ip_str_to_int, picklable
 from n6lib.const import (
     CATEGORY_ENUMS,
     CONFIDENCE_ENUMS,
@@ -44,6 +46,7 @@ from n6lib.record_dict import (
     chained,
     applied_for_nonfalse,
     preceded_by,
+    memoized_adjuster,
     adjuster_factory,
 
     # adjuster factories:
@@ -111,6 +114,66 @@ class TestAdjusterHelpers(unittest.TestCase):
         self.assertEqual(adj._factory_names, {'x', 'y', 'z'})
         self._test_combined_adjuster_call(adj)
 
+    def test__memoized_adjuster(self):
+        class RD1(object): pass
+        class RD2(object): pass
+        adj = memoized_adjuster(self.a)
+        self.assertEqual(adj._factory_names, {'x', 'y'})
+        self.a.side_effect = lambda self, value: 'result:' + str(value)
+        self.assertEqual(adj(RD1(), 'foo'), 'result:foo')
+        self.assertEqual(adj(RD1(), 'foo'), 'result:foo')
+        self.assertEqual(adj(RD1(), u'foo'), 'result:foo')
+        self.assertEqual(adj(RD2(), 'foo'), 'result:foo')
+        self.assertEqual(adj(RD2(), u'foo'), 'result:foo')
+        self.assertEqual(adj(RD1(), 1), 'result:1')
+        self.assertEqual(adj(RD1(), True), 'result:True')
+        self.assertEqual(adj(RD1(), 1), 'result:1')
+        # (the value's type and the record dict's class are parts of the key)
+        self.assertEqual(len(self.a.mock_calls), 6)
+        self.assertEqual(adj._memo_counters, [2, 6])
+
+    def test__memoized_adjuster__errors_cached(self):
+        self.a.side_effect = ValueError('bad')
+        adj = memoized_adjuster(self.a)
+        with self.assertRaisesRegexp(ValueError, 'bad'):
+            adj(sen.self, 'foo')
+        with self.assertRaisesRegexp(ValueError, 'bad'):
+            adj(sen.self, 'foo')
+        self.assertEqual(len(self.a.mock_calls), 1)
+        # ...but not those with the `propagate_it_anyway` attribute
+        exc = ValueError('bad')
+        exc.propagate_it_anyway = True
+        self.a.side_effect = exc
+        for _ in range(2):
+            with self.assertRaisesRegexp(ValueError, 'bad'):
+                adj(sen.self, 'bar')
+        self.assertEqual(len(self.a.mock_calls), 3)
+
+    def test__memoized_adjuster__not_cached_types(self):
+        adj = memoized_adjuster(self.a)
+        self.a.side_effect = lambda self, value: [value]
+        self.assertEqual(adj(sen.self, 'foo'), ['foo'])
+        self.assertEqual(adj(sen.self, 'foo'), ['foo'])
+        self.a.side_effect = lambda self, value: value
+        self.assertEqual(adj(sen.self, ['foo']), ['foo'])
+        self.assertEqual(adj(sen.self, ['foo']), ['foo'])
+        self.assertEqual(len(self.a.mock_calls), 4)
+        self.assertEqual(adj._memo_cache, {})
+
+    def test__memoized_adjuster__max_size(self):
+        adj = memoized_adjuster(self.a, max_size=3)
+        self.a.side_effect = lambda self, value: value
+        for value in [1, 2, 3, 1, 4, 1]:
+            adj(sen.self, value)
+        self.assertEqual(self.a.mock_calls, [
+            call(sen.self, 1),
+            call(sen.self, 2),
+            call(sen.self, 3),
+            call(sen.self, 4),  # (here the cache has been cleared)
+            call(sen.self, 1),
+        ])
+        self.assertEqual(len(adj._memo_cache), 2)
+
     def test__adjuster_factory(self):
         @adjuster_factory
         def chained2(self, value, *adjusters_to_call, **foo_bar):
@@ -620,6 +683,185 @@ class TestRecordDict(TestCaseMixin, unittest.TestCase):
                         self.assertEqual(rd['address'][0], rd2['address'][0])
                         self.assertIsNot(rd['address'][0], rd2['address'][0])
 
+    def test__get_memoized_adjusters_stats(self):
+        stats_before = self.rd_class.get_memoized_adjusters_stats()
+        self.assertTrue({'category', 'restriction', 'source'} <= stats_before.viewkeys())
+        self.assertNotIn('time', stats_before)
+        for _ in range(3):
+            self.rd_class({'category': 'bots', 'restriction': 'public'})
+        with self.assertRaises(AdjusterError):
+            self.rd_class({'category': 'no-such-category'})
+        with self.assertRaises(AdjusterError):
+            self.rd_class({'category': 'no-such-category'})
+        stats_after = self.rd_class.get_memoized_adjusters_stats()
+        hits_before, misses_before = stats_before['category']
+        hits_after, misses_after = stats_after['category']
+        self.assertGreaterEqual(hits_after - hits_before, 3)
+        self.assertLessEqual(misses_after - misses_before, 2)
+        self.assertEqual((hits_after + misses_after) - (hits_before + misses_before), 5)
+
+    def test_derive(self):
+        class Subclass(self.rd_class):
+            pass
+        def _callback(arg):
+            pass
+        for cls in (self.rd_class, Subclass):
+            rd = cls(
+                {'category': 'bots', 'client': ['a', 'b'], 'address': [{'ip': '1.2.3.4'}]},
+                log_nonstandard_names=True,
+                context_manager_error_callback=_callback)
+            with patch.object(cls, '_get_adjusted_value') as adjust_mock:
+                rd2 = rd.derive(context_manager_error_callback=sen.callback)
+            self.assertEqual(adjust_mock.mock_calls, [])
+            self.assertIs(type(rd2), cls)
+            self.assertEqual(rd, rd2)
+            self.assertFalse(rd2.log_nonstandard_names)
+            self.assertIs(rd2.context_manager_error_callback, sen.callback)
+            self.assertFalse(rd2.used_as_context_manager)
+            self.assertIs(rd['category'], rd2['category'])
+            self.assertEqual(rd['client'], rd2['client'])
+            self.assertIsNot(rd['client'], rd2['client'])
+            self.assertIsNot(rd['address'][0], rd2['address'][0])
+            # the derived record dict can be further modified (with
+            # adjusters involved) without affecting the original one
+            rd2['name'] = 'Foo'
+            rd2['address'][0]['cc'] = 'PL'
+            self.assertEqual(rd2['name'], 'foo')
+            self.assertNotIn('name', rd)
+            self.assertEqual(rd['address'], [{'ip': '1.2.3.4'}])
+
+    def test_no_instance_dict(self):
+        rd = self.rd_class({'category': 'bots'})
+        self.assertFalse(hasattr(rd, '__dict__'))
+        with self.assertRaises(AttributeError):
+            rd.foo = 'bar'
+        self.assertIsInstance(rd, collections.MutableMapping)
+        self.assertIsInstance(rd, collections.Mapping)
+        self.assertTrue(issubclass(self.rd_class, collections.MutableMapping))
+
+    def test_mapping_mixin_methods(self):
+        rd = self.rd_class({'category': 'bots', 'restriction': 'public'})
+        self.assertEqual(sorted(rd.keys()), ['category', 'restriction'])
+        self.assertEqual(sorted(rd.iteritems()), [('category', 'bots'),
+                                                  ('restriction', 'public')])
+        self.assertEqual(rd.get('category'), 'bots')
+        self.assertIsNone(rd.get('source'))
+        self.assertEqual(rd, {'category': 'bots', 'restriction': 'public'})
+        self.assertNotEqual(rd, {'category': 'bots'})
+        self.assertEqual(rd.setdefault('confidence', 'low'), 'low')
+        self.assertEqual(rd.pop('confidence'), 'low')
+        self.assertIsNone(rd.pop('confidence', None))
+        with self.assertRaises(KeyError):
+            rd.pop('confidence')
+        self.assertIn(rd.popitem(), [('category', 'bots'), ('restriction', 'public')])
+        rd.clear()
+        self.assertEqual(rd, {})
+        with self.assertRaises(TypeError):
+            hash(rd)
+
+    def test_subclass_without_slots(self):
+        @picklable
+        class Subclass(self.rd_class):
+            pass
+        rd = Subclass({'category': 'bots'})
+        rd.foo = 'bar'
+        rd2 = cPickle.loads(cPickle.dumps(rd, 2))
+        self.assertEqual(rd2, rd)
+        self.assertEqual(rd2.foo, 'bar')
+
+    # pickled by the version of RecordDict that kept all instance
+    # attributes (including `_settable_keys`) in the instance's `__dict__`
+    LEGACY_PICKLES = [
+        (  # protocol 0
+            "ccopy_reg\n_reconstructor\np1\n(cn6lib.record_dict\nRecordDict\np2\nc__builtin__\nob"
+            "ject\np3\nNtRp4\n(dp5\nS'_settable_keys'\np6\nc__builtin__\nfrozenset\np7\n((lp8\nVo"
+            "rigin\np9\naVrestriction\np10\naS'_url_data'\np11\naVsysdesc\np12\naVdataset\np13\na"
+            "S'_bl-series-id'\np14\naVheader\np15\naVinternal_ip\np16\naVfirst_seen\np17\naVurl_p"
+            "attern\np18\naVdetected_since\np19\naVconfidence\np20\naVmisp_eventdid\np21\naVmisp_"
+            "attr_uuid\np22\naS'_url_data_ready'\np23\naVsource\np24\naS'enriched'\np25\naVmac_ad"
+            "dress\np26\naVsha256\np27\naS'type'\np28\naVuntil\np29\naVintelmq\np30\naVdns_versio"
+            "n\np31\naVvisible_databases\np32\naVinjects\np33\naVip_network\np34\naValternative_f"
+            "qdns\np35\naVmisp_event_uuid\np36\naVfacebook_id\np37\naVx509subject\np38\naVphone\n"
+            "p39\naVreferer\np40\naVcount_actual\np41\naVtarget\np42\naVcount\np43\naVreplaces\np"
+            "44\naVname\np45\naVmodified\np46\naVproxy_type\np47\naVdip\np48\naVadditional_data\n"
+            "p49\naVx509issuer\np50\naVusername\np51\naS'_bl-series-total'\np52\naVcert_length\np"
+            "53\naVrid\np54\naVsport\np55\naVipmi_version\np56\naVid\np57\naVcategory\np58\naS'_b"
+            "l-time'\np59\naVurls_matched\np60\naVproto\np61\naVtags\np62\naVsubject_common_name"
+            "\np63\naVmin_amplification\np64\naVx509fp_sha1\np65\naS'_parsed_old'\np66\naVversion"
+            "\np67\naVregistrar\np68\naS'_group'\np69\naVemail\np70\naVchannel\np71\naVadip\np72"
+            "\naVproduct\np73\naVdescription\np74\naS'_do_not_resolve_fqdn_to_ip'\np75\naVexpires"
+            "\np76\naVhandshake\np77\naVbotid\np78\naVaction\np79\naVfilename\np80\naViban\np81\n"
+            "aVaddress\np82\naVmethod\np83\naS'_bl-series-no'\np84\naVmd5\np85\naVsha1\np86\naVse"
+            "nder\np87\naS'_bl-current-time'\np88\naVurl\np89\naS'_first_time'\np90\naVrequest\np"
+            "91\naVfqdn\np92\naVclient\np93\naVstatus\np94\naVuser_agent\np95\naVtime\np96\naVdpo"
+            "rt\np97\natRp98\nsS'context_manager_error_callback'\np99\nNsS'log_nonstandard_names'"
+            "\np100\nI01\nsS'_dict'\np101\n(dp102\nS'category'\np103\nVbots\np104\nsS'source'\np1"
+            "05\nVfoo.bar\np106\nsS'address'\np107\n(lp108\n(dp109\nVcc\np110\nVPL\np111\nsVip\np"
+            "112\nV1.2.3.4\np113\nsassS'used_as_context_manager'\np114\nI00\nsb."
+        ),
+        (  # protocol 2
+            '\x80\x02cn6lib.record_dict\nRecordDict\nq\x01)\x81q\x02}q\x03(U\x0e_settable_keysq'
+            '\x04c__builtin__\nfrozenset\nq\x05]q\x06(X\x06\x00\x00\x00originq\x07X\x0b\x00\x00'
+            '\x00restrictionq\x08U\t_url_dataq\tX\x07\x00\x00\x00sysdescq\nX\x07\x00\x00\x00datas'
+            'etq\x0bU\r_bl-series-idq\x0cX\x06\x00\x00\x00headerq\rX\x0b\x00\x00\x00internal_ipq'
+            '\x0eX\n\x00\x00\x00first_seenq\x0fX\x0b\x00\x00\x00url_patternq\x10X\x0e\x00\x00\x00'
+            'detected_sinceq\x11X\n\x00\x00\x00confidenceq\x12X\r\x00\x00\x00misp_eventdidq\x13X'
+            '\x0e\x00\x00\x00misp_attr_uuidq\x14U\x0f_url_data_readyq\x15X\x06\x00\x00\x00sourceq'
+            '\x16U\x08enrichedq\x17X\x0b\x00\x00\x00mac_addressq\x18X\x06\x00\x00\x00sha256q\x19U'
+            '\x04typeq\x1aX\x05\x00\x00\x00untilq\x1bX\x07\x00\x00\x00intelmqq\x1cX\x0b\x00\x00'
+            '\x00dns_versionq\x1dX\x11\x00\x00\x00visible_databasesq\x1eX\x07\x00\x00\x00injectsq'
+            '\x1fX\n\x00\x00\x00ip_networkq X\x11\x00\x00\x00alternative_fqdnsq!X\x0f\x00\x00\x00'
+            'misp_event_uuidq"X\x0b\x00\x00\x00facebook_idq#X\x0b\x00\x00\x00x509subjectq$X\x05'
+            '\x00\x00\x00phoneq%X\x07\x00\x00\x00refererq&X\x0c\x00\x00\x00count_actualq\'X\x06'
+            '\x00\x00\x00targetq(X\x05\x00\x00\x00countq)X\x08\x00\x00\x00replacesq*X\x04\x00\x00'
+            '\x00nameq+X\x08\x00\x00\x00modifiedq,X\n\x00\x00\x00proxy_typeq-X\x03\x00\x00\x00dip'
+            'q.X\x0f\x00\x00\x00additional_dataq/X\n\x00\x00\x00x509issuerq0X\x08\x00\x00\x00user'
+            'nameq1U\x10_bl-series-totalq2X\x0b\x00\x00\x00cert_lengthq3X\x03\x00\x00\x00ridq4X'
+            '\x05\x00\x00\x00sportq5X\x0c\x00\x00\x00ipmi_versionq6X\x02\x00\x00\x00idq7X\x08\x00'
+            '\x00\x00categoryq8U\x08_bl-timeq9X\x0c\x00\x00\x00urls_matchedq:X\x05\x00\x00\x00pro'
+            'toq;X\x04\x00\x00\x00tagsq<X\x13\x00\x00\x00subject_common_nameq=X\x11\x00\x00\x00mi'
+            'n_amplificationq>X\x0b\x00\x00\x00x509fp_sha1q?U\x0b_parsed_oldq@X\x07\x00\x00\x00ve'
+            'rsionqAX\t\x00\x00\x00registrarqBU\x06_groupqCX\x05\x00\x00\x00emailqDX\x07\x00\x00'
+            '\x00channelqEX\x04\x00\x00\x00adipqFX\x07\x00\x00\x00productqGX\x0b\x00\x00\x00descr'
+            'iptionqHU\x1a_do_not_resolve_fqdn_to_ipqIX\x07\x00\x00\x00expiresqJX\t\x00\x00\x00ha'
+            'ndshakeqKX\x05\x00\x00\x00botidqLX\x06\x00\x00\x00actionqMX\x08\x00\x00\x00filenameq'
+            'NX\x04\x00\x00\x00ibanqOX\x07\x00\x00\x00addressqPX\x06\x00\x00\x00methodqQU\r_bl-se'
+            'ries-noqRX\x03\x00\x00\x00md5qSX\x04\x00\x00\x00sha1qTX\x06\x00\x00\x00senderqUU\x10'
+            '_bl-current-timeqVX\x03\x00\x00\x00urlqWU\x0b_first_timeqXX\x07\x00\x00\x00requestqY'
+            'X\x04\x00\x00\x00fqdnqZX\x06\x00\x00\x00clientq[X\x06\x00\x00\x00statusq\\X\n\x00'
+            '\x00\x00user_agentq]X\x04\x00\x00\x00timeq^X\x05\x00\x00\x00dportq_e\x85Rq`U\x1econt'
+            'ext_manager_error_callbackqaNU\x15log_nonstandard_namesqb\x88U\x05_dictqc}qd(U\x08ca'
+            'tegoryqeX\x04\x00\x00\x00botsU\x06sourceqfX\x07\x00\x00\x00foo.barU\x07addressqg]qh}'
+            'qi(X\x02\x00\x00\x00ccX\x02\x00\x00\x00PLX\x02\x00\x00\x00ipX\x07\x00\x00\x001.2.3.4'
+            'uauU\x17used_as_context_managerqj\x89ub.'
+        ),
+    ]
+
+    def test_unpickling_legacy_pickles(self):
+        for pickled in self.LEGACY_PICKLES:
+            rd = cPickle.loads(pickled)
+            self.assertIs(type(rd), RecordDict)
+            self.assertFalse(hasattr(rd, '__dict__'))
+            self.assertEqual(rd, {'category': 'bots',
+                                  'source': 'foo.bar',
+                                  'address': [{'ip': '1.2.3.4', 'cc': 'PL'}]})
+            self.assertTrue(rd.log_nonstandard_names)
+            self.assertIsNone(rd.context_manager_error_callback)
+            self.assertFalse(rd.used_as_context_manager)
+            self.assertIs(rd._settable_keys, RecordDict._settable_keys)
+            self.assertIsNone(rd._ready_json)
+            rd['name'] = 'foo'
+            self.assertEqual(rd['name'], 'foo')
+
+    def test_pickled_after_used_as_context_manager(self):
+        with self.rd_class({'category': 'bots'}) as rd:
+            pass
+        rd2 = cPickle.loads(cPickle.dumps(rd, 2))
+        self.assertTrue(rd2.used_as_context_manager)
+        with self.assertRaises(TypeError):
+            with rd2:
+                pass
+
     def test_picklability(self):
         @picklable
         class Subclass(self.rd_class):
@@ -682,6 +924,66 @@ class TestRecordDict(TestCaseMixin, unittest.TestCase):
             with self.assertRaises(ValueError):
                 rd.get_ready_dict()
 
+    def test__get_ready_json__compatible_with_bson(self):
+        fixtures = [
+            self.only_required,
+            self.with_optional,
+            self.with_custom,
+            self.with_address_empty,
+            self.with_address1,
+            self.with_address2,
+            self.with_url_data1,
+            self.with_url_data2,
+        ]
+        for fixture in fixtures:
+            rd = self.rd_class(fixture)
+            rd['enriched'] = (['fqdn'], {'127.0.0.1': ['asn', 'cc']})
+            self.assertEqual(rd.get_ready_json(), bson_dumps(rd.get_ready_dict()))
+        self.assertEqual(self.rd_with_custom.get_ready_json(),
+                         bson_dumps(self.rd_with_custom.get_ready_dict()))
+
+    def test__get_ready_json__compatible_with_bson__other_value_types(self):
+        rd = self.rd_class(self.only_required)
+        rd._dict.update({
+            'time': datetime.datetime(2019, 1, 2, 3, 4, 5, 678901),
+            'until': datetime.datetime(2019, 1, 2, 3, 4, 5, tzinfo=FixedOffsetTimezone(120)),
+            'client': set(['o1']),
+            '_parsed_old': self.rd_class(self.with_address1),
+        })
+        # (not comparing with get_ready_dict()'s result, as deep-copying
+        # may change the order of items in the nested record dict)
+        self.assertEqual(rd.get_ready_json(), bson_dumps(rd._get_ready_items()))
+        self.assertEqual(json.loads(rd.get_ready_json())['time'], {'$date': 1546398245678})
+
+    def test__get_ready_json__cached(self):
+        rd = self.rd_class(self.with_address2)
+        ready_json = rd.get_ready_json()
+        self.assertIs(rd.get_ready_json(), ready_json)
+        self.assertEqual(rd['source'], 'foo.bar')
+        self.assertIs(rd.get_ready_json(), ready_json)
+        rd['dport'] = 80
+        ready_json = rd.get_ready_json()
+        self.assertEqual(json.loads(ready_json)['dport'], 80)
+        self.assertIs(rd.get_ready_json(), ready_json)
+        del rd['dport']
+        self.assertNotIn('dport', json.loads(rd.get_ready_json()))
+        rd.append_address({'ip': '127.0.0.3'})
+        self.assertEqual(len(json.loads(rd.get_ready_json())['address']), 3)
+        rd['address'][0]['cc'] = 'DE'
+        self.assertEqual(json.loads(rd.get_ready_json())['address'][0]['cc'], 'DE')
+        rd.get('address')[0]['asn'] = 42
+        self.assertEqual(json.loads(rd.get_ready_json())['address'][0]['asn'], 42)
+
+    def test__get_ready_json__not_cached_after_mutable_value_handed_out(self):
+        rd = self.rd_class(self.with_address2)
+        address = rd['address']
+        rd.get_ready_json()
+        address.append({'ip': '2.2.2.2'})
+        self.assertEqual(len(json.loads(rd.get_ready_json())['address']), 3)
+        address[0]['cc'] = 'DE'
+        self.assertEqual(json.loads(rd.get_ready_json())['address'][0]['cc'], 'DE')
+        self.assertIsNone(rd._ready_json)
+
     def test__iter_db_items(self):
         expected_db_item_lists = dict(
             only_required=[
@@ -784,6 +1086,46 @@ class TestRecordDict(TestCaseMixin, unittest.TestCase):
             else:
                 self.assertEqual(len(db_items), 1)
 
+    def test__iter_db_rows(self):
+        column_name_seqs = [
+            ('id', 'time', 'ip', 'cc', 'asn', 'dip', 'address', 'custom', 'url',
+             'category', 'rid', 'source', 'restriction', 'confidence', 'expires'),
+            ['asn', 'custom', 'ip', 'dip', 'id'],
+            ('id', 'url', 'address'),
+            (),
+        ]
+        for fixture_key in ['only_required', 'with_optional', 'with_custom',
+                            'with_custom_2', 'with_address_empty', 'with_address1',
+                            'with_address2', 'with_url_data1', 'with_url_data2']:
+            rd = self.rd_class(getattr(self, fixture_key))
+            rd['client'] = ['o1', 'o2']
+            for column_names in column_name_seqs:
+                expected_rows = [
+                    tuple(
+                        (ip_str_to_int(item[name]) if name == 'ip' and 'ip' in item else
+                         0 if name == 'ip' else
+                         ip_str_to_int(item[name]) if name == 'dip' and 'dip' in item else
+                         item.get(name))
+                        for name in column_names)
+                    for item in rd.iter_db_items()]
+                iterator = rd.iter_db_rows(column_names)
+                self.assertIsInstance(iterator, collections.Iterator)
+                rows = list(iterator)
+                self.assertEqual(rows, expected_rows)
+                self.assertTrue(all(type(row) is tuple for row in rows))
+
+    def test__iter_db_rows__values(self):
+        rd = self.rd_class(self.with_address2)
+        rd['dip'] = '10.20.30.40'
+        self.assertEqual(list(rd.iter_db_rows(['ip', 'cc', 'asn', 'dip', 'id'])), [
+            (2130706433, None, None, 169090600, 32 * '3'),
+            (2130706434, 'PL', 1, 169090600, 32 * '3'),
+        ])
+        rd = self.rd_class(self.only_required)
+        self.assertEqual(list(rd.iter_db_rows(['ip', 'cc', 'asn', 'dip', 'id'])), [
+            (0, None, None, None, 32 * '3'),
+        ])
+
     def _test_setitem_valid(self, key, values):
         # `values` can be:
         # * S(<expected result value>, <tuple of input values>)
@@ -2047,3 +2389,178 @@ class TestBLRecordDict(TestRecordDict):
         TestRecordDict.only_required,
         expires='2013-09-12 11:30:00',
     )
+
+
+class TestRecordDictSubclassing(unittest.TestCase):
+
+    def test_adjusters_are_compiled_for_each_class(self):
+        class MyRecordDict(RecordDict):
+            optional_keys = RecordDict.optional_keys | {'foo', 'bar', 'spam-ham'}
+            adjust_foo = None
+            adjust_bar = staticmethod(lambda value: value * 2)
+            adjust_spamham = ensure_isinstance(int)
+        self.assertEqual(MyRecordDict._settable_keys,
+                         RecordDict._settable_keys | {'foo', 'bar', 'spam-ham'})
+        self.assertIsNot(MyRecordDict._adjusters, RecordDict._adjusters)
+        self.assertNotIn('foo', RecordDict._adjusters)
+        rd = MyRecordDict({'foo': sen.foo, 'bar': 21, 'category': 'bots'})
+        rd['spam-ham'] = 42
+        self.assertEqual(rd, {'foo': sen.foo, 'bar': 42, 'spam-ham': 42, 'category': 'bots'})
+        with self.assertRaises(AdjusterError):
+            rd['spam-ham'] = '42'
+        with self.assertRaises(RuntimeError):
+            RecordDict({'foo': sen.foo})
+
+    def test_overridden_adjuster(self):
+        class MyRecordDict(RecordDict):
+            def adjust_category(self, value):
+                return value.upper()
+        self.assertEqual(MyRecordDict({'category': 'bots'})['category'], 'BOTS')
+        self.assertEqual(RecordDict({'category': 'bots'})['category'], 'bots')
+
+    def test_missing_adjuster_detected_when_class_is_created(self):
+        with self.assertRaises(TypeError):
+            class MyRecordDict(RecordDict):
+                optional_keys = RecordDict.optional_keys | {'foo'}
+
+    def test_duplicated_keys_detected_when_class_is_created(self):
+        with self.assertRaises(ValueError):
+            class MyRecordDict(RecordDict):
+                optional_keys = RecordDict.optional_keys | {'id'}
+
+    def test_compiled_adjusters_are_not_stored_in_instances(self):
+        rd = RecordDict({'category': 'bots'})
+        self.assertFalse(hasattr(rd, '__dict__'))
+        self.assertNotIn('_adjusters', rd.__getstate__())
+        self.assertEqual(cPickle.loads(cPickle.dumps(rd, -1)), rd)
+        self.assertEqual(rd.copy(), rd)
+
+
+class TestRecordDict_from_json(unittest.TestCase):
+
+    def _make_record_dict(self, rd_class=RecordDict):
+        rd = rd_class()
+        rd.update({
+            'id': 32 * '3',
+            'rid': 32 * '4',
+            'source': 'foo.bar',
+            'restriction': 'public',
+            'confidence': 'low',
+            'category': 'bots',
+            'name': 'Virut',
+            'time': '2019-01-01T10:00:00+01:00',
+            'expires': '2019-02-01 00:00:00',
+            'address': [{'ip': '1.2.3.4', 'cc': 'pl', 'asn': 123}],
+            'url': u'http://Example.com/ą',
+            'fqdn': 'Example.COM',
+            'dport': 80,
+            'client': ['o1', 'o2'],
+            'additional_data': u'ą',
+            '_url_data': {'url_orig': 'aHR0cDovL3gv_w==', 'url_norm_opts': {'a': True}},
+            '_bl-current-time': '2019-01-01 00:00:00',
+            '_bl-time': '2019-01-01 00:00:00',
+        })
+        rd['enriched'] = (['fqdn'], {'1.2.3.4': ['asn', 'cc']})
+        return rd
+
+    @staticmethod
+    def _typed(value):
+        if isinstance(value, dict):
+            return {key: TestRecordDict_from_json._typed(val)
+                    for key, val in value.iteritems()}
+        if isinstance(value, (list, tuple)):
+            return type(value), map(TestRecordDict_from_json._typed, value)
+        return type(value), value
+
+    def test_trusted_gives_the_same_as_adjusted(self):
+        for rd_class in (RecordDict, BLRecordDict):
+            json_string = self._make_record_dict(rd_class).get_ready_json()
+            adjusted = rd_class.from_json(json_string)
+            trusted = rd_class.from_json(json_string, trusted=True)
+            self.assertIs(type(trusted), rd_class)
+            self.assertEqual(self._typed(trusted._dict), self._typed(adjusted._dict))
+            self.assertNotIn('__preserved_custom_keys__', trusted)
+            self.assertEqual(trusted.get_ready_json(), json_string)
+
+    def test_trusted_skips_adjusters(self):
+        json_string = '{"category": "BOTS", "source": "foo.bar"}'
+        with self.assertRaises(AdjusterError):
+            RecordDict.from_json(json_string)
+        self.assertEqual(RecordDict.from_json(json_string, trusted=True),
+                         {'category': 'BOTS', 'source': 'foo.bar'})
+
+    def test_trusted_illegal_key(self):
+        with self.assertRaises(RuntimeError):
+            RecordDict.from_json('{"category": "bots", "foo": 1}', trusted=True)
+
+    def test_trusted_kwargs_passed_to_constructor(self):
+        rd = RecordDict.from_json('{"category": "bots"}', trusted=True,
+                                  log_nonstandard_names=True,
+                                  context_manager_error_callback=sen.callback)
+        self.assertTrue(rd.log_nonstandard_names)
+        self.assertIs(rd.context_manager_error_callback, sen.callback)
+
+    def test_trusted_with_validation(self):
+        json_string = self._make_record_dict().get_ready_json()
+        with patch('n6lib.record_dict.LOGGER') as LOGGER_mock:
+            rd = RecordDict.from_json(json_string, trusted=True, validation_rate=1.0)
+        self.assertEqual(rd, RecordDict.from_json(json_string))
+        self.assertEqual(LOGGER_mock.error.mock_calls, [])
+
+    def test_trusted_with_validation__discrepancy_logged(self):
+        json_string = '{"category": "bots", "md5": "%s"}' % (32 * 'A')
+        with patch('n6lib.record_dict.LOGGER') as LOGGER_mock:
+            rd = RecordDict.from_json(json_string, trusted=True, validation_rate=1.0)
+        self.assertEqual(rd, {'category': 'bots', 'md5': 32 * 'a'})
+        self.assertEqual(len(LOGGER_mock.error.mock_calls), 1)
+
+    def test_trusted_with_validation_rate_0(self):
+        json_string = '{"category": "bots", "md5": "%s"}' % (32 * 'A')
+        with patch('n6lib.record_dict.LOGGER') as LOGGER_mock:
+            rd = RecordDict.from_json(json_string, trusted=True, validation_rate=0.0)
+        self.assertEqual(rd, {'category': 'bots', 'md5': 32 * 'A'})
+        self.assertEqual(LOGGER_mock.error.mock_calls, [])
+
+
+class TestRecordDict_ready_values_are_independent(unittest.TestCase):
+
+    def setUp(self):
+        self.rd = RecordDict({
+            'id': 32 * '3',
+            'rid': 32 * '4',
+            'source': 'foo.bar',
+            'restriction': 'public',
+            'confidence': 'low',
+            'category': 'bots',
+            'time': '2019-01-01T10:00:00',
+            'address': [{'ip': '1.2.3.4', 'cc': 'PL'}],
+            'client': ['o1'],
+            '_url_data': {'url_orig': 'aHR0cDovL3gv_w==', 'url_norm_opts': {'a': True}},
+        })
+        self.rd['enriched'] = (['fqdn'], {'1.2.3.4': ['asn']})
+        self.rd_copy = copy.deepcopy(self.rd._dict)
+
+    def test_get_ready_dict(self):
+        ready_dict = self.rd.get_ready_dict()
+        self.assertEqual(ready_dict, dict(self.rd_copy,
+                                          __preserved_custom_keys__=['enriched']))
+        ready_dict['__preserved_custom_keys__'].append('foo')
+        ready_dict['address'][0]['cc'] = 'DE'
+        ready_dict['address'].append({'ip': '5.6.7.8'})
+        ready_dict['client'].append('o2')
+        ready_dict['enriched'][0].append('url')
+        ready_dict['enriched'][1]['1.2.3.4'].append('cc')
+        ready_dict['_url_data_ready']['url_norm_opts']['a'] = False
+        self.assertEqual(self.rd._dict, self.rd_copy)
+
+    def test_iter_db_items(self):
+        [db_item] = list(self.rd.iter_db_items())
+        db_item['address'][0]['cc'] = 'DE'
+        db_item['client'].append('o2')
+        db_item['custom']['url_data']['url_norm_opts']['a'] = False
+        self.assertEqual(self.rd._dict, self.rd_copy)
+
+    def test_get_ready_json(self):
+        self.assertEqual(json.loads(self.rd.get_ready_json()),
+                         json.loads(json.dumps(self.rd.get_ready_dict())))
+        self.assertEqual(self.rd._dict, self.rd_copy)
@@ -981,6 +981,9 @@ class QueryMock(mock.MagicMock):
         m.one.return_value = self._get_from_db(self.table, col, val)
         return m
 
+    def options(self, *args):
+        return self
+
     def all(self):
         return self.collection.get(self.table, [])
 
@@ -10,6 +10,7 @@
 
 import calendar
 import datetime
+import re
 
 from n6sdk.regexes import (
     ISO_DATE_REGEX,
@@ -18,6 +19,26 @@ from n6sdk.regexes import (
 )
 
 
+# the most typical form of ISO-8601 combined date and time (for which
+# a faster way of parsing is used; see: _parse_canonical_iso_datetime())
+_CANONICAL_ISO_DATETIME_REGEX = re.compile(
+    r'(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2}):(\d{2})'
+    r'(?:\.(\d+))?'
+    r'(?:Z|([+-]\d{2}):(\d{2}))?'
+    r'\Z')
+
+# (a dict lookup is considerably faster than int())
+_TWO_DIGIT_STR_TO_INT = {'{:02}'.format(i): i for i in xrange(100)}
+
+_ZERO_TIMEDELTA = datetime.timedelta(0)
+
+# the cache of parse_iso_datetime_to_utc() results (see the comment in
+# that function) + its maximum size
+_iso_datetime_to_utc_recent_cache = {}
+_iso_datetime_to_utc_old_cache = {}
+_ISO_DATETIME_TO_UTC_CACHE_MAX_SIZE = 5000
+
+
 class FixedOffsetTimezone(datetime.tzinfo):
 
     """
@@ -133,7 +154,19 @@ def datetime_utc_normalize(dt):
     ...                                 tzinfo=tzinfo)
     >>> datetime_utc_normalize(tz_aware_dt)
     datetime.datetime(2013, 6, 6, 12, 13, 57, 251211)
+
+    >>> tz_aware_dt = datetime.datetime(2013, 6, 6, 1, 13, 57, tzinfo=tzinfo)
+    >>> datetime_utc_normalize(tz_aware_dt)
+    datetime.datetime(2013, 6, 5, 23, 13, 57)
     """
+    if not dt.microsecond:
+        # (a faster way -- giving the same results as the one below,
+        # except for overflows; when microseconds are non-zero, the
+        # results could differ because of floating point rounding)
+        try:
+            return (dt - (dt.utcoffset() or _ZERO_TIMEDELTA)).replace(tzinfo=None)
+        except OverflowError:
+            pass
     return datetime.datetime.utcfromtimestamp(datetime_to_utc_timestamp(dt))
 
 
@@ -310,6 +343,9 @@ def parse_iso_datetime(s, prestrip=True):
     """
     if prestrip:
         s = s.strip()
+    dt = _parse_canonical_iso_datetime(s)
+    if dt is not None:
+        return dt
     match = ISO_DATETIME_REGEX.match(s)
     if match:
         d = _make_date_from_match(match)
@@ -368,8 +404,36 @@ def parse_iso_datetime_to_utc(s, prestrip=True):
     Traceback (most recent call last):
     ...
     ValueError: ...
+
+    The results are cached (for the sake of efficiency, as the same
+    strings are often parsed repeatedly).
+
+    >>> dt = parse_iso_datetime_to_utc('2013-06-13 10:02:04')
+    >>> dt
+    datetime.datetime(2013, 6, 13, 10, 2, 4)
+    >>> parse_iso_datetime_to_utc('2013-06-13 10:02:04') is dt
+    True
     """
-    return datetime_utc_normalize(parse_iso_datetime(s, prestrip=prestrip))
+    # Note: the cache is an approximation of an LRU one: it consists
+    # of two dicts -- when the *recent* one becomes full, it replaces
+    # the *old* one (which is dropped); an item found in the *old* one
+    # is moved to the *recent* one.  (`OrderedDict` is not used as it
+    # is a pure-Python class, so its operations are much slower.)
+    cache_key = (s if prestrip else (s,))
+    dt = _iso_datetime_to_utc_recent_cache.get(cache_key)
+    if dt is None:
+        dt = _iso_datetime_to_utc_old_cache.get(cache_key)
+        if dt is None:
+            dt = datetime_utc_normalize(parse_iso_datetime(s, prestrip=prestrip))
+        _cache_iso_datetime_to_utc_result(cache_key, dt)
+    return dt
+
+def _cache_iso_datetime_to_utc_result(cache_key, dt):
+    global _iso_datetime_to_utc_recent_cache, _iso_datetime_to_utc_old_cache
+    if len(_iso_datetime_to_utc_recent_cache) >= _ISO_DATETIME_TO_UTC_CACHE_MAX_SIZE // 2:
+        _iso_datetime_to_utc_old_cache = _iso_datetime_to_utc_recent_cache
+        _iso_datetime_to_utc_recent_cache = {}
+    _iso_datetime_to_utc_recent_cache[cache_key] = dt
 
 
 # TODO: doc, tests
@@ -412,6 +476,50 @@ def is_datetime_format_normalized(s):
     return False
 
 
+def _parse_canonical_iso_datetime(s):
+    # A faster equivalent of the regex-based parsing done by
+    # parse_iso_datetime() -- but only for the most typical form of
+    # input: `YYYY-MM-DD[T ]hh:mm:ss[.ffffff][Z|+hh:mm|-hh:mm]`
+    # (with any number of fractional digits); returns None for any
+    # other input (also for the corner cases: hour 24, second 60 and
+    # invalid time zone minutes -- as these need special treatment).
+    match = _CANONICAL_ISO_DATETIME_REGEX.match(s)
+    if match is None:
+        return None
+    year, month, day, hour, minute, second, fract_str, tzhour, tzminute = match.groups()
+    two_digit_str_to_int = _TWO_DIGIT_STR_TO_INT
+    hour = two_digit_str_to_int[hour]
+    second = two_digit_str_to_int[second]
+    if hour == 24 or second == 60:
+        return None
+    if fract_str:
+        microsecond = (int(fract_str) * 1000000) // (10 ** len(fract_str))
+        microsecond = min(microsecond, 999999)  # must be less than million
+    else:
+        microsecond = 0
+    if tzhour:
+        tzminute = two_digit_str_to_int[tzminute]
+        if tzminute > 59:
+            return None
+        utc_offset = int(tzhour) * 60
+        # (keeping the same behavior as _make_time_from_match())
+        if utc_offset >= 0:
+            utc_offset += tzminute
+        else:
+            utc_offset -= tzminute
+        tzinfo = FixedOffsetTimezone(utc_offset)
+    else:
+        tzinfo = None
+    return datetime.datetime(int(year),
+                             two_digit_str_to_int[month],
+                             two_digit_str_to_int[day],
+                             hour,
+                             two_digit_str_to_int[minute],
+                             second,
+                             microsecond,
+                             tzinfo)
+
+
 # TODO: doc, tests
 def _make_date_from_match(match):
     g = match.groupdict()
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2013-2019 NASK. All rights reserved.
+
+
+import datetime
+import itertools
+import unittest
+
+from mock import patch
+
+from n6sdk import datetime_helpers
+from n6sdk.datetime_helpers import (
+    FixedOffsetTimezone,
+    _parse_canonical_iso_datetime,
+    datetime_to_utc_timestamp,
+    datetime_utc_normalize,
+    parse_iso_datetime,
+    parse_iso_datetime_to_utc,
+)
+
+
+def _result_or_exc_type(func, s):
+    try:
+        return func(s)
+    except Exception as exc:
+        return type(exc)
+
+
+class Test_parse_iso_datetime__canonical_form(unittest.TestCase):
+
+    # the fast parsing of the canonical form must give exactly the same
+    # results as the (generic) regex-based parsing
+
+    DATES = ['2013-06-13', '2016-02-29', '2015-02-29', '0001-01-01', '9999-12-31', '2013-13-01']
+    SEPARATORS = ['T', ' ', '\t', 't', '']
+    TIMES = ['10:02:04', '00:00:00', '23:59:59', '24:00:00', '23:59:60', '10:02', '25:00:00']
+    FRACTIONS = ['', '.1', '.123456', '.1234567', '.999999999', '.']
+    TIMEZONES = ['', 'Z', '+02:00', '-07:30', '-00:30', '+0200', '+02', '+02:60', 'z']
+
+    def _all_inputs(self):
+        for (date, sep, time, fraction, tz) in itertools.product(self.DATES,
+                                                                 self.SEPARATORS,
+                                                                 self.TIMES,
+                                                                 self.FRACTIONS,
+                                                                 self.TIMEZONES):
+            s = date + sep + time + fraction + tz
+            yield s
+            yield s.decode('ascii')
+
+    def test_same_results_as_regex_based_parsing(self):
+        inputs = list(self._all_inputs())
+        with patch('n6sdk.datetime_helpers._parse_canonical_iso_datetime',
+                   return_value=None):
+            expected_results = [_result_or_exc_type(parse_iso_datetime, s)
+                                for s in inputs]
+        canonical_count = 0
+        for s, expected in zip(inputs, expected_results):
+            actual = _result_or_exc_type(parse_iso_datetime, s)
+            self.assertEqual(actual, expected, s)
+            if isinstance(expected, datetime.datetime):
+                self.assertEqual(actual.utcoffset(), expected.utcoffset(), s)
+            if _result_or_exc_type(_parse_canonical_iso_datetime, s) is not None:
+                canonical_count += 1
+        self.assertGreater(canonical_count, 1000)
+
+    def test_non_canonical_forms_not_parsed_by_fast_parser(self):
+        for s in ['2013-06-13T10:02Z',
+                  '2013-06-13T24:00:00',
+                  '2013-06-13T10:02:60',
+                  '2013-06-13T10:02:04+02',
+                  '2013-06-13T10:02:04+0200',
+                  '2013-06-13T10:02:04+02:60',
+                  '2013-06-13\t10:02:04',
+                  '20130613T100204',
+                  u'2013-06-13T10:02:0٤']:   # (non-ASCII digit)
+            self.assertIsNone(_parse_canonical_iso_datetime(s), s)
+
+    def test_canonical_forms(self):
+        self.assertEqual(
+            _parse_canonical_iso_datetime('2013-06-13 10:02:04'),
+            datetime.datetime(2013, 6, 13, 10, 2, 4))
+        self.assertEqual(
+            _parse_canonical_iso_datetime('2013-06-13T10:02:04.1234567Z'),
+            datetime.datetime(2013, 6, 13, 10, 2, 4, 123456))
+        dt = _parse_canonical_iso_datetime('2013-06-13T10:02:04-07:30')
+        self.assertEqual(dt.replace(tzinfo=None), datetime.datetime(2013, 6, 13, 10, 2, 4))
+        self.assertEqual(dt.tzinfo.utcoffset(None), FixedOffsetTimezone(-450).utcoffset(None))
+
+
+class Test_datetime_utc_normalize(unittest.TestCase):
+
+    # the faster way (used if there are no microseconds) must give
+    # the same results as the timestamp-based one
+
+    def _normalize_using_timestamp(self, dt):
+        return datetime.datetime.utcfromtimestamp(datetime_to_utc_timestamp(dt))
+
+    def test_same_results_as_timestamp_based_normalization(self):
+        for dt, offset in itertools.product(
+                [datetime.datetime(1, 1, 1),
+                 datetime.datetime(1, 1, 1, 23, 59, 59),
+                 datetime.datetime(1969, 12, 31, 23, 59, 59),
+                 datetime.datetime(1970, 1, 1),
+                 datetime.datetime(2016, 2, 29, 12, 30),
+                 datetime.datetime(2038, 1, 19, 3, 14, 8),
+                 datetime.datetime(9999, 12, 31),
+                 datetime.datetime(9999, 12, 31, 23, 59, 59)],
+                [None, 0, 1, -1, 120, -450, 1439, -1439]):
+            if offset is not None:
+                dt = dt.replace(tzinfo=FixedOffsetTimezone(offset))
+            expected = _result_or_exc_type(self._normalize_using_timestamp, dt)
+            actual = _result_or_exc_type(datetime_utc_normalize, dt)
+            self.assertEqual(actual, expected, (dt, offset))
+            if isinstance(expected, datetime.datetime):
+                self.assertIs(type(actual), datetime.datetime)
+                self.assertIsNone(actual.tzinfo)
+
+
+class Test_parse_iso_datetime_to_utc__cache(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch.multiple(datetime_helpers,
+                                 _iso_datetime_to_utc_recent_cache={},
+                                 _iso_datetime_to_utc_old_cache={},
+                                 _ISO_DATETIME_TO_UTC_CACHE_MAX_SIZE=4)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_cached(self):
+        dt = parse_iso_datetime_to_utc(' 2013-06-13 10:02:04+02:00')
+        self.assertEqual(dt, datetime.datetime(2013, 6, 13, 8, 2, 4))
+        with patch('n6sdk.datetime_helpers.parse_iso_datetime') as parse_mock:
+            self.assertIs(parse_iso_datetime_to_utc(' 2013-06-13 10:02:04+02:00'), dt)
+        self.assertEqual(parse_mock.mock_calls, [])
+
+    def test_prestrip_false_not_confused_with_true(self):
+        parse_iso_datetime_to_utc(' 2013-06-13 10:02:04')
+        with self.assertRaises(ValueError):
+            parse_iso_datetime_to_utc(' 2013-06-13 10:02:04', prestrip=False)
+
+    def test_errors_not_cached(self):
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                parse_iso_datetime_to_utc('2013-13-13 10:02:04')
+        self.assertEqual(datetime_helpers._iso_datetime_to_utc_recent_cache, {})
+
+    def test_least_recently_used_dropped(self):
+        strings = ['2013-06-1{} 10:02:04'.format(i) for i in range(4)]
+        results = [parse_iso_datetime_to_utc(s) for s in strings[:2]]
+        results.extend(parse_iso_datetime_to_utc(s) for s in strings[2:])
+        # used again (-> to be kept longer)
+        self.assertIs(parse_iso_datetime_to_utc(strings[1]), results[1])
+        parse_iso_datetime_to_utc('2013-06-20 10:02:04')
+        parse_iso_datetime_to_utc('2013-06-21 10:02:04')
+        self.assertIs(parse_iso_datetime_to_utc(strings[1]), results[1])
+        self.assertIsNot(parse_iso_datetime_to_utc(strings[0]), results[0])
+        self.assertEqual(parse_iso_datetime_to_utc(strings[0]), results[0])
+
+
+if __name__ == '__main__':
+    unittest.main()